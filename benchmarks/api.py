@@ -0,0 +1,97 @@
+"""
+Benchmark Api, Block, Connection and Pattern
+operations against a local FakeServer.
+
+  python benchmarks/api.py [n_blocks] [latency]
+"""
+import sys
+import time
+
+from streamtools import Api, AsyncApi, Block, Connection, Pattern
+from streamtools.fake import FakeServer
+
+
+def timed(name, server, fn, *args, **kw):
+  start_hits = server.request_count
+  start = time.time()
+  fn(*args, **kw)
+  elapsed = time.time() - start
+  print '{:<28} {:>9.3f}s {:>7} requests'\
+    .format(name, elapsed, server.request_count - start_hits)
+
+
+def bench_api(st, n):
+  for i in range(n):
+    st.create_block('api-{}'.format(i), type='ticker')
+  for i in range(n - 1):
+    st.create_connection(from_id='api-{}'.format(i), to_id='api-{}'.format(i + 1))
+
+
+def bench_async(st, n):
+  st.create_blocks([
+    {'block_id': 'async-{}'.format(i), 'type': 'ticker'} for i in range(n)
+  ])
+  st.create_connections([
+    {'from_id': 'async-{}'.format(i), 'to_id': 'async-{}'.format(i + 1)}
+    for i in range(n - 1)
+  ])
+
+
+def bench_models(url, n):
+  blocks = [Block('model-{}'.format(i), type='ticker', url=url) for i in range(n)]
+  for b1, b2 in zip(blocks, blocks[1:]):
+    Connection(from_id=b1.id, to_id=b2.id, url=url)
+
+
+def build_pattern(url, n):
+  blocks = [Block('pattern-{}'.format(i), type='ticker', url=url) for i in range(n)]
+  p = Pattern(url=url)
+  for b1, b2 in zip(blocks, blocks[1:]):
+    p += b1 + b2
+  return p
+
+
+def bench_lazy(url, n):
+  blocks = [Block('lazy-{}'.format(i), type='ticker', url=url, lazy=True) for i in range(n)]
+  p = Pattern(url=url)
+  for b1, b2 in zip(blocks, blocks[1:]):
+    p += b1 + b2
+  p.attach()
+
+
+def bench_reconcile(p):
+  p.blocks[0].rule = {'Interval': '5s'}
+  p.refresh(overwrite=False)
+
+
+def bench_walk(url):
+  for raw in Api(url).list_blocks():
+    b = Block(raw['Id'], url=url, _init=False)
+    b.in_blocks
+    b.out_blocks
+
+
+def main(n=50, latency=0.001):
+  with FakeServer(latency=latency) as server:
+    st = Api(server.url)
+    print 'n={} latency={}s'.format(n, latency)
+    timed('Api create', server, bench_api, st, n)
+    timed('Api delete_pattern', server, st.delete_pattern)
+    timed('AsyncApi create', server, bench_async, AsyncApi(server.url), n)
+    timed('Api delete_pattern', server, st.delete_pattern)
+    timed('Block + Connection', server, bench_models, server.url, n)
+    timed('Api delete_pattern', server, st.delete_pattern)
+    timed('Lazy Block + Connection', server, bench_lazy, server.url, n)
+    timed('Api delete_pattern', server, st.delete_pattern)
+    p = build_pattern(server.url, n)
+    timed('Pattern refresh', server, p.refresh)
+    timed('Pattern reconcile', server, bench_reconcile, p)
+    timed('Block graph walk', server, bench_walk, server.url)
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  main(
+    n=int(args[0]) if args else 50,
+    latency=float(args[1]) if len(args) > 1 else 0.001
+  )
@@ -0,0 +1,85 @@
+"""
+Compare the cost of encoding + decoding a message
+with kombu's json serializer and each plugin codec,
+including a projection that only decodes `.summary`.
+
+  python benchmarks/codec.py [n_messages]
+"""
+import sys
+import time
+import ujson
+
+from kombu.serialization import dumps, loads
+
+from streamtools.codec import CODECS, Projection
+
+
+EDIT = {
+  'action': 'edit',
+  'change_size': -42,
+  'flags': None,
+  'is_anon': False,
+  'is_bot': False,
+  'is_minor': True,
+  'is_new': False,
+  'is_unpatrolled': False,
+  'mediawiki_timestamp': 1419290211,
+  'ns': 'Main',
+  'page_title': 'List of Python software',
+  'summary': 'Undid revision 639204823 by 10.0.0.1 (talk)',
+  'url': 'https://en.wikipedia.org/w/index.php?diff=639204901&oldid=639204823',
+  'user': 'Example',
+  'geo_ip': {'city': 'Brooklyn', 'country_name': 'United States', 'latitude': 40.65, 'longitude': -73.95}
+}
+
+# a wide event: the edit plus its recent revisions.
+WIDE = dict(EDIT, revisions=[dict(EDIT, rev_id=i) for i in range(50)])
+
+# a wide event whose `summary` comes after 500 nested ones.
+NESTED = '{{"revisions": {}, "summary": "top"}}'.format(
+  ujson.dumps([EDIT] * 500))
+
+
+def measure(name, encode, decode, n, msg=EDIT):
+  start = time.time()
+  for i in range(n):
+    body = encode(msg)
+  encoded = time.time() - start
+
+  start = time.time()
+  for i in range(n):
+    decode(body)
+  decoded = time.time() - start
+
+  print '{:<12} encode {:>6.2f}us  decode {:>6.2f}us  {:>4} bytes'.format(
+    name, encoded / n * 1e6, decoded / n * 1e6, len(body))
+
+
+def main(n=100000):
+  print 'messages={}'.format(n)
+
+  def kombu_dumps(body):
+    return dumps(body, serializer='json')[2]
+  def kombu_loads(body):
+    return loads(body, 'application/json', 'utf-8')
+  measure('kombu json', kombu_dumps, kombu_loads, n)
+
+  for name, codec in sorted(CODECS.items()):
+    measure(name, codec.dumps, codec.loads, n)
+
+  projection = Projection(['.summary'])
+  measure('projected', CODECS['json'].dumps, projection.loads, n)
+
+  print 'wide messages={}'.format(n / 10)
+  measure('json', CODECS['json'].dumps, CODECS['json'].loads, n / 10, WIDE)
+  measure('projected', CODECS['json'].dumps, projection.loads, n / 10, WIDE)
+
+  print 'nested messages={}'.format(n / 1000)
+  raw = lambda body: body
+  measure('json', raw, CODECS['json'].loads, n / 1000, NESTED)
+  measure('projected', raw, projection.loads, n / 1000, NESTED)
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  main(n=int(args[0]) if args else 100000)
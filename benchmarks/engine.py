@@ -0,0 +1,44 @@
+"""
+Measure the throughput of a pattern
+run in-process by the local Engine.
+
+  python benchmarks/engine.py [n_messages]
+"""
+import sys
+import time
+
+from streamtools.engine import Engine
+
+
+PATTERN = {
+  'Blocks': [
+    {'Id': 'map', 'Type': 'map', 'Rule': {'Map': {'big': '.n > 10'}}},
+    {'Id': 'filter', 'Type': 'filter', 'Rule': {'Filter': '.big'}},
+    {'Id': 'hist', 'Type': 'histogram', 'Rule': {'Path': '.word', 'Window': '1h'}},
+    {'Id': 'count', 'Type': 'count', 'Rule': {'Window': '1h'}}
+  ],
+  'Connections': [
+    {'Id': 'a', 'FromId': 'map', 'ToId': 'filter', 'ToRoute': 'in'},
+    {'Id': 'b', 'FromId': 'filter', 'ToId': 'hist', 'ToRoute': 'in'},
+    {'Id': 'c', 'FromId': 'filter', 'ToId': 'count', 'ToRoute': 'in'}
+  ]
+}
+
+
+def main(n=100000):
+  words = ['a', 'b', 'c', 'd']
+  with Engine(PATTERN) as engine:
+    start = time.time()
+    for i in range(n):
+      engine.send('map', {'n': i % 20, 'word': words[i % 4]})
+    engine.drain(timeout=600)
+    elapsed = time.time() - start
+
+  print 'messages={} elapsed={:.3f}s rate={:,.0f}/s'.format(n, elapsed, n / elapsed)
+  for block_id, stats in sorted(engine.stats.items()):
+    print '{:<8} in {:>8} out {:>8}'.format(block_id, stats['in'], stats['out'])
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  main(n=int(args[0]) if args else 100000)
@@ -0,0 +1,38 @@
+"""
+Ramp load through a two-block pattern and report
+throughput, end-to-end latency + loss.
+
+  python benchmarks/load.py [rate] [ramp_to] [duration] [workers]
+"""
+import sys
+
+import streamtools as st
+from streamtools.fake import FakeServer
+from streamtools.load import LoadGenerator
+
+
+def main(rate=100, ramp_to=1000, duration=5, workers=8):
+  with FakeServer() as server:
+    p = st.Pattern(url=server.url)
+    p += st.Block('in', type='map', url=server.url) + \
+         st.Block('out', type='map', url=server.url)
+
+    report = LoadGenerator(p, rate=rate, ramp_to=ramp_to,
+                           duration=duration, workers=workers).run()
+
+  print 'rate={} ramp_to={} duration={}s workers={}'.format(rate, ramp_to, duration, workers)
+  print 'sent {sent} ({send_rate:,.0f}/s)  received {received} ({receive_rate:,.0f}/s)  ' \
+        'loss {loss:.2%}  errors {errors}'.format(**report)
+  latency = report['latency']
+  print 'latency p50 {:.2f}ms  p99 {:.2f}ms  p999 {:.2f}ms  max {:.2f}ms'.format(
+    *[(latency[k] or 0) * 1000 for k in ('p50', 'p99', 'p999', 'max')])
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  main(
+    rate=float(args[0]) if args else 100,
+    ramp_to=float(args[1]) if len(args) > 1 else 1000,
+    duration=float(args[2]) if len(args) > 2 else 5,
+    workers=int(args[3]) if len(args) > 3 else 8
+  )
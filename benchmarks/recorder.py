@@ -0,0 +1,46 @@
+"""
+Measure how fast a recording is written + replayed,
+and how well it compresses.
+
+  python benchmarks/recorder.py [n_messages]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import ujson
+
+from streamtools.recorder import Recorder, Replayer, segment_paths
+
+
+def main(n=100000):
+  path = tempfile.mkdtemp()
+  words = ['python', 'streamtools', 'wikipedia', 'edit']
+  try:
+    start = time.time()
+    size = 0
+    with Recorder(path, segment_size=8 * 1024 * 1024) as rec:
+      for i in range(n):
+        line = ujson.dumps({'seq': i, 'ts': time.time(), 'summary': ' '.join(words * (i % 8))})
+        size += len(line)
+        rec.write(line)
+    written = time.time() - start
+
+    stored = sum(os.path.getsize(p) for p in segment_paths(path))
+    start = time.time()
+    replayed = sum(1 for _ in Replayer(path, speed=None).lines())
+    read = time.time() - start
+
+    print 'messages={} segments={} ratio={:.2f}'.format(
+      n, len(segment_paths(path)), float(stored) / size)
+    print 'write  {:>10,.0f}/s'.format(n / written)
+    print 'replay {:>10,.0f}/s'.format(replayed / read)
+
+  finally:
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  main(n=int(args[0]) if args else 100000)
@@ -0,0 +1,65 @@
+"""
+Compare message latency of per-block http streams
+with websockets multiplexed on one event loop.
+
+  python benchmarks/streams.py [n_blocks] [n_messages]
+"""
+import sys
+import threading
+import time
+
+from streamtools import Api, AsyncApi
+from streamtools.fake import FakeServer
+
+
+def measure(server, name, stream, block_ids, n):
+  st = Api(server.url)
+
+  def send():
+
+    # wait for every stream to connect.
+    time.sleep(0.5)
+    for i in range(n):
+      for block_id in block_ids:
+        st.to_block_route(block_id, msg={'ts': time.time()})
+
+  threading.Thread(target=send).start()
+
+  lags = []
+  for block_id, msg in stream:
+    lags.append(time.time() - msg['ts'])
+    if len(lags) == 1:
+      threads = threading.active_count()
+    if len(lags) == n * len(block_ids):
+      break
+
+  lags.sort()
+  print '{:<12} p50 {:>7.2f}ms  p99 {:>7.2f}ms  {:>3} threads'.format(
+    name,
+    lags[len(lags) / 2] * 1000,
+    lags[int(len(lags) * 0.99)] * 1000,
+    threads)
+
+
+def main(n_blocks=20, n=50):
+  with FakeServer() as server:
+    st = Api(server.url)
+    block_ids = ['block-{}'.format(i) for i in range(n_blocks)]
+    for block_id in block_ids:
+      st.create_block(block_id, type='map')
+
+    print 'blocks={} messages={}'.format(n_blocks, n * n_blocks)
+    measure(server, 'http stream', AsyncApi(server.url).stream(*block_ids), block_ids, n)
+    server.close_streams()
+
+    mux = st.ws_many(*block_ids)
+    measure(server, 'websocket', mux, block_ids, n)
+    mux.close()
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  main(
+    n_blocks=int(args[0]) if args else 20,
+    n=int(args[1]) if len(args) > 1 else 50
+  )
@@ -25,7 +25,7 @@ ticker_block = Block('ticker-1',
 log_block = Block('log', type='tolog')
 
 # create plugin to tokenize text
-tokenize = Plugin('tokenize')
+tokenize = Plugin('tokenize', paths=['.summary'])
 
 def tokenize_main(body):
   text = body.get('summary', '')
@@ -30,7 +30,7 @@ setup(
     "kombu",
     "librabbitmq",
     "pytz",
-    "requests",
+    "requests>=2.10.0",
     "six",
     "ujson",
     "ws4py",
@@ -1,2 +1,2 @@
-from client import Api
+from client import Api, AsyncApi
 from models import Block, Plugin, Connection, Pattern 
\ No newline at end of file
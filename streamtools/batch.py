@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import copy
+import uuid
+
+from util import random_position, diff_pattern
+
+
+class Batch:
+
+  """
+  Records the Blocks + Connections created, updated and
+  deleted through an `Api` and applies them together on exit.
+  The current pattern is exported once, the changes are checked
+  against it locally, and only the difference is sent: new Blocks
+  + Connections in one import, with a request per delete or rule
+  update. `results` holds the outcome of each operation.
+  With `strict`, nothing is applied if any operation fails.
+  If applying the difference fails partway, the pattern is
+  exported again and each operation is reported by whether
+  it actually landed.
+
+    with st.batch() as b:
+      for i in range(300):
+        st.create_block('log-{}'.format(i), type='tolog')
+    print b.results
+  """
+
+  def __init__(self, api, strict=True):
+
+    self.api = api
+    self.strict = strict
+    self.ops = []
+    self.results = []
+    self.diff = None
+
+  def __enter__(self):
+    self.api._batches().append(self)
+    return self
+
+  def __exit__(self, type, value, tb):
+    self.api._batches().remove(self)
+
+    # don't apply half-recorded batches.
+    if type is None:
+      self.apply()
+    return False
+
+  def create_block(self, block_id=None, **kw):
+    assert('type' in kw)
+    block_id = block_id or str(uuid.uuid4())
+    self.ops.append(('create_block', block_id, {
+      'Id': block_id,
+      'Type': kw.get('type'),
+      'Rule': kw.get('rule') or {},
+      'Position': {
+        'X': kw.get('x_pos', random_position(15, 900)),
+        'Y': kw.get('y_pos', random_position(15, 500))
+      }
+    }))
+    return block_id
+
+  def update_block(self, block_id, rule):
+    self.ops.append(('update_block', block_id, rule))
+    return True
+
+  def delete_block(self, block_id):
+    self.ops.append(('delete_block', block_id, None))
+    return True
+
+  def create_connection(self, conn_id=None, **kw):
+    assert('from_id' in kw and 'to_id' in kw)
+    conn_id = conn_id or str(uuid.uuid4())
+    self.ops.append(('create_connection', conn_id, {
+      'Id': conn_id,
+      'FromId': kw['from_id'],
+      'ToId': kw['to_id'],
+      'ToRoute': kw.get('to_route', 'in')
+    }))
+    return conn_id
+
+  def delete_connection(self, conn_id):
+    self.ops.append(('delete_connection', conn_id, None))
+    return True
+
+  def _check(self, blocks, conns, op, id, raw):
+
+    # apply an op to the local state, returning any error.
+    if op == 'create_block':
+      if id in blocks:
+        return 'Block "{}" already exists'.format(id)
+      blocks[id] = raw
+
+    elif op == 'update_block':
+      if id not in blocks:
+        return 'Block "{}" does not exist'.format(id)
+      blocks[id]['Rule'] = raw
+
+    elif op == 'delete_block':
+      if id not in blocks:
+        return 'Block "{}" does not exist'.format(id)
+      del blocks[id]
+
+      # deleting a block deletes its connections.
+      for conn_id, c in conns.items():
+        if id in (c['FromId'], c['ToId']):
+          del conns[conn_id]
+
+    elif op == 'create_connection':
+      if id in conns:
+        return 'Connection "{}" already exists'.format(id)
+      for block_id in (raw['FromId'], raw['ToId']):
+        if block_id not in blocks:
+          return 'Block "{}" does not exist'.format(block_id)
+      conns[id] = raw
+
+    elif op == 'delete_connection':
+      if id not in conns:
+        return 'Connection "{}" does not exist'.format(id)
+      del conns[id]
+
+  def apply(self):
+
+    """
+    Apply the recorded operations, returning their results.
+    With `strict`, raises a ValueError if any of them failed.
+    """
+
+    current = self.api.get_pattern()
+    blocks = OrderedDict((b['Id'], copy.deepcopy(b)) for b in current.get('Blocks', []))
+    conns = OrderedDict((c['Id'], copy.deepcopy(c)) for c in current.get('Connections', []))
+
+    self.results = []
+    for op, id, raw in self.ops:
+      error = self._check(blocks, conns, op, id, raw)
+      self.results.append({'op': op, 'id': id, 'ok': not error, 'error': error})
+
+    failed = [r for r in self.results if not r['ok']]
+    if failed and self.strict:
+      raise ValueError('{} of {} batched operations failed: {}'\
+        .format(len(failed), len(self.results), failed[0]['error']))
+
+    desired = {'Blocks': blocks.values(), 'Connections': conns.values()}
+    self.diff = diff_pattern(current, desired, prune=True)
+    try:
+      self.api.apply_diff(self.diff)
+
+    except ValueError as e:
+      self._settle(blocks, conns, str(e))
+      raise
+
+    return self.results
+
+  def _settle(self, blocks, conns, error):
+
+    # after a failed apply, check each op against what landed.
+    try:
+      actual = self.api.get_pattern()
+    except ValueError:
+      landed = lambda op, id: False
+    else:
+      have_blocks = dict((b['Id'], b) for b in actual.get('Blocks', []))
+      have_conns = dict((c['Id'], c) for c in actual.get('Connections', []))
+      landed = lambda op, id: self._landed(op, id,
+        blocks, conns, have_blocks, have_conns)
+
+    for r in self.results:
+      if r['ok'] and not landed(r['op'], r['id']):
+        r['ok'] = False
+        r['error'] = error
+
+  def _landed(self, op, id, blocks, conns, have_blocks, have_conns):
+
+    # an op landed if what it touched is as the batch left it.
+    if op.endswith('_connection'):
+      want, have = conns.get(id), have_conns.get(id)
+      if not want or not have:
+        return want is have
+      return (want['FromId'], want['ToId']) == (have['FromId'], have['ToId'])
+
+    want, have = blocks.get(id), have_blocks.get(id)
+    if not want or not have:
+      return want is have
+    if want['Type'] != have['Type']:
+      return False
+    if op == 'update_block':
+      return (want.get('Rule') or {}) == (have.get('Rule') or {})
+    return True
@@ -1,18 +1,126 @@
 from requests import Session, Request
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+import threading
+import time
 import ujson
 import os
 
-from util import random_position
+from kombu.log import get_logger
+
+from util import random_position, path_template, TTLCache
+from metrics import RequestStats
+from stream import Stream, iter_lines, hangup
+from ws import WebSocketMux
+from batch import Batch
 import settings 
 
+logger = get_logger(__name__)
+
+# block libraries + topologies, shared by every client of a daemon.
+LIBRARY_CACHE = TTLCache(settings.LIBRARY_TTL)
+TOPOLOGY_CACHE = TTLCache(settings.TOPOLOGY_TTL)
+
+# shared clients, by url.
+APIS = {}
+APIS_LOCK = threading.Lock()
+
+
+class Topology:
+
+  """
+  An index of connections by the blocks they join.
+  """
+
+  def __init__(self, connections):
+
+    self.connections = connections
+    self.from_ids = {}
+    self.to_ids = {}
+
+    for c in connections:
+      self.from_ids.setdefault(c['FromId'], []).append(c)
+      self.to_ids.setdefault(c['ToId'], []).append(c)
+
+  def in_connections(self, block_id):
+    
+    """
+    Connections that send messages to a block.
+    """
+    
+    return self.to_ids.get(block_id, [])
+
+  def out_connections(self, block_id):
+    
+    """
+    Connections that a block sends messages on.
+    """
+    
+    return self.from_ids.get(block_id, [])
+
+  def block_connections(self, block_id):
+    
+    """
+    All connections to or from a block.
+    """
+    
+    out = self.out_connections(block_id)
+    return out + [c for c in self.in_connections(block_id) if c not in out]
+
+  def in_blocks(self, block_id):
+    
+    """
+    The block ids a block recieves messages from.
+    """
+    
+    return [c['FromId'] for c in self.in_connections(block_id)]
+
+  def out_blocks(self, block_id):
+    
+    """
+    The block ids a block sends messages to.
+    """
+    
+    return [c['ToId'] for c in self.out_connections(block_id)]
+
 class Api:
+
+  """
+  A client for the streamtools REST api.
+
+  Every request is passed to each of `hooks` as a dict of 
+  its method, path template, status, error, bytes sent + 
+  received and its total, encode + decode times in seconds.
+  By default `stats` collects them in memory:
+
+    st = Api()
+    st.list_blocks()
+    print st.stats.to_dict()['GET blocks']
+
+  Up to `pool_size` connections to the daemon are kept
+  open for reuse unless `keep_alive` is False.
+  """
   
-  def __init__(self, url=None, **kw):
+  def __init__(self, url=None, hooks=None, 
+               pool_size=settings.POOL_SIZE, 
+               keep_alive=settings.KEEP_ALIVE, **kw):
     
     self.url = self._parse_url(url)
     self.s = Session()
+    self.s.mount('http://', 
+      HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    if not keep_alive:
+      self.s.headers['Connection'] = 'close'
+
+    self.stats = RequestStats()
+    self.hooks = [self.stats.record] + list(hooks or [])
+
+    # batches open on each thread.
+    self._local = threading.local()
 
-  def _parse_url(self, url):
+  @staticmethod
+  def _parse_url(url):
     
     """
     Parse the url given on initialization.
@@ -34,15 +142,30 @@ class Api:
     return settings.STREAMTOOLS_URL
 
 
-  def _http(self, method, path, json=True, **kw):
+  def _http(self, method, path, json=True, check=False, **kw):
     
     """
     A wrapper for http requests to streamtools.
-    """
-    
+    With `check`, error responses raise a ValueError.
+    """
+    
+    start = time.time()
+    record = {
+      'method': method,
+      'path': path_template(path),
+      'status': None,
+      'error': None,
+      'bytes_sent': 0,
+      'bytes_received': 0,
+      'encode_time': 0.0,
+      'decode_time': 0.0
+    }
+
     # serialize all incoming json
     if 'data' in kw:
       kw['data'] = ujson.dumps(kw['data'])
+      record['encode_time'] = time.time() - start
+      record['bytes_sent'] = len(kw['data'])
 
     # construct the url endpoint
     url = 'http://{}/{}'.format(self.url, path)
@@ -54,14 +177,38 @@ class Api:
     req = Request(method, url, **kw)
 
     # execute
-    resp = self.s.send(req.prepare(), stream=stream)
-
-    # return
-    if json:
+    try:
+      resp = self.s.send(req.prepare(), stream=stream)
+      record['status'] = resp.status_code
+      if resp.status_code >= 400:
+        record['error'] = resp.status_code
+        if check:
+          raise ValueError('{} /{} failed with HTTP {}: {}'.format(
+            method, path, resp.status_code, resp.content[:200]))
+
+      # return
+      if json:
+        record['bytes_received'] = len(resp.content)
+        decode_start = time.time()
+        data = ujson.loads(resp.content)
+        record['decode_time'] = time.time() - decode_start
+        return data
       
-      return ujson.loads(resp.content)
-    
-    return resp
+      return resp
+
+    except Exception as e:
+      record['error'] = e
+      raise
+
+    finally:
+      record['time'] = time.time() - start
+
+      # a failing hook mustn't hide the request's own error.
+      for hook in self.hooks:
+        try:
+          hook(record)
+        except Exception as hook_error:
+          logger.warning('Request hook %r failed: %r', hook, hook_error)
 
 
   @property 
@@ -91,14 +238,110 @@ class Api:
     return self._http('GET', 'version')
 
 
-  def library(self):
+  def library(self, cache=True):
     
     """
     Get parameters for all available blocks.
+    The response is cached per url for `settings.LIBRARY_TTL`
+    seconds unless `cache` is False. Errors raise a 
+    ValueError, and aren't cached.
+    """
+    
+    if cache:
+      lib = LIBRARY_CACHE.get(self.url)
+      if lib is not None:
+        return lib
+
+    lib = self._http('GET', 'library', check=True)
+    LIBRARY_CACHE.set(self.url, lib)
+    return lib
+
+
+  def invalidate_library(self):
+    
+    """
+    Drop the cached library for this url.
+    """
+    
+    LIBRARY_CACHE.invalidate(self.url)
+
+
+  def topology(self, cache=True):
+    
+    """
+    Get an index of the current connections.
+    The index is cached per url for `settings.TOPOLOGY_TTL`
+    seconds, or until a client changes the connections.
     """
     
-    return self._http('GET', 'library')
+    if cache:
+      topology = TOPOLOGY_CACHE.get(self.url)
+      if topology is not None:
+        return topology
 
+    topology = Topology(self.list_connections())
+    TOPOLOGY_CACHE.set(self.url, topology)
+    return topology
+
+
+  def invalidate_topology(self):
+    
+    """
+    Drop the cached topology for this url.
+    """
+    
+    TOPOLOGY_CACHE.invalidate(self.url)
+
+
+  def _batches(self):
+    if not hasattr(self._local, 'batches'):
+      self._local.batches = []
+    return self._local.batches
+
+  @property 
+  def _batch(self):
+    batches = self._batches()
+    return batches[-1] if batches else None
+
+  def batch(self, strict=True):
+    
+    """
+    Record Block + Connection changes made on this thread
+    and apply them together when the block exits:
+    
+      with st.batch() as b:
+        st.create_block('ticker', type='ticker')
+        st.create_block('log', type='tolog')
+        st.create_connection(from_id='ticker', to_id='log')
+      print b.results
+    """
+    
+    return Batch(self, strict=strict)
+
+  def apply_diff(self, diff):
+    
+    """
+    Apply a diff from `util.diff_pattern`, in
+    the fewest requests we can. 
+    """
+    
+    for conn_id in diff['remove_connections']:
+      self.delete_connection(conn_id)
+
+    for block_id in diff['remove_blocks']:
+      self.delete_block(block_id)
+
+    for block_id, rule in diff['update_rules']:
+      self.update_block(block_id, rule)
+
+    # new blocks + connections in one import.
+    if diff['add_blocks'] or diff['add_connections']:
+      self.set_pattern({
+        'Blocks': diff['add_blocks'],
+        'Connections': diff['add_connections']
+      })
+
+    return diff
 
   def get_pattern(self):
     
@@ -116,48 +359,90 @@ class Api:
     """
     
     response = self._http('POST', 'import', data=pattern)
+    self.invalidate_topology()
     
     if response['daemon'] != 'OK':
       raise ValueError('Error loading pattern')
     
     return True
 
-  def delete_pattern(self):
+  def delete_pattern(self, concurrency=settings.TEARDOWN_CONCURRENCY):
     
     """
-    Delete the current pattern
+    Delete the current pattern, exporting it once and deleting
+    its Connections, then its Blocks, `concurrency` at a time.
     """
     
-    output = []
-    output.append(self.delete_connections())
-    output.append(self.delete_blocks())
-    return all(output)
+    pattern = self.get_pattern()
+    failures = self._delete_all(self.delete_connection, 
+      [c['Id'] for c in pattern.get('Connections', [])], concurrency)
+    failures.update(self._delete_all(self.delete_block, 
+      [b['Id'] for b in pattern.get('Blocks', [])], concurrency))
+    return self._teardown_report(failures)
+
+  def _delete_all(self, delete, ids, concurrency):
 
-  # TODO: Websocket support.
-  # def ws(self, block_id):
-  #   """
-  #   Stream output from a block's websocket.
-  #   """
-  #   # construct url
-  #   ws_url = 'ws://{}/ws/{}'.format(self.url, str(block_id))
+    # delete ids in parallel, returning any errors by id.
+    def attempt(id):
+      try:
+        delete(id)
+      except Exception as e:
+        return id, str(e)
 
-  #   # create client object and connect
-  #   ws = WebSocketClient(ws_url, protocols=['http-only', 'chat'])
-  #   ws.connect()
+    # batches are recorded on this thread.
+    if self._batch or concurrency <= 1 or len(ids) <= 1:
+      results = map(attempt, ids)
 
-  #   # yield output endlessly
-  #   while True:
-  #     m = ws.receive()
-  #     if m is not None:
-  #       yield ujson.dumps(m)
-  #     else:
-  #       break
+    else:
+      pool = ThreadPool(min(concurrency, len(ids)))
+      try:
+        results = pool.map(attempt, ids)
+      finally:
+        pool.close()
+        pool.join()
 
+    return dict(r for r in results if r)
 
-  def stream(self, block_id):
+  def _teardown_report(self, failures):
+    if failures:
+      e = ValueError('Failed to delete {}'.format('; '.join(
+        '{}: {}'.format(id, failures[id]) for id in sorted(failures))))
+      e.failures = failures
+      raise e
+    return True
+
+  def ws(self, block_id):
+    
+    """
+    Stream output from a block's websocket.
+    """
+
+    mux = WebSocketMux(self.url, [block_id], batch_size=1)
+    try:
+      for _, msg in mux:
+        yield msg
+    finally:
+      mux.close()
+
+
+  def ws_many(self, *block_ids, **kw):
+    
+    """
+    Stream output from many blocks' websockets on one
+    event loop, yielding (block_id, msg) tuples.
+    See `streamtools.ws.WebSocketMux` for options.
+    """
+
+    return WebSocketMux(self.url, block_ids, **kw)
+
+
+  def stream(self, block_id, chunk_size=None, raw=False):
     
     """
     Stream output from a block's httpstream.
+    Lines are yielded as they arrive unless a
+    read `chunk_size` is given, and undecoded 
+    with `raw`.
     """
 
     resp = self._http("GET", 
@@ -166,13 +451,22 @@ class Api:
       stream=True)          
     
     # return an endless generator of objects.
-    for line in resp.iter_lines():
+    for line in iter_lines(resp, chunk_size):
     
+      # skip keep-alives
       if line:
-        yield ujson.loads(line)
+        yield line if raw else ujson.loads(line)
+
+
+  def stream_batches(self, block_id, **kw):
     
-      else:
-        break
+    """
+    Stream lists of messages from a block's httpstream,
+    read on a background thread that reconnects on failure.
+    See `streamtools.stream.Stream` for options.
+    """
+
+    return Stream(self, block_id, **kw).start()
 
 
   def list_blocks(self):
@@ -204,6 +498,9 @@ class Api:
     Create a block given an id, type, rule (dict), xpos and ypos.
     """
     
+    if self._batch:
+      return self._batch.create_block(block_id, **kw)
+
     # parse kwargs
     kw.setdefault('rule', {})
     assert('type' in kw)
@@ -237,7 +534,11 @@ class Api:
     Delete a block.
     """
     
+    if self._batch:
+      return self._batch.delete_block(block_id)
+
     resp = self._http("DELETE", 'blocks/{}'.format(block_id))
+    self.invalidate_topology()
 
     if 'daemon' in resp and 'does not exist' in resp['daemon']:
       raise ValueError('Block "{}" Does not exist'.format(block_id))
@@ -248,16 +549,15 @@ class Api:
     return True
 
 
-  def delete_blocks(self):
+  def delete_blocks(self, concurrency=settings.TEARDOWN_CONCURRENCY):
     
     """
-    Delete all blocks
+    Delete all blocks, `concurrency` at a time.
     """
     
-    for block in self.list_blocks():
-      self.delete_block(block['Id'])
-
-    return True
+    ids = [b['Id'] for b in self.list_blocks()]
+    return self._teardown_report(
+      self._delete_all(self.delete_block, ids, concurrency))
 
 
   def update_block(self, block_id, rule):
@@ -266,6 +566,9 @@ class Api:
     A helper for updating a block's rule.
     """
     
+    if self._batch:
+      return self._batch.update_block(block_id, rule)
+
     return self.to_block_route(block_id, route='rule', msg=rule)
 
 
@@ -312,6 +615,9 @@ class Api:
     Create a connection.
     """
     
+    if self._batch:
+      return self._batch.create_connection(conn_id, **kw)
+
     # check kwargs
     assert('from_id' in kw and 'to_id' in kw)
 
@@ -326,6 +632,7 @@ class Api:
       options['Id'] = conn_id 
 
     resp = self._http("POST", 'connections', data=options)
+    self.invalidate_topology()
 
     if 'daemon' in resp and 'does not exist' in resp['daemon']:
       raise ValueError('Block "{}" Does not exist'.format(conn_id))
@@ -362,7 +669,11 @@ class Api:
     Delete a connection.
     """
     
+    if self._batch:
+      return self._batch.delete_connection(conn_id)
+
     resp = self._http("DELETE", 'connections/{}'.format(conn_id))
+    self.invalidate_topology()
     
     if 'daemon' in resp and 'does not exist' in resp['daemon']:
       raise ValueError('Connection "{}" Does not exist'.format(conn_id))
@@ -373,16 +684,15 @@ class Api:
     return True
 
 
-  def delete_connections(self):
+  def delete_connections(self, concurrency=settings.TEARDOWN_CONCURRENCY):
     
     """
-    Delete all connections.
+    Delete all connections, `concurrency` at a time.
     """
     
-    for conn in self.list_connections():
-      self.delete_connection(conn['Id'])
-    
-    return True
+    ids = [c['Id'] for c in self.list_connections()]
+    return self._teardown_report(
+      self._delete_all(self.delete_connection, ids, concurrency))
 
 
   def from_connection_route(self, conn_id, route='last'):
@@ -394,3 +704,173 @@ class Api:
     return self._http("GET", 'connections/{}/{}'.format(conn_id, route))
 
 
+def get_api(url=None, **kw):
+
+  """
+  The shared `Api` for a daemon, created with
+  `kw` the first time its url is requested.
+  """
+
+  url = Api._parse_url(url)
+  with APIS_LOCK:
+    if url not in APIS:
+      APIS[url] = Api(url, **kw)
+    return APIS[url]
+
+class AsyncApi:
+
+  """
+  A concurrent counterpart to `Api`. Every `Api` method
+  is available and runs on a bounded pool of worker threads,
+  returning an `AsyncResult`; call `.get()` for its value.
+
+    st = AsyncApi(concurrency=20)
+    results = [st.create_block(type='tolog') for _ in range(500)]
+    block_ids = st.gather(results)
+  """
+
+  def __init__(self, url=None, concurrency=10, **kw):
+
+    self.api = Api(url, **kw)
+    self.url = self.api.url
+    self.concurrency = concurrency
+
+    # one pooled connection per worker.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    self.api.s.mount('http://', adapter)
+
+    self._pool = ThreadPool(concurrency)
+    self._responses = []
+
+  def __getattr__(self, name):
+
+    """
+    Submit calls to `Api` methods to the pool.
+    """
+
+    if name == 'api':
+      raise AttributeError(name)
+
+    method = getattr(self.api, name)
+    if not callable(method):
+      return method
+
+    def submit(*args, **kw):
+      return self._pool.apply_async(method, args, kw)
+
+    submit.__name__ = name
+    submit.__doc__ = method.__doc__
+    return submit
+
+  def gather(self, results, timeout=None):
+
+    """
+    Wait for a list of `AsyncResult`s and return their values.
+    """
+
+    return [r.get(timeout) for r in results]
+
+  def create_blocks(self, blocks):
+
+    """
+    Create many blocks concurrently from a list of 
+    kwargs for `Api.create_block`. Returns their ids.
+    """
+
+    return self.gather([self.create_block(**kw) for kw in blocks])
+
+  def create_connections(self, connections):
+
+    """
+    Create many connections concurrently from a list of 
+    kwargs for `Api.create_connection`. Returns their ids.
+    """
+
+    return self.gather([self.create_connection(**kw) for kw in connections])
+
+  def stream(self, *block_ids, **kw):
+
+    """
+    Stream output from many blocks at once, yielding 
+    (block_id, msg) tuples as messages arrive. Each stream
+    runs on its own threads, outside of the request pool,
+    and up to `max_buffer` messages wait to be read. Ends 
+    once every stream has ended, and raises if one fails.
+    Call `close()` on the generator, or on this AsyncApi,
+    to hang up.
+    """
+
+    q = Queue(kw.get('max_buffer', 10000))
+    stopped = threading.Event()
+    responses = []
+
+    def put(item):
+
+      # block while the buffer is full, checking for stop.
+      while not stopped.is_set():
+        try:
+          return q.put(item, timeout=0.1)
+        except Full:
+          pass
+
+    def reader(block_id):
+      try:
+        resp = self.api._http('GET', 'stream/{}'.format(block_id), 
+                              json=False, stream=True)
+        responses.append(resp)
+        self._responses.append(resp)
+        if stopped.is_set():
+          return hangup(resp)
+        if resp.status_code >= 400:
+          raise ValueError('HTTP {}: {}'.format(resp.status_code, resp.content))
+
+        for line in iter_lines(resp):
+          if line:
+            put((block_id, ujson.loads(line)))
+        put((block_id, StopIteration()))
+
+      except Exception as e:
+        if not stopped.is_set():
+          put((block_id, ValueError('Stream {} failed: {!r}'.format(block_id, e))))
+
+    for block_id in block_ids:
+      t = threading.Thread(target=reader, args=(block_id,), 
+                           name='stream-{}'.format(block_id))
+      t.daemon = True
+      t.start()
+
+    try:
+      streaming = len(block_ids)
+      while streaming:
+        # poll so the consumer stays interruptible.
+        try:
+          block_id, msg = q.get(timeout=1)
+        except Empty:
+          continue
+
+        # readers end with StopIteration, or the error they hit.
+        if isinstance(msg, StopIteration):
+          streaming -= 1
+        elif isinstance(msg, Exception):
+          raise msg
+        else:
+          yield block_id, msg
+
+    finally:
+      stopped.set()
+      for resp in list(responses):
+        hangup(resp)
+        if resp in self._responses:
+          self._responses.remove(resp)
+
+  def close(self):
+
+    """
+    Stop accepting work, hang up open streams
+    and wait for pending requests.
+    """
+
+    for resp in list(self._responses):
+      hangup(resp)
+    self._pool.close()
+    self._pool.join()
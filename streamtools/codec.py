@@ -0,0 +1,197 @@
+from json import JSONDecoder
+import re
+import ujson
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+
+class Codec:
+  """
+  Encodes + decodes message bodies for the AMQP path.
+  `loads_many` decodes a list of bodies, in one pass
+  where the format allows.
+  """
+
+  def __init__(self, name, content_type, dumps, loads,
+               loads_many=None, content_encoding='binary'):
+    self.name = name
+    self.content_type = content_type
+    self.content_encoding = content_encoding
+    self.dumps = dumps
+    self.loads = loads
+    self._loads_many = loads_many
+
+  def loads_many(self, bodies):
+    if self._loads_many:
+      return self._loads_many(bodies)
+    return [self.loads(b) for b in bodies]
+
+
+def json_loads_many(bodies):
+
+  # one ujson call for the whole batch.
+  return ujson.loads('[' + ','.join(bodies) + ']')
+
+def raw_dumps(body):
+  if isinstance(body, str):
+    return body
+  if isinstance(body, unicode):
+    return body.encode('utf-8')
+  return ujson.dumps(body)
+
+def raw_loads(body):
+  return body
+
+
+DECODER = JSONDecoder()
+
+
+class Projected(dict):
+  """
+  The fields of a message decoded by a `Projection`.
+  `raw` holds the message's original bytes and `offsets`
+  where each field's value starts in them.
+  """
+
+  def __init__(self, fields, raw, offsets):
+    dict.__init__(self, fields)
+    self.raw = raw
+    self.offsets = offsets
+
+
+class Projection(Codec):
+  """
+  A json codec that decodes only the top-level fields 
+  named by `paths`, eg: [".summary", ".user.name"]. 
+  Fields are found in one pass over the body, so 
+  messages without them are rejected before any parsing;
+  see `matches`. Projected messages that are published 
+  unchanged are forwarded as their original bytes; 
+  changed ones are merged back into the full message.
+  """
+
+  def __init__(self, paths):
+    self.paths = list(paths)
+    self.keys = []
+    for path in self.paths:
+      key = re.match(r'\.?([^.\[\]]+)', path)
+      if not key:
+        raise ValueError('Cannot project path "{}"'.format(path))
+      if key.group(1) not in self.keys:
+        self.keys.append(key.group(1))
+
+    self.name = 'json'
+    self.content_type = 'application/json'
+    self.content_encoding = 'utf-8'
+    self._key_re = re.compile(r'"({})"\s*:\s*'.format(
+      '|'.join(re.escape(k) for k in self.keys)))
+
+  def _offsets(self, body):
+    offsets = {}
+    depth, quoted, scanned = 0, False, 0
+    for m in self._key_re.finditer(body):
+      start = m.start()
+      if body[start - 1:start] == '\\':
+        continue
+
+      # track string + bracket depth from the last candidate:
+      # with escapes dropped, every other piece between quotes
+      # is outside a string. keys are outside, one bracket deep.
+      chunk = body[scanned:start]
+      if '\\' in chunk:
+        chunk = chunk.replace('\\\\', '').replace('\\"', '')
+      scanned = start
+      pieces = chunk.split('"')
+      outside = ''.join(pieces[quoted::2])
+      if not len(pieces) % 2:
+        quoted = not quoted
+      depth += outside.count('{') + outside.count('[') - \
+               outside.count('}') - outside.count(']')
+
+      key = m.group(1)
+      if depth == 1 and not quoted and key not in offsets:
+        offsets[key] = m.end()
+        if len(offsets) == len(self.keys):
+          break
+    return offsets
+
+  def _decode(self, body, offsets):
+    return dict((key, DECODER.raw_decode(body, i)[0]) 
+                for key, i in offsets.items())
+
+  def matches(self, body):
+
+    """
+    Where each projected field's value starts in a body,
+    by key; empty if it has none of them. Pass the result
+    to `loads` to decode the body without scanning it again.
+    """
+
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    return self._offsets(body)
+
+  def loads(self, body, offsets=None):
+    if isinstance(body, Projected):
+      return body
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+
+    if offsets is None:
+      offsets = self._offsets(body)
+    return Projected(self._decode(body, offsets), body, offsets)
+
+  def loads_many(self, bodies):
+    return [self.loads(b) for b in bodies]
+
+  def dumps(self, body):
+    if not isinstance(body, Projected):
+      return ujson.dumps(body)
+
+    # decode the fields again to see if any changed.
+    original = self._decode(body.raw, body.offsets)
+    if body == original:
+      return body.raw
+
+    full = ujson.loads(body.raw)
+    for key in original:
+      if key not in body:
+        full.pop(key, None)
+    full.update(body)
+    return ujson.dumps(full)
+
+
+CODECS = {
+  'json': Codec('json', 'application/json', ujson.dumps, ujson.loads,
+                json_loads_many, content_encoding='utf-8'),
+  'raw': Codec('raw', 'application/data', raw_dumps, raw_loads)
+}
+
+if msgpack is not None:
+  CODECS['msgpack'] = Codec('msgpack', 'application/x-msgpack',
+                            msgpack.packb, msgpack.unpackb)
+
+
+def register(codec):
+  """
+  Make a Codec available by name.
+  """
+  CODECS[codec.name] = codec
+  return codec
+
+def get_codec(codec):
+  """
+  Look up a Codec by name. Codec instances pass through.
+  """
+  if isinstance(codec, Codec):
+    return codec
+
+  if codec == 'msgpack' and msgpack is None:
+    raise ValueError('The msgpack codec requires `pip install msgpack-python`')
+
+  if codec not in CODECS:
+    raise ValueError('Unknown codec "{}", try: {}'.format(codec, ', '.join(sorted(CODECS))))
+  return CODECS[codec]
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+
+from kombu.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def compile_pattern(pattern, library=None, allow_cycles=True):
+  """
+  Check a raw pattern locally before sending it to streamtools.
+  With a `library`, block types + routes are checked against it.
+  Raises a ValueError listing every problem, with the list on its
+  `errors`. Otherwise returns the blocks in topological order and
+  the pattern's sources, sinks + orphans (blocks without connections).
+  Blocks in feedback loops are logged and returned as `cycles`;
+  they're only an error without `allow_cycles`.
+  """
+  errors = []
+  blocks = OrderedDict()
+  for b in pattern.get('Blocks', []):
+    block_id = b.get('Id')
+    if not block_id:
+      errors.append('Block {} has no Id'.format(b))
+      continue
+
+    # a block may be listed more than once, but not as different types.
+    have = blocks.get(block_id)
+    if have and have.get('Type') != b.get('Type'):
+      errors.append('Block "{}" has types "{}" and "{}"'\
+        .format(block_id, have.get('Type'), b.get('Type')))
+      continue
+    blocks[block_id] = b
+
+    if library is not None and b.get('Type') not in library:
+      errors.append('Block "{}" has unknown type "{}"'.format(block_id, b.get('Type')))
+
+  outs = OrderedDict((block_id, []) for block_id in blocks)
+  ins = dict((block_id, 0) for block_id in blocks)
+  conn_ids = set()
+
+  for c in pattern.get('Connections', []):
+    from_id, to_id = c.get('FromId'), c.get('ToId')
+    route = c.get('ToRoute', 'in')
+    name = c.get('Id') or '{} => {}.{}'.format(from_id, to_id, route)
+
+    if c.get('Id'):
+      if c['Id'] in conn_ids:
+        errors.append('Connection "{}" is listed twice'.format(name))
+      conn_ids.add(c['Id'])
+
+    dangling = [i for i in (from_id, to_id) if i not in blocks]
+    for block_id in dangling:
+      errors.append('Connection "{}" refers to missing Block "{}"'.format(name, block_id))
+    if dangling:
+      continue
+
+    if library is not None:
+      from_lib = library.get(blocks[from_id].get('Type'))
+      to_lib = library.get(blocks[to_id].get('Type'))
+
+      if from_lib and not from_lib.get('OutRoutes'):
+        errors.append('Connection "{}" leaves "{}", a {} block with no OutRoutes'\
+          .format(name, from_id, blocks[from_id].get('Type')))
+
+      if to_lib and route not in to_lib.get('InRoutes', []):
+        errors.append('Connection "{}" goes to "{}", a {} block with no "{}" route (try: {})'\
+          .format(name, to_id, blocks[to_id].get('Type'), route,
+                  ', '.join(to_lib.get('InRoutes', []))))
+
+    outs[from_id].append(to_id)
+    ins[to_id] += 1
+
+  # kahn's algorithm: whatever isn't ordered is in a cycle.
+  indegree = dict(ins)
+  order = [block_id for block_id in blocks if not indegree[block_id]]
+  for block_id in order:
+    for to_id in outs[block_id]:
+      indegree[to_id] -= 1
+      if not indegree[to_id]:
+        order.append(to_id)
+
+  cyclic = [block_id for block_id in blocks if indegree[block_id]]
+  if cyclic:
+    cycle = 'Blocks {} form a cycle'.format(', '.join('"{}"'.format(b) for b in cyclic))
+    if allow_cycles:
+      logger.warning(cycle)
+    else:
+      errors.append(cycle)
+
+  if errors:
+    e = ValueError('Invalid pattern: ' + '; '.join(errors))
+    e.errors = errors
+    raise e
+
+  return {
+    'order': order + cyclic,
+    'cycles': cyclic,
+    'sources': [b for b in blocks if not ins[b] and outs[b]],
+    'sinks': [b for b in blocks if ins[b] and not outs[b]],
+    'orphans': [b for b in blocks if not ins[b] and not outs[b]]
+  }
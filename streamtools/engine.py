@@ -0,0 +1,575 @@
+from Queue import Queue, Empty, Full
+from collections import deque
+import copy
+import re
+import threading
+import time
+
+from kombu.log import get_logger
+
+from codec import CODECS, Projection
+from compiler import compile_pattern
+
+logger = get_logger(__name__)
+
+
+# go-style durations, eg: "1h0m0s", "500ms"
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ns|us|ms|h|m|s)')
+DURATION_UNITS = {
+  'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600
+}
+
+def parse_duration(duration, default=1.0):
+  """
+  Parse a go-style duration like "1m30s" into seconds.
+  """
+  if isinstance(duration, (int, float)):
+    return float(duration)
+
+  parts = DURATION_RE.findall(duration or '')
+  if not parts:
+    return default
+  return sum(float(n) * DURATION_UNITS[unit] for n, unit in parts)
+
+
+# a subset of gojee, the expression language of streamtools' rules.
+TOKEN_RE = re.compile(r'''
+  \s*(?:
+    (?P<number>-?\d+(?:\.\d+)?) |
+    (?P<string>"(?:[^"\\]|\\.)*") |
+    (?P<path>\.[\w.\[\]]*) |
+    (?P<word>true|false|null) |
+    (?P<op>&&|\|\||==|!=|>=|<=|>|<|\+|-|\*|/|!|\(|\))
+  )''', re.VERBOSE)
+
+def lookup(msg, path):
+  """
+  Get the value at a path like ".a.b[0]" from a message,
+  or None if it's missing.
+  """
+  for key in re.findall(r'[^.\[\]]+|\[\d+\]', path):
+    try:
+      if key.startswith('['):
+        msg = msg[int(key[1:-1])]
+      else:
+        msg = msg[key]
+    except (KeyError, IndexError, TypeError, ValueError):
+      return None
+  return msg
+
+def compile_expr(expr):
+  """
+  Compile a gojee expression, eg: '.count > 5 && .user == "bob"',
+  into a function of a message. Supports paths, number, string
+  + boolean literals, arithmetic, comparisons, `!`, `&&` and `||`.
+  """
+  tokens = []
+  pos = 0
+  expr = expr.strip()
+  while pos < len(expr):
+    m = TOKEN_RE.match(expr, pos)
+    if not m or m.end() == pos:
+      raise ValueError('Cannot parse "{}" at "{}"'.format(expr, expr[pos:]))
+    pos = m.end()
+    kind = m.lastgroup
+    tokens.append((kind, m.group(kind)))
+  tokens.append((None, None))
+
+  ops = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b,
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b
+  }
+  state = {'i': 0}
+
+  def peek():
+    return tokens[state['i']]
+
+  def take():
+    token = tokens[state['i']]
+    state['i'] += 1
+    return token
+
+  def binary(next_level, symbols):
+    def parse():
+      left = next_level()
+      while peek()[0] == 'op' and peek()[1] in symbols:
+        fn = ops[take()[1]]
+        right = next_level()
+        left = (lambda fn, l, r: lambda msg: fn(l(msg), r(msg)))(fn, left, right)
+      return left
+    return parse
+
+  def atom():
+    kind, value = take()
+    if kind == 'number':
+      n = float(value) if '.' in value else int(value)
+      return lambda msg: n
+    if kind == 'string':
+      s = value[1:-1].decode('string_escape')
+      return lambda msg: s
+    if kind == 'word':
+      v = {'true': True, 'false': False, 'null': None}[value]
+      return lambda msg: v
+    if kind == 'path':
+      return lambda msg: lookup(msg, value)
+    if value == '!':
+      inner = atom()
+      return lambda msg: not inner(msg)
+    if value == '(':
+      inner = either()
+      if take()[1] != ')':
+        raise ValueError('Unbalanced parentheses in "{}"'.format(expr))
+      return inner
+    raise ValueError('Unexpected "{}" in "{}"'.format(value, expr))
+
+  product = binary(atom, ('*', '/'))
+  total = binary(product, ('+', '-'))
+  compare = binary(total, ('==', '!=', '>=', '<=', '>', '<'))
+
+  def both():
+    left = compare()
+    while peek()[1] == '&&':
+      take()
+      right = compare()
+      left = (lambda l, r: lambda msg: bool(l(msg)) and bool(r(msg)))(left, right)
+    return left
+
+  def either():
+    left = both()
+    while peek()[1] == '||':
+      take()
+      right = both()
+      left = (lambda l, r: lambda msg: bool(l(msg)) or bool(r(msg)))(left, right)
+    return left
+
+  fn = either()
+  if peek()[0] is not None:
+    raise ValueError('Unexpected "{}" in "{}"'.format(peek()[1], expr))
+
+  # errors like comparing None to a number count as false.
+  def evaluate(msg):
+    try:
+      return fn(msg)
+    except TypeError:
+      return None
+  return evaluate
+
+
+class LocalBlock:
+
+  """
+  A Python implementation of a streamtools block.
+  Messages arrive on `receive`, and `emit` sends
+  them along the block's connections.
+  """
+
+  in_routes = ['rule']
+  out_routes = ['out']
+
+  def __init__(self, engine, raw):
+    self.engine = engine
+    self.id = raw['Id']
+    self.type = raw['Type']
+    self.set_rule(raw.get('Rule') or {})
+
+  def set_rule(self, rule):
+    self.rule = rule
+
+  def receive(self, route, msg):
+    if route == 'rule':
+      self.set_rule(msg)
+    else:
+      self.process(route, msg)
+
+  def process(self, route, msg):
+    pass
+
+  def emit(self, msg):
+    self.engine.emit(self.id, msg)
+
+  def query(self, route):
+    if route == 'rule':
+      return self.rule
+    raise ValueError('Block "{}" has no "{}" route'.format(self.id, route))
+
+  def timeout(self):
+
+    # seconds until `tick` should next be called.
+    return None
+
+  def tick(self):
+    pass
+
+
+class Ticker(LocalBlock):
+
+  def set_rule(self, rule):
+    self.rule = rule
+    self.interval = parse_duration(rule.get('Interval'), 1.0)
+    self.next_at = time.time() + self.interval
+
+  def timeout(self):
+    return max(self.next_at - time.time(), 0)
+
+  def tick(self):
+    self.next_at += self.interval
+    self.emit({'tick': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())})
+
+
+class ToLog(LocalBlock):
+
+  in_routes = ['in']
+  out_routes = []
+
+  def __init__(self, engine, raw):
+    LocalBlock.__init__(self, engine, raw)
+    self.messages = deque(maxlen=1000)
+
+  def process(self, route, msg):
+    self.messages.append(msg)
+    logger.info('%s: %r', self.id, msg)
+
+
+class Filter(LocalBlock):
+
+  in_routes = ['in', 'rule']
+
+  def set_rule(self, rule):
+    self.rule = rule
+    self.test = compile_expr(rule.get('Filter') or 'true')
+
+  def process(self, route, msg):
+    if self.test(msg):
+      self.emit(msg)
+
+
+class Map(LocalBlock):
+
+  in_routes = ['in', 'rule']
+
+  def set_rule(self, rule):
+    self.rule = rule
+    self.additive = rule.get('Additive', True)
+    self.fields = [(k, compile_expr(v)) for k, v in (rule.get('Map') or {}).items()]
+
+  def process(self, route, msg):
+    out = copy.copy(msg) if self.additive and isinstance(msg, dict) else {}
+    for key, fn in self.fields:
+      out[key] = fn(msg)
+    self.emit(out)
+
+
+class Windowed(LocalBlock):
+
+  in_routes = ['in', 'rule', 'poll', 'clear']
+
+  # keeps (timestamp, value) pairs for the last `Window`.
+  def set_rule(self, rule):
+    self.rule = rule
+    self.window = parse_duration(rule.get('Window'), 60.0)
+    self.seen = getattr(self, 'seen', deque())
+
+  def expire(self):
+    cutoff = time.time() - self.window
+    while self.seen and self.seen[0][0] < cutoff:
+      self.seen.popleft()
+
+  def process(self, route, msg):
+    if route == 'clear':
+      self.seen.clear()
+    elif route == 'poll':
+      self.emit(self.state())
+    else:
+      self.seen.append((time.time(), self.value(msg)))
+
+  def value(self, msg):
+    return None
+
+  def state(self):
+    return {}
+
+  def query(self, route):
+    if route == self.type:
+      return self.state()
+    return LocalBlock.query(self, route)
+
+
+class Histogram(Windowed):
+
+  def set_rule(self, rule):
+    Windowed.set_rule(self, rule)
+    self.path = rule.get('Path', '.')
+
+  def value(self, msg):
+    return lookup(msg, self.path)
+
+  def state(self):
+    self.expire()
+    counts = {}
+    for ts, label in self.seen:
+      counts[label] = counts.get(label, 0) + 1
+    return {
+      'Histogram': [{'Label': k, 'Count': v} for k, v in counts.items()],
+      'Window': self.window
+    }
+
+
+class Count(Windowed):
+
+  def state(self):
+    self.expire()
+    return {'Count': len(self.seen)}
+
+
+class PluginBlock(LocalBlock):
+
+  """
+  A `toamqp` block. When a Plugin reads from it,
+  messages run through the Plugin's `main` and
+  its outputs leave from the Plugin's `fromamqp` block.
+  Plugins with `paths` see the same projected bodies,
+  and skip the same messages, as they would over AMQP.
+  """
+
+  in_routes = ['in', 'rule']
+  out_routes = []
+
+  def process(self, route, msg):
+    plugin = self.engine.plugins.get(self.id)
+    if not plugin:
+      return
+
+    try:
+      if isinstance(plugin.codec, Projection):
+        body = CODECS['json'].dumps(msg)
+        offsets = plugin.codec.matches(body)
+        if plugin.skip_unmatched and not offsets:
+          return
+        msg = plugin.codec.loads(body, offsets)
+
+      if plugin.batch_size > 1:
+        outputs = plugin.main_batch([msg])
+      else:
+        outputs = plugin.main(msg)
+      for output in outputs:
+        self.engine.emit(plugin.out_block.id, output)
+
+    except Exception as e:
+      self.engine.stats[self.id]['errors'] += 1
+      logger.error('Plugin %s failed: %r', plugin.id, e)
+
+
+# block types we can run, keyed like `/library`
+BLOCKS = {
+  'ticker': Ticker,
+  'tolog': ToLog,
+  'filter': Filter,
+  'map': Map,
+  'histogram': Histogram,
+  'count': Count,
+  'toamqp': PluginBlock,
+  'fromamqp': LocalBlock
+}
+
+LIBRARY = dict(
+  (type_, {'Type': type_, 'InRoutes': cls.in_routes, 'OutRoutes': cls.out_routes})
+  for type_, cls in BLOCKS.items()
+)
+
+
+class Engine:
+
+  """
+  Run a Pattern in this process, without a streamtools daemon.
+  Each block runs on its own thread, reading from a bounded queue
+  fed by its connections. Plugins run their `main` directly on
+  messages sent to their `toamqp` block, without AMQP.
+
+    engine = Engine(pattern, plugins=[tokenize]).start()
+    engine.send('ticker', {'text': 'hello world'})
+    engine.drain()
+    print engine.stats
+  """
+
+  def __init__(self, pattern, plugins=(), max_buffer=10000):
+
+    raw = pattern.raw if hasattr(pattern, 'raw') else pattern
+    raw = {
+      'Blocks': list(raw.get('Blocks', [])),
+      'Connections': list(raw.get('Connections', []))
+    }
+
+    # plugins' blocks needn't be in the pattern.
+    for plugin in plugins:
+      for b in plugin.raw:
+        if b['Id'] not in [have['Id'] for have in raw['Blocks']]:
+          raw['Blocks'].append(b)
+
+    compile_pattern(raw, LIBRARY)
+
+    self.max_buffer = max_buffer
+    self.plugins = dict((p.in_block.id, p) for p in plugins)
+    self.blocks = {}
+    self.inboxes = {}
+    self.routes = {}
+    self.subscribers = {}
+    self.stats = {}
+
+    for b in raw['Blocks']:
+      self.blocks[b['Id']] = BLOCKS[b['Type']](self, b)
+      self.inboxes[b['Id']] = Queue(max_buffer)
+      self.routes[b['Id']] = []
+      self.stats[b['Id']] = {'in': 0, 'out': 0, 'errors': 0}
+
+    for c in raw['Connections']:
+      self.routes[c['FromId']].append((c['ToId'], c.get('ToRoute', 'in')))
+
+    self._lock = threading.Lock()
+    self._threads = []
+    self._stopped = threading.Event()
+
+  def start(self):
+
+    """
+    Start a thread for every block.
+    """
+
+    if self._threads:
+      return self
+
+    self._stopped.clear()
+    for block_id in self.blocks:
+      t = threading.Thread(target=self._run, args=(block_id,))
+      t.daemon = True
+      t.start()
+      self._threads.append(t)
+    return self
+
+  def stop(self):
+
+    """
+    Stop every block.
+    """
+
+    self._stopped.set()
+    for t in self._threads:
+      t.join()
+    self._threads = []
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def _run(self, block_id):
+    block = self.blocks[block_id]
+    inbox = self.inboxes[block_id]
+    stats = self.stats[block_id]
+
+    while not self._stopped.is_set():
+      wait = block.timeout()
+      if wait == 0:
+        block.tick()
+        continue
+
+      try:
+        route, msg = inbox.get(timeout=min(wait, 0.1) if wait else 0.1)
+      except Empty:
+        continue
+
+      try:
+        stats['in'] += 1
+        block.receive(route, msg)
+      except Exception as e:
+        stats['errors'] += 1
+        logger.error('Block %s failed: %r', block_id, e)
+      finally:
+        inbox.task_done()
+
+  def emit(self, block_id, msg):
+
+    """
+    Send a message out of a block, along its connections.
+    """
+
+    self.stats[block_id]['out'] += 1
+    for q in self.subscribers.get(block_id, []):
+      try:
+        q.put_nowait(msg)
+      except Full:
+        pass
+
+    for to_id, route in self.routes[block_id]:
+      self._put(to_id, route, msg)
+
+  def _put(self, block_id, route, msg):
+
+    # block while the inbox is full, checking for stop.
+    inbox = self.inboxes[block_id]
+    while not self._stopped.is_set():
+      try:
+        return inbox.put((route, msg), timeout=0.1)
+      except Full:
+        pass
+
+  def send(self, block_id, msg, route='in'):
+
+    """
+    Send a message to a block's route.
+    """
+
+    if block_id not in self.blocks:
+      raise ValueError('Block "{}" does not exist'.format(block_id))
+    self._put(block_id, route, msg)
+
+  def query(self, block_id, route='rule'):
+
+    """
+    Get the state of a block's query route.
+    """
+
+    if block_id not in self.blocks:
+      raise ValueError('Block "{}" does not exist'.format(block_id))
+    return self.blocks[block_id].query(route)
+
+  def subscribe(self, block_id, max_buffer=None):
+
+    """
+    A queue of the messages a block emits. Messages
+    that don't fit in `max_buffer` are dropped.
+    """
+
+    q = Queue(max_buffer or self.max_buffer)
+    with self._lock:
+      self.subscribers.setdefault(block_id, []).append(q)
+    return q
+
+  def drain(self, timeout=10):
+
+    """
+    Wait until every message sent has been processed.
+    Returns False if that took longer than `timeout`.
+    """
+
+    deadline = time.time() + timeout
+    idle = 0
+    while time.time() < deadline:
+      if all(not q.unfinished_tasks for q in self.inboxes.values()):
+        idle += 1
+
+        # check twice, in case a block was mid-emit.
+        if idle > 1:
+          return True
+      else:
+        idle = 0
+      time.sleep(0.001)
+    return False
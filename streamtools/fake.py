@@ -0,0 +1,574 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from Queue import Queue, Empty
+from base64 import b64encode
+from hashlib import sha1
+import threading
+import socket
+import struct
+import time
+import ujson
+import uuid
+
+from util import path_template
+
+# block types the fake daemon knows about, keyed like streamtools' `/library`
+LIBRARY = {
+  'ticker': {
+    'InRoutes': ['rule'],
+    'QueryRoutes': ['rule'],
+    'OutRoutes': ['out']
+  },
+  'tolog': {
+    'InRoutes': ['in'],
+    'QueryRoutes': [],
+    'OutRoutes': []
+  },
+  'filter': {
+    'InRoutes': ['in', 'rule'],
+    'QueryRoutes': ['rule'],
+    'OutRoutes': ['out']
+  },
+  'map': {
+    'InRoutes': ['in', 'rule'],
+    'QueryRoutes': ['rule'],
+    'OutRoutes': ['out']
+  },
+  'histogram': {
+    'InRoutes': ['in', 'rule', 'poll', 'clear'],
+    'QueryRoutes': ['rule', 'histogram'],
+    'OutRoutes': ['out']
+  },
+  'count': {
+    'InRoutes': ['in', 'rule', 'poll', 'clear'],
+    'QueryRoutes': ['rule', 'count'],
+    'OutRoutes': ['out']
+  },
+  'toamqp': {
+    'InRoutes': ['in', 'rule'],
+    'QueryRoutes': ['rule'],
+    'OutRoutes': []
+  },
+  'fromamqp': {
+    'InRoutes': ['rule'],
+    'QueryRoutes': ['rule'],
+    'OutRoutes': ['out']
+  },
+  'fromwebsocket': {
+    'InRoutes': ['rule'],
+    'QueryRoutes': ['rule'],
+    'OutRoutes': ['out']
+  }
+}
+for type_, routes in LIBRARY.items():
+  routes['Type'] = type_
+  routes['Definition'] = 'fake {} block'.format(type_)
+
+
+class FakeDaemon:
+
+  """
+  The in-memory state of a fake streamtools daemon.
+  Messages sent to a block's in route are passed
+  through unchanged and forwarded along its connections.
+  """
+
+  def __init__(self):
+
+    self.blocks = {}
+    self.connections = {}
+    self.last = {}
+    self.subscribers = {}
+    self.lock = threading.RLock()
+
+  def _id(self):
+    return str(uuid.uuid4())[:8]
+
+  def _error(self, msg):
+    return 400, {'daemon': msg}
+
+  def export(self):
+    with self.lock:
+      return {
+        'Blocks': self.blocks.values(),
+        'Connections': self.connections.values()
+      }
+
+  def create_block(self, raw):
+    with self.lock:
+      block_id = raw.get('Id') or self._id()
+      if block_id in self.blocks:
+        return self._error('block {} already exists'.format(block_id))
+
+      if raw.get('Type') not in LIBRARY:
+        return self._error('block type {} does not exist'.format(raw.get('Type')))
+
+      self.blocks[block_id] = {
+        'Id': block_id,
+        'Type': raw['Type'],
+        'Rule': raw.get('Rule') or {},
+        'Position': raw.get('Position') or {'X': 0, 'Y': 0}
+      }
+      return 200, self.blocks[block_id]
+
+  def delete_block(self, block_id):
+    with self.lock:
+      if block_id not in self.blocks:
+        return self._error('block {} does not exist'.format(block_id))
+
+      for conn in self.connections.values():
+        if block_id in (conn['FromId'], conn['ToId']):
+          self.connections.pop(conn['Id'])
+
+      return 200, self.blocks.pop(block_id)
+
+  def create_connection(self, raw):
+    with self.lock:
+      conn_id = raw.get('Id') or self._id()
+      if conn_id in self.connections:
+        return self._error('connection {} already exists'.format(conn_id))
+
+      for key in ['FromId', 'ToId']:
+        if raw.get(key) not in self.blocks:
+          return self._error('block {} does not exist'.format(raw.get(key)))
+
+      self.connections[conn_id] = {
+        'Id': conn_id,
+        'FromId': raw['FromId'],
+        'ToId': raw['ToId'],
+        'ToRoute': raw.get('ToRoute', 'in')
+      }
+      return 200, self.connections[conn_id]
+
+  def delete_connection(self, conn_id):
+    with self.lock:
+      if conn_id not in self.connections:
+        return self._error('connection {} does not exist'.format(conn_id))
+
+      return 200, self.connections.pop(conn_id)
+
+  def load(self, pattern):
+    with self.lock:
+      for raw in pattern.get('Blocks', []):
+        self.blocks.pop(raw.get('Id'), None)
+        status, resp = self.create_block(raw)
+        if status != 200:
+          return status, resp
+
+      for raw in pattern.get('Connections', []):
+        self.connections.pop(raw.get('Id'), None)
+        status, resp = self.create_connection(raw)
+        if status != 200:
+          return status, resp
+
+      return 200, {'daemon': 'OK'}
+
+  def to_route(self, block_id, route, msg):
+    with self.lock:
+      if block_id not in self.blocks:
+        return self._error('block {} does not exist'.format(block_id))
+
+      if route == 'rule':
+        self.blocks[block_id]['Rule'] = msg
+
+      else:
+        self.emit(block_id, msg)
+
+      return 200, {}
+
+  def from_route(self, block_id, route):
+    with self.lock:
+      if block_id not in self.blocks:
+        return self._error('block {} does not exist'.format(block_id))
+
+      if route == 'rule':
+        return 200, self.blocks[block_id]['Rule']
+
+      return 200, {}
+
+  def from_connection_route(self, conn_id, route):
+    with self.lock:
+      if conn_id not in self.connections:
+        return self._error('connection {} does not exist'.format(conn_id))
+
+      if route == 'last':
+        return 200, {'Last': self.last.get(conn_id)}
+
+      return 200, {}
+
+  def emit(self, block_id, msg, hops=0):
+
+    """
+    Publish a message on a block's output and
+    forward it along the block's connections.
+    """
+
+    # guard against cycles
+    if hops > len(self.blocks):
+      return
+
+    for q in self.subscribers.get(block_id, []):
+      q.put(msg)
+
+    for conn in self.connections.values():
+      if conn['FromId'] == block_id:
+        self.last[conn['Id']] = msg
+        for q in self.subscribers.get(conn['Id'], []):
+          q.put(msg)
+        if conn['ToRoute'] == 'rule':
+          self.blocks[conn['ToId']]['Rule'] = msg
+        elif self.blocks[conn['ToId']]['Type'] != 'tolog':
+          self.emit(conn['ToId'], msg, hops + 1)
+
+  def subscribe(self, id):
+    q = Queue()
+    with self.lock:
+      self.subscribers.setdefault(id, []).append(q)
+    return q
+
+  def unsubscribe(self, id, q):
+    with self.lock:
+      if q in self.subscribers.get(id, []):
+        self.subscribers[id].remove(q)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+  """
+  Map streamtools' REST routes onto a FakeDaemon.
+  """
+
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    pass
+
+  def _body(self):
+    length = int(self.headers.getheader('content-length') or 0)
+    if not length:
+      return {}
+    return ujson.loads(self.rfile.read(length))
+
+  def _respond(self, status, obj):
+    body = ujson.dumps(obj)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _route(self, method):
+    parts = [p for p in self.path.split('?')[0].split('/') if p]
+    server = self.server
+    server.record(method, parts)
+    server.begin(method)
+    try:
+
+      # simulate network / daemon latency
+      delay = server.latency
+      if callable(delay):
+        delay = delay(method, self.path)
+      if delay:
+        time.sleep(delay)
+
+      if method == 'GET' and parts and parts[0] == 'stream' and len(parts) == 2:
+        return self._stream(parts[1])
+
+      if method == 'GET' and parts and parts[0] == 'ws' and len(parts) == 2:
+        return self._websocket(parts[1])
+
+      self._respond(*server.dispatch(method, parts, self._body()))
+
+    finally:
+      server.end(method)
+
+  def _write_chunk(self, data):
+    self.wfile.write('{:x}\r\n{}\r\n'.format(len(data), data))
+    self.wfile.flush()
+
+  def _stream(self, id):
+
+    # stream json lines, one chunk per message, like streamtools.
+    server = self.server
+    generation = server.stream_generation
+    q = server.state.subscribe(id)
+
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.send_header('Connection', 'close')
+    self.end_headers()
+    self.close_connection = 1
+
+    seq = 0
+    next_at = time.time()
+    try:
+      while not server.stopped and generation == server.stream_generation:
+
+        # emit synthetic traffic at the configured rate.
+        if server.stream_rate and time.time() >= next_at:
+          seq += 1
+          self._write_chunk(ujson.dumps({'seq': seq, 'ts': time.time()}) + '\n')
+          next_at += 1.0 / server.stream_rate
+
+        timeout = 0.1
+        if server.stream_rate:
+          timeout = max(0, min(timeout, next_at - time.time()))
+
+        try:
+          msg = q.get(timeout=timeout)
+        except Empty:
+          continue
+
+        self._write_chunk(ujson.dumps(msg) + '\n')
+
+      self.wfile.write('0\r\n\r\n')
+
+    except socket.error:
+      pass
+
+    finally:
+      server.state.unsubscribe(id, q)
+
+  def _websocket(self, id):
+
+    # send each message as an unmasked text frame.
+    server = self.server
+    generation = server.stream_generation
+    q = server.state.subscribe(id)
+
+    key = self.headers.getheader('sec-websocket-key', '')
+    accept = b64encode(sha1(key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+
+    self.send_response(101, 'Switching Protocols')
+    self.send_header('Upgrade', 'websocket')
+    self.send_header('Connection', 'Upgrade')
+    self.send_header('Sec-WebSocket-Accept', accept)
+    self.end_headers()
+    self.close_connection = 1
+
+    try:
+      while not server.stopped and generation == server.stream_generation:
+        try:
+          msg = q.get(timeout=0.1)
+        except Empty:
+          continue
+
+        data = ujson.dumps(msg)
+        if len(data) < 126:
+          header = struct.pack('!BB', 0x81, len(data))
+        elif len(data) < 65536:
+          header = struct.pack('!BBH', 0x81, 126, len(data))
+        else:
+          header = struct.pack('!BBQ', 0x81, 127, len(data))
+        self.wfile.write(header + data)
+        self.wfile.flush()
+
+      # close frame
+      self.wfile.write(struct.pack('!BB', 0x88, 0))
+
+    except socket.error:
+      pass
+
+    finally:
+      server.state.unsubscribe(id, q)
+
+  def do_GET(self):
+    self._route('GET')
+
+  def do_POST(self):
+    self._route('POST')
+
+  def do_DELETE(self):
+    self._route('DELETE')
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+
+  """
+  A local stand-in for the streamtools daemon.
+  Implements the REST surface used by `Api` with
+  configurable per-request `latency` (seconds, or a
+  callable of method and path) and a synthetic
+  `stream_rate` (messages per second) on `/stream/{id}`.
+  `peak_inflight` counts the most requests of each 
+  method that were served at once.
+
+    with FakeServer(latency=0.005) as server:
+      st = Api(server.url)
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def __init__(self, host='localhost', port=0, latency=0, stream_rate=None):
+
+    HTTPServer.__init__(self, (host, port), FakeHandler)
+    self.state = FakeDaemon()
+    self.latency = latency
+    self.stream_rate = stream_rate
+    self.stopped = False
+    self.stream_generation = 0
+    self.hits = {}
+    self.inflight = {}
+    self.peak_inflight = {}
+    self._thread = None
+    self._requests = {}
+
+  @property
+  def url(self):
+
+    """
+    The address of this server, as passed to `Api`.
+    """
+
+    return '{}:{}'.format(*self.server_address)
+
+  @property
+  def request_count(self):
+
+    """
+    The total number of requests served.
+    """
+
+    return sum(self.hits.values())
+
+  def record(self, method, parts):
+
+    # key by method + route template, eg: "GET blocks/:id"
+    key = '{} {}'.format(method, path_template('/'.join(parts)))
+    with self.state.lock:
+      self.hits[key] = self.hits.get(key, 0) + 1
+
+  def begin(self, method):
+    with self.state.lock:
+      self.inflight[method] = self.inflight.get(method, 0) + 1
+      self.peak_inflight[method] = max(self.peak_inflight.get(method, 0), 
+                                       self.inflight[method])
+
+  def end(self, method):
+    with self.state.lock:
+      self.inflight[method] -= 1
+
+  def dispatch(self, method, parts, body):
+
+    """
+    Route a request to the fake daemon.
+    Returns a (status, response) tuple.
+    """
+
+    d = self.state
+    route = (method, parts[0] if parts else '', len(parts))
+
+    if route == ('GET', 'version', 1):
+      return 200, {'Version': 'fake'}
+
+    elif route == ('GET', 'library', 1):
+      return 200, LIBRARY
+
+    elif route == ('GET', 'export', 1):
+      return 200, d.export()
+
+    elif route == ('POST', 'import', 1):
+      return d.load(body)
+
+    elif route == ('GET', 'blocks', 1):
+      return 200, d.export()['Blocks']
+
+    elif route == ('POST', 'blocks', 1):
+      return d.create_block(body)
+
+    elif route == ('GET', 'blocks', 2):
+      if parts[1] not in d.blocks:
+        return d._error('block {} does not exist'.format(parts[1]))
+      return 200, d.blocks[parts[1]]
+
+    elif route == ('DELETE', 'blocks', 2):
+      return d.delete_block(parts[1])
+
+    elif route == ('POST', 'blocks', 3):
+      return d.to_route(parts[1], parts[2], body)
+
+    elif route == ('GET', 'blocks', 3):
+      return d.from_route(parts[1], parts[2])
+
+    elif route == ('GET', 'connections', 1):
+      return 200, d.export()['Connections']
+
+    elif route == ('POST', 'connections', 1):
+      return d.create_connection(body)
+
+    elif route == ('GET', 'connections', 2):
+      if parts[1] not in d.connections:
+        return d._error('connection {} does not exist'.format(parts[1]))
+      return 200, d.connections[parts[1]]
+
+    elif route == ('DELETE', 'connections', 2):
+      return d.delete_connection(parts[1])
+
+    elif route == ('GET', 'connections', 3):
+      return d.from_connection_route(parts[1], parts[2])
+
+    return 404, {'daemon': 'no route for {} /{}'.format(method, '/'.join(parts))}
+
+  def close_streams(self):
+
+    """
+    End every open `/stream/{id}` and `/ws/{id}` response.
+    """
+
+    self.stream_generation += 1
+
+  def process_request(self, request, client_address):
+
+    # track handler threads so `stop` can wait on them.
+    t = threading.Thread(target=self.process_request_thread, 
+                         args=(request, client_address))
+    t.daemon = True
+    self._requests[request] = t
+    t.start()
+
+  def handle_error(self, request, client_address):
+    if not self.stopped:
+      HTTPServer.handle_error(self, request, client_address)
+
+  def shutdown_request(self, request):
+    self._requests.pop(request, None)
+    HTTPServer.shutdown_request(self, request)
+
+  def start(self):
+
+    """
+    Serve requests from a background thread.
+    """
+
+    self._thread = threading.Thread(target=self.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+
+    """
+    Stop serving and close open streams.
+    """
+
+    self.stopped = True
+    self.shutdown()
+    self.server_close()
+
+    # hang up on idle keep-alive connections
+    for request, t in self._requests.items():
+      try:
+        request.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      t.join(1)
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
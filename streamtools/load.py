@@ -0,0 +1,168 @@
+import math
+import threading
+import time
+import uuid
+
+from kombu.log import get_logger
+
+from metrics import Histogram
+
+logger = get_logger(__name__)
+
+
+class LoadGenerator:
+
+  """
+  Sends tagged messages into a Pattern from `workers`
+  threads and reads them back with `Pattern.listen` to
+  measure what the Pattern sustains. The send rate starts
+  at `rate` messages per second and ramps linearly to
+  `ramp_to` over `duration` seconds when given.
+
+  Each message is `payload` plus a "_load" tag of the run's
+  id, a sequence number and the time it was due; the Pattern
+  must pass the tag through. Latency is measured from when
+  a message was due, not sent, so a generator that falls
+  behind doesn't hide the backlog. `run` returns throughput,
+  exact latency percentiles (seconds) and loss once every
+  message arrives or `drain` seconds pass.
+
+    report = LoadGenerator(pattern, rate=100, ramp_to=1000, duration=60).run()
+    print report['latency']['p99'], report['loss']
+  """
+
+  def __init__(self, pattern, rate=100, duration=10, ramp_to=None,
+               workers=4, payload=None, warmup=0.5, drain=5):
+
+    if rate <= 0 or (ramp_to is not None and ramp_to <= 0):
+      raise ValueError('Load rates must be positive')
+
+    self.pattern = pattern
+    self.rate = float(rate)
+    self.duration = duration
+    self.ramp_to = float(rate if ramp_to is None else ramp_to)
+    self.workers = workers
+    self.payload = payload or {}
+    self.warmup = warmup
+    self.drain = drain
+
+    self.id = str(uuid.uuid4())
+    self.total = int((self.rate + self.ramp_to) / 2 * duration)
+    self.latency = Histogram(size=None)
+    self.sent = 0
+    self.errors = 0
+    self._received = set()
+    self._duplicates = 0
+    self._lock = threading.Lock()
+    self._done = threading.Event()
+    self._stream = None
+    self._listener = None
+
+  def due(self, seq):
+
+    """
+    Seconds after the start that message `seq` is due:
+    when the integral of the (linear) rate reaches `seq`.
+    """
+
+    a = (self.ramp_to - self.rate) / (2.0 * self.duration)
+    if abs(a) < 1e-12:
+      return seq / self.rate
+    return (-self.rate + math.sqrt(self.rate ** 2 + 4 * a * seq)) / (2 * a)
+
+  def _send(self, worker, start):
+    for seq in xrange(worker, self.total, self.workers):
+      due = start + self.due(seq)
+      wait = due - time.time()
+      if wait > 0:
+        time.sleep(wait)
+
+      msg = dict(self.payload)
+      msg['_load'] = {'run': self.id, 'seq': seq, 'ts': due}
+      try:
+        self.pattern.send_to(msg)
+      except Exception as e:
+        with self._lock:
+          self.errors += 1
+        logger.warning('Sending message %d failed: %r', seq, e)
+      else:
+        with self._lock:
+          self.sent += 1
+
+  def _listen(self, stream):
+    for msgs in stream:
+      now = time.time()
+      for msg in msgs:
+        self._receive(msg, now)
+
+  def _receive(self, msg, now):
+    tag = msg.get('_load') if isinstance(msg, dict) else None
+
+    # skip other traffic + earlier runs.
+    if not tag or tag.get('run') != self.id or self._done.is_set():
+      return
+
+    with self._lock:
+      if tag['seq'] in self._received:
+        self._duplicates += 1
+        return
+      self._received.add(tag['seq'])
+      received = len(self._received)
+    self.latency.add(now - tag['ts'])
+
+    if received >= self.total:
+      self._done.set()
+
+  def run(self):
+
+    """
+    Generate the load and return a report.
+    """
+
+    # one message per batch, so none wait to be read.
+    stream = self._stream = self.pattern.listen(batches=True, batch_size=1)
+    listener = self._listener = threading.Thread(target=self._listen, args=(stream,))
+    listener.daemon = True
+    listener.start()
+
+    # let the listener connect before sending.
+    time.sleep(self.warmup)
+
+    start = time.time()
+    senders = [threading.Thread(target=self._send, args=(w, start))
+               for w in range(self.workers)]
+    for t in senders:
+      t.daemon = True
+      t.start()
+    for t in senders:
+      t.join()
+    sent_in = time.time() - start
+
+    self._done.wait(self.drain)
+    self._done.set()
+    elapsed = time.time() - start
+
+    # hang up, even if messages were lost.
+    stream.stop()
+    listener.join()
+    return self.report(sent_in, elapsed)
+
+  def report(self, sent_in, elapsed):
+    with self._lock:
+      received = len(self._received)
+      duplicates = self._duplicates
+
+    lost = self.sent - received
+    return {
+      'run': self.id,
+      'target': self.total,
+      'sent': self.sent,
+      'errors': self.errors,
+      'received': received,
+      'duplicates': duplicates,
+      'lost': lost,
+      'loss': float(lost) / self.sent if self.sent else 0.0,
+      'send_rate': self.sent / sent_in if sent_in else 0.0,
+      'receive_rate': received / elapsed if elapsed else 0.0,
+      'latency': self.latency.snapshot()
+    }
@@ -0,0 +1,225 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from collections import deque
+import threading
+import time
+import ujson
+
+
+class Counter:
+  """
+  A thread-safe counter that also tracks its
+  per-second rate over the last `window` seconds.
+  """
+
+  def __init__(self, window=10):
+    self.value = 0
+    self.window = window
+    self._start = time.time()
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def inc(self, n=1):
+    now = int(time.time())
+    with self._lock:
+      self.value += n
+      self._buckets[now] = self._buckets.get(now, 0) + n
+
+      # forget seconds that fell out of the window.
+      if len(self._buckets) > self.window + 1:
+        for second in self._buckets.keys():
+          if second < now - self.window:
+            del self._buckets[second]
+
+  def rate(self):
+    now = time.time()
+    with self._lock:
+      recent = sum(n for s, n in self._buckets.items() if s >= now - self.window)
+    elapsed = min(self.window, now - self._start)
+    return recent / elapsed if elapsed > 0 else 0.0
+
+  def snapshot(self):
+    return {'count': self.value, 'rate': self.rate()}
+
+
+class Histogram:
+  """
+  A thread-safe histogram of samples. Percentiles are
+  computed over the last `size` samples, or every sample
+  when `size` is None; count, sum, min + max are exact.
+  """
+
+  percentiles = (0.5, 0.9, 0.99, 0.999)
+
+  def __init__(self, size=1024):
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+    self._samples = deque(maxlen=size)
+    self._lock = threading.Lock()
+
+  def add(self, value):
+    with self._lock:
+      self.count += 1
+      self.sum += value
+      self._samples.append(value)
+      if self.min is None or value < self.min:
+        self.min = value
+      if self.max is None or value > self.max:
+        self.max = value
+
+  def percentile(self, p):
+    with self._lock:
+      samples = sorted(self._samples)
+    if not samples:
+      return None
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+  def snapshot(self):
+    with self._lock:
+      samples = sorted(self._samples)
+      snap = {
+        'count': self.count,
+        'sum': self.sum,
+        'mean': self.sum / self.count if self.count else None,
+        'min': self.min,
+        'max': self.max
+      }
+
+    for p in self.percentiles:
+      key = 'p' + ('%g' % (p * 100)).replace('.', '')
+      snap[key] = samples[min(int(len(samples) * p), len(samples) - 1)] \
+        if samples else None
+    return snap
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    body = ujson.dumps(self.server.stats())
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+def serve(stats, port=0, host='localhost'):
+  """
+  Serve the json returned by `stats()` over http
+  on a background thread. Returns the server;
+  call `shutdown()` to stop it.
+  """
+  server = HTTPServer((host, port), StatsHandler)
+  server.stats = stats
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+class RequestStats:
+  """
+  Collects timings, sizes + errors of http requests,
+  by method and path template, eg: "GET blocks/:id".
+  Pass `record` as a request hook to `Api`.
+  """
+
+  def __init__(self, size=1024):
+    self.size = size
+    self.endpoints = {}
+    self._lock = threading.Lock()
+
+  def record(self, r):
+    key = (r['method'], r['path'])
+    with self._lock:
+      ep = self.endpoints.get(key)
+      if not ep:
+        ep = self.endpoints[key] = {
+          'requests': 0,
+          'errors': 0,
+          'bytes_sent': 0,
+          'bytes_received': 0,
+          'time': Histogram(self.size),
+          'encode_time': Histogram(self.size),
+          'decode_time': Histogram(self.size)
+        }
+      ep['requests'] += 1
+      ep['errors'] += int(bool(r['error']))
+      ep['bytes_sent'] += r['bytes_sent']
+      ep['bytes_received'] += r['bytes_received']
+
+    ep['time'].add(r['time'])
+    ep['encode_time'].add(r['encode_time'])
+    ep['decode_time'].add(r['decode_time'])
+
+  def reset(self):
+    with self._lock:
+      self.endpoints = {}
+
+  def to_dict(self):
+    
+    """
+    Stats for each endpoint, keyed by "METHOD path".
+    """
+    
+    with self._lock:
+      endpoints = self.endpoints.items()
+
+    stats = {}
+    for (method, path), ep in endpoints:
+      stats['{} {}'.format(method, path)] = {
+        'requests': ep['requests'],
+        'errors': ep['errors'],
+        'error_rate': float(ep['errors']) / ep['requests'],
+        'bytes_sent': ep['bytes_sent'],
+        'bytes_received': ep['bytes_received'],
+        'time': ep['time'].snapshot(),
+        'encode_time': ep['encode_time'].snapshot(),
+        'decode_time': ep['decode_time'].snapshot()
+      }
+    return stats
+
+  def to_prometheus(self, prefix='streamtools_api'):
+    
+    """
+    Stats in the prometheus text exposition format.
+    """
+    
+    with self._lock:
+      endpoints = sorted(self.endpoints.items())
+
+    lines = []
+    counters = [
+      ('requests_total', 'requests'),
+      ('errors_total', 'errors'),
+      ('sent_bytes_total', 'bytes_sent'),
+      ('received_bytes_total', 'bytes_received')
+    ]
+    for name, field in counters:
+      lines.append('# TYPE {}_{} counter'.format(prefix, name))
+      for (method, path), ep in endpoints:
+        lines.append('{}_{}{{method="{}",path="{}"}} {}'\
+          .format(prefix, name, method, path, ep[field]))
+
+    summaries = [
+      ('request_seconds', 'time'),
+      ('encode_seconds', 'encode_time'),
+      ('decode_seconds', 'decode_time')
+    ]
+    for name, field in summaries:
+      lines.append('# TYPE {}_{} summary'.format(prefix, name))
+      for (method, path), ep in endpoints:
+        labels = 'method="{}",path="{}"'.format(method, path)
+        h = ep[field]
+        for p in Histogram.percentiles:
+          value = h.percentile(p)
+          lines.append('{}_{}{{{},quantile="{}"}} {}'\
+            .format(prefix, name, labels, p, 'NaN' if value is None else repr(value)))
+        lines.append('{}_{}_sum{{{}}} {!r}'.format(prefix, name, labels, h.sum))
+        lines.append('{}_{}_count{{{}}} {}'.format(prefix, name, labels, h.count))
+
+    return '\n'.join(lines) + '\n'
@@ -1,12 +1,21 @@
-from client import Api
+from client import get_api
 
-from util import md5, random_position
+from util import md5, random_position, diff_pattern
+from compiler import compile_pattern
+from engine import Engine
+from codec import CODECS, Projection, get_codec
+from metrics import Counter, Histogram, serve
 import settings
 
+import errno
+import threading
 import time 
-import ujson
 import uuid
-from kombu import Queue
+from socket import error as SocketError
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from kombu import Queue, Producer
 from kombu.common import maybe_declare
 from kombu.pools import producers
 from kombu.mixins import ConsumerMixin
@@ -14,6 +23,64 @@ from kombu.log import get_logger
 
 logger = get_logger(__name__)
 
+# the methods a broker confirms publishes with: basic.ack + basic.nack.
+CONFIRMS = [(60, 80), (60, 120)]
+
+
+def run_main(main, body, codec=None):
+  """
+  Run a plugin's `main` on a raw message body, 
+  returning its outputs, any error and how long it took.
+  """
+  start = time.time()
+  codec = codec or CODECS['json']
+  try:
+    return list(main(codec.loads(body))), None, time.time() - start
+  except Exception as e:
+    return [], e, time.time() - start
+
+
+def run_main_batch(main_batch, bodies, codec=None):
+  """
+  Run a plugin's `main_batch` on a list of raw message 
+  bodies, returning its outputs, any error and how long it took.
+  """
+  start = time.time()
+  codec = codec or CODECS['json']
+  try:
+    outputs = list(main_batch(codec.loads_many(bodies)))
+    return outputs, None, time.time() - start
+  except Exception as e:
+    return [], e, time.time() - start
+
+
+class Pipeline:
+  """
+  The `main` of fused Plugins: each stage's outputs are passed
+  to the next stage in memory. A stage is a (function, batched)
+  pair; batched stages get a list of bodies. Called with a list
+  of bodies, or a single body when `single` is set.
+  """
+
+  def __init__(self, stages, single=False):
+    self.stages = stages
+    self.single = single
+
+  def __call__(self, bodies):
+    if self.single:
+      bodies = [bodies]
+
+    for fn, batched in self.stages:
+      if batched:
+        bodies = list(fn(bodies))
+      else:
+        bodies = [output for body in bodies for output in fn(body)]
+    return bodies
+
+  @property 
+  def picklable(self):
+    return not any(hasattr(fn, 'im_self') for fn, batched in self.stages)
+
 
 class Plugin(ConsumerMixin):
   """
@@ -21,22 +88,88 @@ class Plugin(ConsumerMixin):
   streams from streamtools into a customizable python function 
   which emits output to a `fromamqp` which can be used to route the  
   output to other streamtools blocks.
+
+  With `concurrency` > 1, `main` runs on a pool of threads with up 
+  to `prefetch_count` unacked messages in flight. Outputs are 
+  published and messages acked from the consumer thread, in 
+  delivery order unless `ordered` is False. With `executor='process'`,
+  bodies are decoded and run on a pool of processes instead, 
+  one per core by default; `main`, and `main_batch` if it's
+  overridden, must then be picklable, module-level functions.
+  Work whose outputs can't be sent back from a process fails
+  like an error in `main`.
+
+  With `batch_size` > 1, up to `batch_size` messages, or as many 
+  as arrive within `batch_wait` seconds, are passed to `main_batch` 
+  as one list. A batch is acked or rejected as a whole.
+
+  `stats()` snapshots message rates, `main` + publish timings, 
+  errors and in-flight messages. While running, the snapshot 
+  is sent to the `stats_block` block and/or served as json on 
+  `stats_port` every `stats_interval` seconds.
+
+  Outputs are published on the consumer's channel and flushed 
+  once `publish_batch_size` are waiting or `publish_interval` 
+  seconds have passed; messages are acked after their outputs
+  are flushed. With `confirm`, each flush waits for the broker
+  to confirm its outputs (publisher confirms) before acking;
+  messages whose outputs it refuses are requeued.
+
+  Bodies are decoded with `codec` and outputs encoded with 
+  `out_codec`, which defaults to `codec`: "json" (ujson), 
+  "msgpack", "raw" (bytes passed through) or a `codec.Codec`.
+  With `paths`, eg: [".summary"], json bodies are projected: 
+  only the named top-level fields are decoded, and bodies 
+  yielded unchanged are published as their original bytes.
+  Bodies with none of the fields reach `main` empty, or are
+  acked without running it with `skip_unmatched`.
+
+  `p1 | p2`, or `p1.pipe(p2)`, fuses two Plugins into one that 
+  reads from `p1`'s in_block, runs both `main`s back to back and
+  publishes to `p2`'s out_block, skipping the hop through
+  streamtools + AMQP in between. It consumes with `p1`'s 
+  settings and publishes with `p2`'s.
   """
 
-  def __init__(self, id=None, type='plugin', rule={}, **kw):
+  # seconds to wait on the broker before checking for finished work.
+  poll_interval = 0.05
+
+  def __init__(self, id=None, type='plugin', rule={}, 
+               concurrency=None, executor='thread', prefetch_count=None, ordered=True, 
+               batch_size=1, batch_wait=0.1,
+               stats_block=None, stats_port=None, stats_interval=10,
+               codec='json', out_codec=None, paths=None, skip_unmatched=False,
+               publish_batch_size=1, publish_interval=0, confirm=False, **kw):
       
     # setup connection
-    self.connection = settings.CONN
+    self.connection = kw.get('connection', settings.CONN)
+    self.api = kw.get('api') or get_api(kw.get('url'))
+    self.url = self.api.url
     if not id:
       id = str(uuid.uuid4())
+    self.id = id
+
+    # setup serialization
+    self.codec = get_codec(codec)
+    if paths:
+      if self.codec is not CODECS['json']:
+        raise ValueError('Only json bodies can be projected to `paths`')
+      self.codec = Projection(paths)
+    self.out_codec = get_codec(out_codec or codec)
+    self.skip_unmatched = skip_unmatched
+
+    # projected bodies are re-encoded whole by their projection.
+    if self.out_codec is CODECS['json'] and isinstance(self.codec, Projection):
+      self.out_codec = self.codec
     
     # determine routing keys.
     self.in_key = "in-{}".format(id)
     self.out_key = "out-{}".format(id)
 
-    # setup queues
+    # setup queues, one per plugin so plugins don't 
+    # compete for each other's messages.
     self.queues = [
-        Queue(settings.EXCHANGE_NAME, 
+        Queue(self.in_key, 
             settings.EXCHANGE, 
             routing_key=self.in_key)          
         ]
@@ -44,16 +177,73 @@ class Plugin(ConsumerMixin):
     # setup blocks
     self.in_block = Block(self.in_key, 
         type='toamqp',
-        rule = self._parse_rule(rule, self.in_key)
+        rule = self._parse_rule(rule, self.in_key),
+        api = self.api,
+        lazy = kw.get('lazy', settings.LAZY)
     )
     
     self.out_block = Block(self.out_key, 
         type='fromamqp',
-        rule = self._parse_rule(rule, self.out_key)
+        rule = self._parse_rule(rule, self.out_key),
+        api = self.api,
+        lazy = kw.get('lazy', settings.LAZY)
     )
 
     self._cached_connections = []
 
+    # setup worker pool
+    if executor not in ('thread', 'process'):
+      raise ValueError('executor must be "thread" or "process"')
+    
+    if not concurrency:
+      concurrency = cpu_count() if executor == 'process' else 1
+
+    self.executor = executor
+    self.concurrency = concurrency
+    self.prefetch_count = prefetch_count
+    if not prefetch_count and (self._pooled or batch_size > 1):
+      self.prefetch_count = concurrency * batch_size * 2
+    self.ordered = ordered
+
+    # setup micro-batching
+    self.batch_size = batch_size
+    self.batch_wait = batch_wait
+    self._batch = []
+    self._batch_opened = None
+
+    self._pool = None
+    self._pending = OrderedDict()
+    self._seq = 0
+
+    # setup publishing
+    self.publish_batch_size = publish_batch_size
+    self.publish_interval = publish_interval
+    self.confirm = confirm
+
+    self._producer = None
+    self._outbox = []
+    self._settle = []
+    self._batch_started = None
+    self._unconfirmed = None
+    self._nacked = False
+    self._tag = 0
+
+    # setup metrics
+    self.stats_block = stats_block
+    self.stats_port = stats_port
+    self.stats_interval = stats_interval
+    self.metrics = {
+      'in': Counter(),
+      'out': Counter(),
+      'errors': Counter(),
+      'skipped': Counter(),
+      'main_time': Histogram(),
+      'publish_time': Histogram()
+    }
+    self._inflight = 0
+    self._reporter = None
+    self._stats_server = None
+
   def _parse_rule(self, raw, routing_key):
     return {
       "Exchange": raw.get('Exchange', settings.EXCHANGE_NAME),
@@ -69,19 +259,275 @@ class Plugin(ConsumerMixin):
   def raw(self):
     return [self.in_block.raw, self.out_block.raw]
 
+  @property 
+  def _pooled(self):
+    return self.concurrency > 1 or self.executor == 'process'
+
+  def _start_pool(self):
+    if self.executor == 'thread':
+      return ThreadPool(self.concurrency)
+
+    # bound methods can't be pickled.
+    fn = self._main_batch() if self.batch_size > 1 else self.main
+    if hasattr(fn, 'im_self') or (isinstance(fn, Pipeline) and not fn.picklable):
+      raise ValueError('Process plugins need a module-level `{}` function'\
+        .format(getattr(fn, '__name__', 'main')))
+    return Pool(self.concurrency)
+
+  def stats(self):
+    
+    """
+    A snapshot of this Plugin's throughput + latency.
+    Times are in seconds, rates in messages per second.
+    """
+
+    snap = dict((k, m.snapshot()) for k, m in self.metrics.items())
+    snap['id'] = self.id
+    snap['inflight'] = self._inflight
+    snap['unpublished'] = len(self._outbox)
+    snap['ts'] = time.time()
+    return snap
+
+  def _start_reporting(self):
+    if self.stats_port is not None and not self._stats_server:
+      self._stats_server = serve(self.stats, self.stats_port)
+
+    if self.stats_block and not self._reporter:
+      self._reporter = threading.Thread(target=self._report)
+      self._reporter.daemon = True
+      self._reporter.start()
+
+  def _stop_reporting(self):
+    if self._stats_server:
+      self._stats_server.shutdown()
+      self._stats_server.server_close()
+      self._stats_server = None
+    self._reporter = None
+
+  def _report(self):
+    st = self.api
+    reporter = self._reporter
+    while self._reporter is reporter:
+      time.sleep(self.stats_interval)
+      try:
+        st.to_block_route(self.stats_block, msg=self.stats())
+      except Exception as e:
+        logger.warning('Reporting stats to %s failed: %r', self.stats_block, e)
+
   def get_consumers(self, Consumer, channel):
-    return [Consumer(self.queues, callbacks=[self.on_message])]
+    
+    # skip kombu's decoding; we decode with our codec.
+    consumer = Consumer(self.queues, on_message=self._receive)
+    if self.prefetch_count:
+      consumer.qos(prefetch_count=self.prefetch_count)
+    return [consumer]
+
+  def consume(self, *args, **kw):
+
+    # fork workers before the AMQP connection is opened.
+    if self._pooled and not self._pool:
+      self._pool = self._start_pool()
+    kw.setdefault('safety_interval', self.poll_interval)
+    return super(Plugin, self).consume(*args, **kw)
+
+  def on_consume_ready(self, connection, channel, consumers, **kw):
+    self._start_reporting()
+
+    # one producer per consumer loop, declared once.
+    maybe_declare(settings.EXCHANGE, channel)
+    self._producer = Producer(channel, exchange=settings.EXCHANGE)
+    if self.confirm:
+      self._start_confirms(channel)
+
+  def _start_confirms(self, channel):
+    if not (hasattr(channel, 'confirm_select') and hasattr(channel, 'events')):
+      logger.warning('Transport does not support publisher confirms, '
+                     'publishing without them')
+      return
+
+    channel.confirm_select()
+    channel.events['basic_ack'].add(self._on_ack)
+    channel.events['basic_nack'].add(self._on_nack)
+    self._unconfirmed = set()
+    self._nacked = False
+    self._tag = 0
+
+  def _on_ack(self, tag, multiple):
+    if multiple:
+      self._unconfirmed = set(t for t in self._unconfirmed if t > tag)
+    else:
+      self._unconfirmed.discard(tag)
+
+  def _on_nack(self, tag, multiple, requeue):
+    self._nacked = True
+    self._on_ack(tag, multiple)
+
+  def _wait_for_confirms(self):
+    if self._unconfirmed is None:
+      return True
+
+    while self._unconfirmed:
+      self._producer.channel.wait(CONFIRMS)
+
+    nacked, self._nacked = self._nacked, False
+    if nacked:
+      logger.warning('Broker refused outputs of plugin %s, '
+                     'requeueing their messages', self.id)
+    return not nacked
+
+  def on_consume_end(self, connection, channel):
+    
+    # finish in-flight work before the channel goes away.
+    self._dispatch()
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    self.on_iteration()
+    self._flush()
+    self._producer = None
+    self._unconfirmed = None
+    self._stop_reporting()
+
+  def on_iteration(self):
+
+    # close batches that have waited long enough.
+    if self._batch_opened is not None and \
+        time.time() - self._batch_opened >= self.batch_wait:
+      self._dispatch()
+    
+    # publish + ack finished work, in order unless unordered.
+    # work the pool itself failed, eg: on unpicklable outputs, 
+    # is completed as an error.
+    for seq, (messages, result, submitted) in self._pending.items():
+      if not result.ready():
+        if self.ordered:
+          break
+        continue
+
+      del self._pending[seq]
+      try:
+        outcome = result.get()
+      except Exception as e:
+        outcome = [], e, time.time() - submitted
+      self._complete(messages, outcome)
+
+    if self._batch_started is not None and \
+        time.time() - self._batch_started >= self.publish_interval:
+      self._flush()
+
+  def _receive(self, message):
+    self.on_message(message.body, message)
 
   def on_message(self, body, message):
-    body = ujson.loads(body)
-    try:
-      messages = self.main(body)
-    except Exception as e:
-      print 'Got Error', e
-    else:
-      for m in messages:
+    self.metrics['in'].inc()
+
+    # skip bodies without any projected fields, and
+    # decode the rest from the same scan.
+    if self.skip_unmatched and isinstance(self.codec, Projection):
+      offsets = self.codec.matches(body)
+      if not offsets:
+        self.metrics['skipped'].inc()
+        message.ack()
+        return
+      body = self.codec.loads(body, offsets)
+
+    self._inflight += 1
+    if self.batch_size > 1:
+      self._batch.append((body, message))
+      if self._batch_opened is None:
+        self._batch_opened = time.time()
+      if len(self._batch) >= self.batch_size:
+        self._dispatch()
+      return
+
+    self._submit(run_main, self.main, body, [message])
+
+  def _dispatch(self):
+    if not self._batch:
+      return
+
+    bodies = [b for b, m in self._batch]
+    messages = [m for b, m in self._batch]
+    self._batch = []
+    self._batch_opened = None
+    self._submit(run_main_batch, self._main_batch(), bodies, messages)
+
+  def _submit(self, fn, main, bodies, messages):
+    if not self._pool:
+      return self._complete(messages, fn(main, bodies, self.codec))
+
+    result = self._pool.apply_async(fn, (main, bodies, self.codec))
+    self._pending[self._seq] = (messages, result, time.time())
+    self._seq += 1
+
+  def _complete(self, messages, result):
+    outputs, error, elapsed = result
+    self.metrics['main_time'].add(elapsed)
+    if error:
+      self.metrics['errors'].inc()
+      logger.error('Plugin %s failed on %d message(s): %r', 
+                   self.id, len(messages), error)
+
+    # outside of a consumer loop, publish right away.
+    if not self._producer:
+      for m in outputs:
         self.send_to(m)
-      message.ack()
+      for message in messages:
+        message.reject() if error else message.ack()
+      self._inflight -= len(messages)
+      return
+
+    self._outbox.extend(outputs)
+    self._settle.extend((message, not error) for message in messages)
+    if self._batch_started is None:
+      self._batch_started = time.time()
+
+    if len(self._outbox) >= self.publish_batch_size or \
+        time.time() - self._batch_started >= self.publish_interval:
+      self._flush()
+
+  def _flush(self):
+    if self._producer is None or not (self._outbox or self._settle):
+      return
+
+    # take the batch first, so outputs published before a
+    # failure aren't published again by the next flush. its 
+    # messages stay unacked, and are redelivered.
+    outbox, settle = self._outbox, self._settle
+    self._outbox = []
+    self._settle = []
+    self._batch_started = None
+
+    start = time.time()
+    codec = self.out_codec
+    published = 0
+    try:
+      for body in outbox:
+        self._producer.publish(
+          codec.dumps(body), 
+          content_type=codec.content_type,
+          content_encoding=codec.content_encoding,
+          routing_key=self.out_key)
+        published += 1
+        if self._unconfirmed is not None:
+          self._tag += 1
+          self._unconfirmed.add(self._tag)
+
+      confirmed = self._wait_for_confirms()
+      for message, ok in settle:
+        if not confirmed:
+          message.requeue()
+        elif ok:
+          message.ack()
+        else:
+          message.reject()
+
+    finally:
+      self._inflight -= len(settle)
+      if published:
+        self.metrics['out'].inc(published)
+        self.metrics['publish_time'].add(time.time() - start)
 
   def send_to(self, body):
     with producers[self.connection].acquire(block=True) as producer: 
@@ -91,16 +537,94 @@ class Plugin(ConsumerMixin):
         if e.errno != errno.ECONNRESET:
           raise
       else:
+          start = time.time()
+          codec = self.out_codec
           producer.publish(
-            body, 
+            codec.dumps(body), 
             exchange=settings.EXCHANGE_NAME,
             declare=[settings.EXCHANGE], 
-            serializer='json', 
+            content_type=codec.content_type,
+            content_encoding=codec.content_encoding,
             routing_key=self.out_key)
+          self.metrics['out'].inc()
+          self.metrics['publish_time'].add(time.time() - start)
 
   def main(self, body):
     yield body
 
+  def main_batch(self, bodies):
+    for body in bodies:
+      for output in self.main(body):
+        yield output
+
+  def _main_batch(self):
+
+    # the default main_batch is a bound method, so it can't 
+    # be sent to processes; loop over `main` in a Pipeline.
+    if getattr(self.main_batch, 'im_func', None) is Plugin.main_batch.im_func:
+      return Pipeline([(self.main, False)])
+    return self.main_batch
+
+  def _stages(self):
+    if isinstance(self.main, Pipeline):
+      return self.main.stages
+    if self.batch_size > 1:
+      main_batch = self._main_batch()
+      if isinstance(main_batch, Pipeline):
+        return main_batch.stages
+      return [(main_batch, True)]
+    return [(self.main, False)]
+
+  def pipe(self, other):
+
+    """
+    Fuse `other` onto the end of this Plugin, returning
+    a Plugin that runs both in one consumer. Outputs 
+    are published, and messages acked, at the edge only.
+    The fused Plugin consumes with this Plugin's settings
+    (concurrency, executor, ordering, prefetch, batching 
+    and codec) and publishes with `other`'s; `other`'s 
+    consumer settings are ignored, except that its `main`
+    still gets batches when its `batch_size` is set.
+    Raises a ValueError if `other` projects `paths`, 
+    since its `main` would see whole bodies.
+    """
+
+    if isinstance(other.codec, Projection):
+      raise ValueError('Plugins with `paths` can only be fused first')
+
+    fused = Plugin(self.id,
+      concurrency = self.concurrency,
+      executor = self.executor,
+      prefetch_count = self.prefetch_count,
+      ordered = self.ordered,
+      batch_size = self.batch_size,
+      batch_wait = self.batch_wait,
+      publish_batch_size = other.publish_batch_size,
+      publish_interval = other.publish_interval,
+      confirm = other.confirm,
+      stats_block = self.stats_block,
+      stats_port = self.stats_port,
+      stats_interval = self.stats_interval,
+      codec = self.codec,
+      out_codec = other.out_codec,
+      skip_unmatched = self.skip_unmatched,
+      connection = self.connection,
+      api = self.api,
+      lazy = True
+    )
+    fused.in_block = self.in_block
+    fused.out_key = other.out_key
+    fused.out_block = other.out_block
+
+    stages = self._stages() + other._stages()
+    fused.main = Pipeline(stages, single=True)
+    fused.main_batch = Pipeline(stages)
+    return fused
+
+  def __or__(self, other):
+    return self.pipe(other)
+
   def attach(self):
     self.in_block.refresh()
     self.out_block.refresh()
@@ -136,7 +660,15 @@ class Block:
   A block is a StreamTools module,
   It can be connected with other blocks
   to form a StreamTools Connection
+
+  With `lazy`, construction makes no requests: 
+  call `attach()`, `sync()` or `refresh()` to deploy it.
+  A lazy Block with only an id refers to an existing 
+  Block, whose type, rule + position load on first use.
   """
+
+  # fields a lazy reference loads from streamtools.
+  _remote_fields = ('type', 'rule', 'x_pos', 'y_pos')
  
   def __init__(self, 
       id = None, 
@@ -151,15 +683,21 @@ class Block:
     # get id 
     self.id = id
 
-    # initialize client + library.
-    self.url = kw.get('url', settings.STREAMTOOLS_URL)
-    self._st = Api(self.url)
-    self._lib = self._st.library()
+    # initialize client.
+    self._st = kw.get('api') or get_api(kw.get('url'))
+    self.url = self._st.url
+    self.lazy = kw.get('lazy', settings.LAZY)
+    self._unloaded = False
 
     # pull in existing block
-    if self.is_attached():
+    if 'raw' not in kw and not self.lazy and self.is_attached():
       kw['raw'] = self._st.get_block(self.id)
 
+    # a reference to an existing block, loaded on first use.
+    if 'raw' not in kw and self.lazy and id and type is None:
+      self._unloaded = True
+      return
+
     # check for raw switch
     if not 'raw' in kw:
       
@@ -169,27 +707,55 @@ class Block:
       self.rule = rule
       self.x_pos = x_pos
       self.y_pos = y_pos
+
+      # name lazy blocks now so they can be connected.
+      if self.lazy and not self.id:
+        self.id = str(uuid.uuid4())
     
     # parse raw stream tools block object.
     else:
-      self.id = kw['raw'].get('Id', id)
-      self.type = kw['raw'].get('Type', type)
-      self.rule = kw['raw'].get('Rule', rule)
-      
-      # parse position
-      pos = kw['raw'].get('Position')
-      if pos:
-        self.x_pos = pos.get('X', random_position(20, 900))
-        self.y_pos = pos.get('Y', random_position(20, 500))
-      
-      else:
-        self.x_pos = random_position(20, 900)
-        self.y_pos = random_position(20, 500)
+      self._parse(kw['raw'], id, type, rule)
 
-    if kw.get('_init', True):
+    if kw.get('_init', True) and not self.lazy:
       # refresh block
       self.refresh()
 
+  def _parse(self, raw, id=None, type=None, rule={}):
+    self.id = raw.get('Id', id)
+    self.type = raw.get('Type', type)
+    self.rule = raw.get('Rule', rule)
+    
+    # parse position
+    pos = raw.get('Position')
+    if pos:
+      self.x_pos = pos.get('X', random_position(20, 900))
+      self.y_pos = pos.get('Y', random_position(20, 500))
+    
+    else:
+      self.x_pos = random_position(20, 900)
+      self.y_pos = random_position(20, 500)
+
+  def __getattr__(self, name):
+
+    # lazy references load on first use.
+    if name in Block._remote_fields and self.__dict__.get('_unloaded'):
+      self.pull()
+      return getattr(self, name)
+    raise AttributeError(name)
+
+  def pull(self):
+
+    """
+    Load this Block's type, rule + position from streamtools.
+    """
+
+    self._unloaded = False
+    try:
+      raw = self._st.get_block(self.id)
+    except ValueError:
+      raw = {}
+    self._parse(raw, self.id)
+
   @property 
   def position(self):
    
@@ -220,11 +786,10 @@ class Block:
     Blocks associated with this Connection
     """
 
-    connections = []
-    for raw in self._st.list_connections():
-      if raw['ToId'] == self.id or raw['FromId'] == self.id:
-        connections.append(Connection(raw=raw))
-    return connections
+    return [
+      Connection(raw=raw, api=self._st, _init=False) 
+      for raw in self._st.topology().block_connections(self.id)
+    ]
 
   @property 
   def in_blocks(self):
@@ -233,11 +798,7 @@ class Block:
     The block ids this Block recieves messages from.
     """
 
-    block_ids = []
-    for c in self._st.list_connections():
-      if c['ToId'] == self.id:
-        block_ids.append(c['FromId'])
-    return block_ids
+    return self._st.topology().in_blocks(self.id)
 
   @property 
   def out_blocks(self):
@@ -246,11 +807,16 @@ class Block:
     The block ids this Block sends messages to.
     """
     
-    block_ids = []
-    for c in self._st.list_connections():
-      if c['FromId'] == self.id:
-        block_ids.append(c['ToId'])
-    return block_ids
+    return self._st.topology().out_blocks(self.id)
+
+  @property 
+  def _lib(self):
+
+    """
+    The library entry for this Block's type.
+    """
+
+    return self._st.library().get(self.type, {})
 
   @property 
   def in_routes(self):
@@ -259,8 +825,7 @@ class Block:
     This Block's available InRoutes
     """
 
-    resp = self._lib.get(self.id, {})
-    return resp.get('InRoutes', [])
+    return self._lib.get('InRoutes', [])
 
   @property 
   def out_routes(self):
@@ -269,8 +834,7 @@ class Block:
     This Block's available OutRoutes
     """
 
-    resp = self._lib.get(self.id, {})
-    return resp.get('OutRoutes', [])
+    return self._lib.get('OutRoutes', [])
 
   @property 
   def query_routes(self):
@@ -279,8 +843,7 @@ class Block:
     This Block's available QueryRoutes
     """
 
-    resp = self._lib.get(self.id, {})
-    return resp.get('QueryRoutes', [])
+    return self._lib.get('QueryRoutes', [])
 
   def attach(self):
    
@@ -339,6 +902,28 @@ class Block:
     for c in cached_connections:
       c.attach()
 
+  def sync(self):
+
+    """
+    Make streamtools match this Block, only re-creating 
+    it if it's missing or its type changed.
+    """
+
+    try:
+      have = self._st.get_block(self.id)
+    except ValueError:
+      return self.attach()
+
+    if self._unloaded:
+      self._unloaded = False
+      return self._parse(have, self.id)
+
+    if have.get('Type') != self.type:
+      self.refresh()
+
+    elif (have.get('Rule') or {}) != (self.rule or {}):
+      self._st.update_block(self.id, self.rule)
+
   def send_to(self, **kw):
     
     """
@@ -380,7 +965,13 @@ class Block:
     """
 
     if isinstance(obj, Block):
-      return Connection(from_id=self.id, to_id=obj.id)
+      return Connection(
+        from_id = self.id, 
+        to_id = obj.id, 
+        api = self._st,
+        lazy = self.lazy,
+        blocks = [self, obj]
+      )
 
   def __repr__(self):
     
@@ -388,6 +979,9 @@ class Block:
     Block display
     """
     
+    if self._unloaded:
+      return "< Block.{} >".format(self.id)
+
     return "< Block.{} = {}, {} >"\
       .format(self.id, self.type, self.rule)
 
@@ -396,6 +990,8 @@ class Connection:
   
   """
   A Connection is a linkage of two Blocks.
+  With `lazy`, construction makes no requests: 
+  call `attach()`, `sync()` or `refresh()` to deploy it.
   """
   
   def __init__(self, 
@@ -408,13 +1004,18 @@ class Connection:
 
     # get id 
     self.id = id
+    self.listen_stats = {}
 
     # initialize client.
-    self.url = kw.get('url', settings.STREAMTOOLS_URL)
-    self._st = Api(self.url)
+    self._st = kw.get('api') or get_api(kw.get('url'))
+    self.url = self._st.url
+    self.lazy = kw.get('lazy', settings.LAZY)
+
+    # the Block objects this Connection was built from, if any.
+    self._blocks = kw.get('blocks')
 
     # pull in existing block if it exists.
-    if self.is_attached():
+    if 'raw' not in kw and not self.lazy and self.is_attached():
       kw['raw'] = self._st.get_connection(self.id)
 
     if not 'raw' in kw:
@@ -430,7 +1031,7 @@ class Connection:
       self.to_id = kw['raw'].get('ToId', to_id)
       self.to_route = kw['raw'].get('ToRoute', to_route)
 
-    if kw.get('_init', True):
+    if kw.get('_init', True) and not self.lazy:
       
       # refresh block
       self.refresh()
@@ -456,9 +1057,12 @@ class Connection:
     Blocks associated with this Connection
     """
 
+    if self._blocks:
+      return list(self._blocks)
+
     return [
-      Block(self.from_id, _init=False), 
-      Block(self.to_id, _init=False)
+      Block(self.from_id, _init=False, api=self._st, lazy=True), 
+      Block(self.to_id, _init=False, api=self._st, lazy=True)
     ]
 
   def detach(self):
@@ -515,6 +1119,28 @@ class Connection:
 
     self.attach()
 
+  def sync(self):
+
+    """
+    Make streamtools match this Connection, only 
+    re-creating it if it's missing or was rewired.
+    """
+
+    if self.id:
+      try:
+        have = self._st.get_connection(self.id)
+      except ValueError:
+        have = None
+
+      if have and (have['FromId'], have['ToId'], have.get('ToRoute', 'in')) \
+          == (self.from_id, self.to_id, self.to_route):
+        return
+
+      if have:
+        self.detach()
+
+    self.attach()
+
   def recieve_from(self, route="last"):
 
     """
@@ -523,39 +1149,106 @@ class Connection:
 
     return self._st.from_connection_route(self.id, route=route)
   
-  def listen(self, interval=1, max_buffer=60):
+  def listen(self, interval=1, max_buffer=60, push=False, max_interval=None,
+             ts_key='ts', seq_key='seq'):
     
     """
-    Poll the last route for new results
-    """
-    
-    buffer = []
+    Listen for messages on this Connection.
+    With `push`, tap the upstream Block's stream, which
+    carries every message sent along this Connection.
+    Otherwise poll the last route, backing off from `interval`
+    to `max_interval` seconds while nothing new arrives.
+
+    Counts are kept in `listen_stats`. Messages that carry
+    a `ts_key` timestamp (seconds) add their age on arrival
+    to its `latency` Histogram; those that carry a `seq_key`
+    sequence number count the `gaps` between them and the
+    messages `missed` in those gaps, eg: ones a poll skipped.
+    """
+
+    self.listen_stats = {
+      'messages': 0,
+      'latency': Histogram(),
+      'gaps': 0,
+      'missed': 0,
+      'last_seq': None
+    }
+    keys = (ts_key, seq_key)
+
+    if push:
+      return self._push(keys)
+
+    return self._poll(interval, max_buffer, max_interval or interval * 10, keys)
+
+  def _track(self, msg, now, keys):
+    stats = self.listen_stats
+    stats['messages'] += 1
+    if not isinstance(msg, dict):
+      return
+
+    ts_key, seq_key = keys
+    ts = msg.get(ts_key)
+    if isinstance(ts, (int, long, float)):
+      stats['latency'].add(now - ts)
+
+    seq = msg.get(seq_key)
+    if isinstance(seq, (int, long)):
+      last = stats['last_seq']
+      if last is not None and seq > last + 1:
+        stats['gaps'] += 1
+        stats['missed'] += seq - last - 1
+      if last is None or seq > last:
+        stats['last_seq'] = seq
+
+  def _push(self, keys):
+    for msg in self._st.stream(self.from_id):
+      self._track(msg, time.time(), keys)
+      yield msg
+
+  def _poll(self, interval, max_buffer, max_interval, keys):
+
+    stats = self.listen_stats
+    stats.update(polls=0, duplicates=0, max_lag=0)
+
+    # recent msg hashes, oldest first.
+    seen = OrderedDict()
+    wait = interval
+    last_poll = time.time()
     
     while True:
       
       # get msg
       msg = self.recieve_from()
       msg = msg.pop('Last', None)
+      now = time.time()
+      stats['polls'] += 1
 
-      if msg:
+      # polling adds at most this much latency.
+      lag = now - last_poll
+      last_poll = now
 
-        # create msg hash
-        msg_id = md5(msg)
+      msg_id = msg and md5(msg)
+      if msg and msg_id not in seen:
+        seen[msg_id] = True
+        if len(seen) > max_buffer:
+          seen.popitem(last=False)
 
-        # check if the msg is new
-        if msg_id not in buffer:
-          buffer.append(msg_id)
+        self._track(msg, now, keys)
+        stats['max_lag'] = max(stats['max_lag'], lag)
+        wait = interval
 
-          # yield new messages.
-          yield msg 
+        # yield new messages.
+        yield msg 
 
-      # trim buffer
-      if len(buffer) >- max_buffer:
-        buffer = [buffer[-1]]
+      else:
+        if msg:
+          stats['duplicates'] += 1
 
-      # rest
-      time.sleep(interval)
+        # back off while the Connection is quiet.
+        wait = min(wait * 2, max_interval)
 
+      # rest
+      time.sleep(wait)
 
   def __add__(self, obj):
     
@@ -569,7 +1262,7 @@ class Connection:
       return obj
 
     elif isinstance(obj, Connection):
-      return Pattern(connections = [obj, self])
+      return Pattern(connections = [obj, self], api=self._st)
 
   def __repr__(self):
 
@@ -589,12 +1282,15 @@ class Pattern:
   """
 
   def __init__(self,
-      connections = [],
+      connections = None,
       **kw
     ):
 
     # listify
-    if not isinstance(connections, list):
+    if connections is None:
+      connections = []
+
+    elif not isinstance(connections, list):
       connections = [connections]
     
     self.connections = connections 
@@ -603,8 +1299,8 @@ class Pattern:
     self.blocks = [b for c in self.connections for b in c.blocks]
 
     # initialize client.
-    self.url = kw.get('url', settings.STREAMTOOLS_URL)
-    self._st = Api(self.url)
+    self._st = kw.get('api') or get_api(kw.get('url'))
+    self.url = self._st.url
 
     # global in/out blocks.
     self.in_block = kw.get('in_block', None)
@@ -646,13 +1342,48 @@ class Pattern:
     return [b.id for b in self.blocks]
 
 
-  def attach(self):
+  def compile(self, allow_cycles=True):
+
+    """
+    Check this Pattern against the block library without
+    touching the running pattern. Raises a ValueError if 
+    it's invalid, otherwise returns its Blocks' ids in 
+    topological order + its sources, sinks, orphans and
+    cycles. Cycles are only an error without `allow_cycles`.
+    """
+
+    return compile_pattern(self.raw, self._st.library(), allow_cycles)
+
+  def local(self, plugins=()):
+
+    """
+    An `Engine` that runs this Pattern, and
+    `plugins`, in this process. Call `start()` on it.
+    """
+
+    return Engine(self, plugins=plugins)
+
+  def attach(self, reconcile=False, prune=False, validate=True):
 
     """
     Attach this Pattern to streamtools. 
+    With `reconcile`, only apply the difference 
+    between this Pattern and the current one,
+    leaving unchanged Blocks + Connections running.
+    With `prune`, also remove everything else.
+    Unless `validate` is False, the Pattern is
+    compiled first and nothing is sent if it's invalid.
     """
 
-    self._st.set_pattern(self.raw)
+    if validate:
+      self.compile()
+
+    if not reconcile:
+      self._st.set_pattern(self.raw)
+      return
+
+    diff = diff_pattern(self._st.get_pattern(), self.raw, prune=prune)
+    return self._st.apply_diff(diff)
 
 
   def detach(self):
@@ -678,14 +1409,22 @@ class Pattern:
         pass 
 
 
-  def refresh(self, overwrite=True):
+  def refresh(self, overwrite=True, validate=True):
 
     """
-    Refresh this Pattern. 
+    Refresh this Pattern. Without `overwrite`, 
+    only changed Blocks + Connections are touched.
+    Unless `validate` is False, an invalid Pattern
+    is rejected before anything is detached.
     """
 
+    if not overwrite:
+      return self.attach(reconcile=True, validate=validate)
+
+    if validate:
+      self.compile()
     self.detach()
-    self.attach()
+    self.attach(validate=False)
 
 
   def send_to(self, msg):
@@ -707,18 +1446,22 @@ class Pattern:
           )
 
 
-  def listen(self):
+  def listen(self, batches=False, **kw):
 
     """
     Listen for messages from the out_route 
-    of this pattern's specifed out_block
+    of this pattern's specifed out_block.
+    With `batches`, returns a `Stream` of lists 
+    of messages which can be `stop()`ped.
     """
 
     if not self.out_block:
       self.out_block = self.blocks[-1]
 
     out_block = [b for b in self.blocks if b.id == self.out_block.id][0]
-    return self._st.stream(out_block.id)
+    if batches:
+      return self._st.stream_batches(out_block.id, **kw)
+    return self._st.stream(out_block.id, **kw)
 
 
   def __add__(self, obj):
@@ -730,7 +1473,7 @@ class Pattern:
     if isinstance(obj, Connection):
       
       # only add new conections + blocks to Pattern
-      if obj.id not in self.connection_ids:
+      if not self._has_connection(obj):
         self.connections.append(obj)
       
       for b in obj.blocks:
@@ -743,7 +1486,7 @@ class Pattern:
       
       # only add new conections + blocks to Pattern
       for c in obj.connections:
-        if c.id not in obj.connection_ids:
+        if not self._has_connection(c):
           self.connections.append(c)
       
       for b in obj.blocks:
@@ -753,6 +1496,12 @@ class Pattern:
       return self
 
 
+  def _has_connection(self, c):
+
+    # lazy connections have no id until they're attached.
+    return c in self.connections or \
+      (c.id is not None and c.id in self.connection_ids)
+
   def __repr__(self):
 
     """
@@ -0,0 +1,318 @@
+from bisect import bisect_right
+import glob
+import mmap
+import os
+import struct
+import time
+import zlib
+import ujson
+
+from kombu import Producer
+from kombu.common import maybe_declare
+from kombu.log import get_logger
+
+import settings
+
+logger = get_logger(__name__)
+
+# each block: its first timestamp + compressed length, then 
+# its zlib-compressed records.
+BLOCK = struct.Struct('>dI')
+
+# each record: its timestamp + length, then the json line.
+RECORD = struct.Struct('>dI')
+
+# each index entry: a block's first timestamp + offset in its segment.
+INDEX = struct.Struct('>dQ')
+
+
+def segment_paths(path):
+  """
+  The segments of a recording, in order.
+  """
+  return sorted(glob.glob(os.path.join(path, '*.log')))
+
+
+class Recorder:
+
+  """
+  Appends messages to a recording: a directory of segment
+  files of timestamped json lines. Every `index_interval` 
+  records are zlib-compressed together as one block, and 
+  the block's first timestamp + offset are written to the
+  segment's `.idx` file so replays can seek by time. Records
+  are buffered until their block is written, on `flush` 
+  or `close` at the latest. A new segment is started once 
+  one reaches `segment_size` bytes.
+
+    with Recorder('recordings/wiki') as rec:
+      rec.record(st, 'wiki-ws', duration=60)
+  """
+
+  def __init__(self, path, segment_size=64 * 1024 * 1024,
+               index_interval=100, level=6):
+
+    self.path = path
+    self.segment_size = segment_size
+    self.index_interval = index_interval
+    self.level = level
+    self.count = 0
+
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+    # append to an existing recording in a new segment.
+    existing = segment_paths(path)
+    self._segment = len(existing)
+    self._log = None
+    self._idx = None
+    self._block = []
+    self._block_ts = None
+
+  def _open(self):
+    name = os.path.join(self.path, '{:08d}'.format(self._segment))
+    self._log = open(name + '.log', 'ab')
+    self._idx = open(name + '.idx', 'ab')
+    self._segment += 1
+
+  def _close(self):
+    if self._log:
+      self._log.close()
+      self._idx.close()
+    self._log = None
+    self._idx = None
+
+  def _write_block(self):
+    if not self._block:
+      return
+
+    if self._log and self._log.tell() >= self.segment_size:
+      self._close()
+    if not self._log:
+      self._open()
+
+    data = zlib.compress(''.join(self._block), self.level)
+    self._idx.write(INDEX.pack(self._block_ts, self._log.tell()))
+    self._log.write(BLOCK.pack(self._block_ts, len(data)))
+    self._log.write(data)
+    self._block = []
+    self._block_ts = None
+
+  def write(self, msg, ts=None):
+
+    """
+    Append a message, or a raw json line,
+    stamped with `ts` or the current time.
+    """
+
+    if ts is None:
+      ts = time.time()
+    if not isinstance(msg, basestring):
+      msg = ujson.dumps(msg)
+    elif isinstance(msg, unicode):
+      msg = msg.encode('utf-8')
+
+    if self._block_ts is None:
+      self._block_ts = ts
+    self._block.append(RECORD.pack(ts, len(msg)) + msg)
+    self.count += 1
+
+    if len(self._block) >= self.index_interval:
+      self._write_block()
+
+  def record(self, api, block_id, limit=None, duration=None):
+
+    """
+    Record a block's httpstream until `limit` messages
+    or `duration` seconds have been recorded, whichever
+    comes first. Lines are stored as they arrive, without
+    decoding them. Returns the number of messages recorded.
+    """
+
+    deadline = None if duration is None else time.time() + duration
+    stream = api.stream_batches(block_id, raw=True)
+    n = 0
+    try:
+      while limit is None or n < limit:
+
+        # wait for lines no later than the deadline.
+        timeout = None
+        if deadline is not None:
+          timeout = deadline - time.time()
+          if timeout <= 0:
+            break
+
+        lines = stream.next_batch(timeout=timeout)
+        if limit is not None:
+          lines = lines[:limit - n]
+        for line in lines:
+          self.write(line)
+        n += len(lines)
+
+    finally:
+      stream.stop()
+      self.flush()
+    return n
+
+  def flush(self):
+
+    """
+    Write buffered records, as a block of their own.
+    """
+
+    self._write_block()
+    if self._log:
+      self._log.flush()
+      self._idx.flush()
+
+  def close(self):
+    self._write_block()
+    self._close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return False
+
+
+class Replayer:
+
+  """
+  Reads a recording back with memory-mapped segments,
+  from `start` to `end` (timestamps) when given. Messages
+  are paced to `speed` times their recorded rate, or sent
+  as fast as possible when `speed` is None.
+
+    replay = Replayer('recordings/wiki', speed=10)
+    replay.to_block(st, 'tokenize-in')
+  """
+
+  def __init__(self, path, speed=1.0, start=None, end=None):
+    if not os.path.isdir(path):
+      raise ValueError('No recording at "{}"'.format(path))
+
+    self.path = path
+    self.speed = speed
+    self.start = start
+    self.end = end
+
+  def _first_offset(self, log_path):
+
+    # the last block starting at or before `start`.
+    if self.start is None:
+      return 0
+
+    idx_path = log_path[:-len('.log')] + '.idx'
+    if not os.path.exists(idx_path):
+      return 0
+    with open(idx_path, 'rb') as f:
+      data = f.read()
+
+    entries = [INDEX.unpack_from(data, i)
+               for i in range(0, len(data) - INDEX.size + 1, INDEX.size)]
+    i = bisect_right([ts for ts, _ in entries], self.start)
+    return entries[i - 1][1] if i else 0
+
+  def lines(self):
+
+    """
+    Yield (timestamp, raw json line) tuples,
+    as fast as they can be read.
+    """
+
+    for log_path in segment_paths(self.path):
+      if not os.path.getsize(log_path):
+        continue
+
+      with open(log_path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          offset = self._first_offset(log_path)
+          while offset + BLOCK.size <= len(buf):
+            first, size = BLOCK.unpack_from(buf, offset)
+            offset += BLOCK.size
+
+            # a block cut short by a crash ends the segment.
+            if offset + size > len(buf):
+              logger.warning('Skipping truncated block in %s', log_path)
+              break
+
+            if self.end is not None and first > self.end:
+              return
+            data = zlib.decompress(buf[offset:offset + size])
+            offset += size
+
+            i = 0
+            while i < len(data):
+              ts, length = RECORD.unpack_from(data, i)
+              i += RECORD.size
+              if self.end is not None and ts > self.end:
+                return
+              if self.start is None or ts >= self.start:
+                yield ts, data[i:i + length]
+              i += length
+
+        finally:
+          buf.close()
+
+  def _paced(self):
+
+    # sleep to keep each message's lag from the first.
+    started = None
+    for ts, line in self.lines():
+      if self.speed:
+        if started is None:
+          started, first = time.time(), ts
+        wait = (ts - first) / self.speed - (time.time() - started)
+        if wait > 0:
+          time.sleep(wait)
+      yield ts, line
+
+  def __iter__(self):
+
+    """
+    Yield decoded messages, paced to `speed`.
+    """
+
+    for ts, line in self._paced():
+      yield ujson.loads(line)
+
+  def to_block(self, api, block_id, route='in'):
+
+    """
+    Send the recording to a block's route.
+    Returns the number of messages sent.
+    """
+
+    n = 0
+    for msg in self:
+      api.to_block_route(block_id, route=route, msg=msg)
+      n += 1
+    return n
+
+  def to_plugin(self, plugin):
+
+    """
+    Publish the recording straight onto a Plugin's
+    AMQP queue, skipping streamtools. Lines are sent
+    as recorded to json + raw Plugins, and re-encoded 
+    with the Plugin's `codec` otherwise. Returns the 
+    number of messages sent.
+    """
+
+    codec = plugin.codec
+    as_recorded = codec.content_type in ('application/json', 'application/data')
+
+    n = 0
+    with plugin.connection.channel() as channel:
+      maybe_declare(settings.EXCHANGE, channel)
+      producer = Producer(channel, exchange=settings.EXCHANGE)
+      for ts, line in self._paced():
+        producer.publish(line if as_recorded else codec.dumps(ujson.loads(line)),
+          routing_key=plugin.in_key,
+          content_type=codec.content_type,
+          content_encoding=codec.content_encoding)
+        n += 1
+    return n
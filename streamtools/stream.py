@@ -0,0 +1,261 @@
+from Queue import Queue, Empty, Full
+import socket
+import threading
+import time
+import ujson
+
+from kombu.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def iter_lines(resp, chunk_size=None):
+  """
+  Yield lines from a streaming response as soon as they
+  arrive. `requests` only yields a line once `chunk_size`
+  bytes have been read, which stalls slow streams. So by
+  default we read each chunk of a chunked response as it
+  arrives where urllib3 supports it, or small reads
+  otherwise, and split lines ourselves.
+  """
+  raw = resp.raw
+  if chunk_size is None and getattr(raw, 'chunked', False) \
+      and hasattr(raw, 'read_chunked'):
+    chunks = raw.read_chunked(decode_content=True)
+  else:
+    chunks = resp.iter_content(chunk_size or 1)
+
+  # the start of a line that hasn't ended yet.
+  pending = []
+  for chunk in chunks:
+    if '\n' not in chunk:
+      pending.append(chunk)
+      continue
+
+    lines = (''.join(pending) + chunk).split('\n')
+    pending = [lines.pop()]
+    for line in lines:
+      yield line.rstrip('\r')
+
+  if ''.join(pending):
+    yield ''.join(pending)
+
+
+def hangup(resp):
+  """
+  Close a streaming response. Closing alone doesn't wake 
+  a thread blocked reading it, so shut the socket down too.
+  """
+  try:
+    sock = socket.fromfd(resp.raw.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    finally:
+      sock.close()
+  except Exception:
+    pass
+
+  try:
+    resp.close()
+  except Exception:
+    pass
+
+
+def decode_lines(lines):
+  """
+  Decode a list of json lines with a single call to `ujson`,
+  falling back to line-by-line decoding and skipping
+  lines that aren't valid json.
+  """
+  try:
+    return ujson.loads('[' + ','.join(lines) + ']')
+
+  except ValueError:
+    msgs = []
+    for line in lines:
+      try:
+        msgs.append(ujson.loads(line))
+      except ValueError:
+        logger.warning('Skipping malformed line: %r', line[:100])
+    return msgs
+
+
+class Stream:
+
+  """
+  A resilient reader of a block's httpstream.
+  A background thread fills a bounded buffer of raw lines,
+  reconnecting with exponential backoff when the stream drops.
+  Iterating yields lists of up to `batch_size` decoded
+  messages, or raw lines with `raw`, waiting at most 
+  `max_wait` seconds to fill one.
+  When the buffer is full the reader blocks, pushing
+  back on the daemon instead of dropping messages.
+
+    for msgs in Api().stream_batches('ticker', batch_size=500):
+      print len(msgs)
+  """
+
+  def __init__(self, api, block_id,
+      batch_size = 100,
+      max_wait = 0.1,
+      max_buffer = 10000,
+      chunk_size = None,
+      backoff = 0.5,
+      max_backoff = 30,
+      max_retries = None,
+      raw = False
+    ):
+
+    self._st = api
+    self.block_id = block_id
+    self.batch_size = batch_size
+    self.max_wait = max_wait
+    self.chunk_size = chunk_size
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.max_retries = max_retries
+    self.raw = raw
+
+    self.stats = {
+      'messages': 0,
+      'batches': 0,
+      'connects': 0,
+      'errors': 0
+    }
+
+    self._buffer = Queue(max_buffer)
+    self._stopped = threading.Event()
+    self._resp = None
+    self._thread = None
+
+  @property
+  def running(self):
+    return bool(self._thread and self._thread.is_alive())
+
+  def start(self):
+
+    """
+    Start reading from the stream in the background.
+    """
+
+    if not self.running:
+      self._stopped.clear()
+      self._thread = threading.Thread(target=self._read)
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def stop(self):
+
+    """
+    Stop reading and hang up on the daemon.
+    """
+
+    self._stopped.set()
+    if self._resp is not None:
+      hangup(self._resp)
+
+  def _put(self, line):
+
+    # block while the buffer is full, checking for stop.
+    while not self._stopped.is_set():
+      try:
+        self._buffer.put(line, timeout=0.1)
+        return
+      except Full:
+        pass
+
+  def _read(self):
+    wait = self.backoff
+    retries = 0
+
+    while not self._stopped.is_set():
+      try:
+        self._resp = self._st._http('GET',
+          'stream/{}'.format(self.block_id),
+          json=False,
+          stream=True)
+        self.stats['connects'] += 1
+
+        # stopped while connecting.
+        if self._stopped.is_set():
+          hangup(self._resp)
+          break
+
+        for line in iter_lines(self._resp, self.chunk_size):
+
+          # reset backoff once data flows.
+          wait = self.backoff
+          retries = 0
+
+          # skip keep-alives
+          if line:
+            self._put(line)
+
+          if self._stopped.is_set():
+            break
+
+      except Exception as e:
+        if self._stopped.is_set():
+          break
+        self.stats['errors'] += 1
+        logger.warning('Stream %s failed: %r', self.block_id, e)
+
+      if self._stopped.is_set():
+        break
+
+      retries += 1
+      if self.max_retries is not None and retries > self.max_retries:
+        break
+
+      # reconnect
+      time.sleep(wait)
+      wait = min(wait * 2, self.max_backoff)
+
+    self._stopped.set()
+
+  def next_batch(self, timeout=None):
+
+    """
+    Get the next list of decoded messages.
+    Blocks up to `timeout` seconds for the first
+    message and returns an empty list if none arrive.
+    """
+
+    if self._thread is None:
+      self.start()
+
+    try:
+      lines = [self._buffer.get(timeout=timeout or 1e6)]
+    except Empty:
+      return []
+
+    deadline = time.time() + self.max_wait
+    while len(lines) < self.batch_size:
+      try:
+        lines.append(self._buffer.get_nowait())
+      except Empty:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          lines.append(self._buffer.get(timeout=remaining))
+        except Empty:
+          break
+
+    msgs = lines if self.raw else decode_lines(lines)
+    self.stats['messages'] += len(msgs)
+    self.stats['batches'] += 1
+    return msgs
+
+  def __iter__(self):
+
+    """
+    Yield lists of decoded messages until stopped.
+    """
+
+    while not (self._stopped.is_set() and self._buffer.empty()):
+      msgs = self.next_batch(timeout=1)
+      if msgs:
+        yield msgs
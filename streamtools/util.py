@@ -1,5 +1,7 @@
 import random
 import hashlib 
+import threading
+import time
 import ujson
 
 def random_position(min_=15, max_=900):
@@ -9,3 +11,110 @@ def md5(contents, json=True):
   if json:
     contents = ujson.dumps(contents)
   return hashlib.md5(contents).hexdigest()
+
+def path_template(path):
+  """
+  Collapse ids in a request path, eg: "blocks/:id/in".
+  """
+  parts = path.strip('/').split('/')
+  return '/'.join(parts[:1] + [':id'] * min(len(parts[1:]), 1) + parts[2:3])
+
+def diff_pattern(current, desired, prune=False):
+  """
+  Compute the changes needed to turn the `current` pattern
+  into the `desired` one. Blocks whose type changed are
+  replaced, blocks whose rule changed are updated in place.
+  Unless `prune` is set, Blocks + Connections that don't touch 
+  the desired pattern are left alone.
+  """
+  have_blocks = dict((b['Id'], b) for b in current.get('Blocks', []))
+  want_blocks = dict((b['Id'], b) for b in desired.get('Blocks', []))
+
+  diff = {
+    'add_blocks': [],
+    'remove_blocks': [],
+    'update_rules': [],
+    'add_connections': [],
+    'remove_connections': []
+  }
+
+  # blocks
+  for block_id, block in want_blocks.items():
+    have = have_blocks.get(block_id)
+    if not have:
+      diff['add_blocks'].append(block)
+
+    elif have.get('Type') != block.get('Type'):
+      diff['remove_blocks'].append(block_id)
+      diff['add_blocks'].append(block)
+
+    elif (have.get('Rule') or {}) != (block.get('Rule') or {}):
+      diff['update_rules'].append((block_id, block.get('Rule') or {}))
+
+  if prune:
+    for block_id in have_blocks:
+      if block_id not in want_blocks:
+        diff['remove_blocks'].append(block_id)
+
+  # connections, by id or by their endpoints.
+  def key(c):
+    return (c.get('FromId'), c.get('ToId'), c.get('ToRoute', 'in'))
+
+  removed = set(diff['remove_blocks'])
+  want_conns = desired.get('Connections', [])
+  want_ids = dict((c['Id'], c) for c in want_conns if c.get('Id'))
+  want_keys = set(key(c) for c in want_conns if not c.get('Id'))
+  kept = set()
+
+  for c in current.get('Connections', []):
+    
+    # deleting a block deletes its connections.
+    if removed.intersection([c['FromId'], c['ToId']]):
+      continue
+
+    want = want_ids.get(c['Id'])
+    if want and key(want) == key(c):
+      kept.add(c['Id'])
+
+    elif not want and key(c) in want_keys:
+      kept.add(key(c))
+
+    elif want or prune or c['FromId'] in want_blocks or c['ToId'] in want_blocks:
+      diff['remove_connections'].append(c['Id'])
+
+  for c in want_conns:
+    if c.get('Id') in kept or (not c.get('Id') and key(c) in kept):
+      continue
+    diff['add_connections'].append(c)
+
+  return diff
+
+class TTLCache:
+  """
+  A thread-safe mapping whose entries expire after `ttl` seconds.
+  """
+
+  def __init__(self, ttl=300):
+    self.ttl = ttl
+    self._data = {}
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key in self._data:
+        value, expires = self._data[key]
+        if self.ttl is None or time.time() < expires:
+          return value
+        del self._data[key]
+    return default
+
+  def set(self, key, value):
+    with self._lock:
+      self._data[key] = (value, time.time() + (self.ttl or 0))
+
+  def invalidate(self, key=None):
+    with self._lock:
+      if key is None:
+        self._data.clear()
+      else:
+        self._data.pop(key, None)
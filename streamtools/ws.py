@@ -0,0 +1,177 @@
+from Queue import Queue, Empty, Full
+import threading
+
+from ws4py.client import WebSocketBaseClient
+from ws4py.manager import WebSocketManager
+from kombu.log import get_logger
+
+from stream import decode_lines
+
+logger = get_logger(__name__)
+
+
+class BlockSocket(WebSocketBaseClient):
+
+  """
+  A websocket subscribed to one block's output.
+  Frames are handed to the mux undecoded so the
+  event loop only ever does socket work.
+  """
+
+  def __init__(self, mux, block_id):
+
+    self.mux = mux
+    self.block_id = block_id
+    url = 'ws://{}/ws/{}'.format(mux.url, block_id)
+    WebSocketBaseClient.__init__(self, url, protocols=['http-only', 'chat'])
+
+  def handshake_ok(self):
+    self.mux.manager.add(self)
+
+  def received_message(self, m):
+    self.mux._put(self.block_id, m.data)
+
+  def closed(self, code, reason=None):
+    self.mux._closed(self)
+
+
+class WebSocketMux:
+
+  """
+  Stream many blocks over websockets on a single event loop.
+  One `ws4py` manager thread polls every socket and a bounded
+  buffer merges their frames. Iterating yields (block_id, msg)
+  tuples. When the buffer is full the event loop waits for
+  room, so every socket backs off until the reader catches up;
+  each wait is counted in `stats['stalls']`.
+  Dropped sockets are reconnected after `backoff` seconds.
+
+    for block_id, msg in Api().ws_many('ticker-1', 'ticker-2'):
+      print block_id, msg
+  """
+
+  def __init__(self, url, block_ids=(), max_buffer=10000, batch_size=100, backoff=1):
+
+    self.url = url
+    self.batch_size = batch_size
+    self.backoff = backoff
+    self.sockets = {}
+    self.stats = {'messages': 0, 'connects': 0, 'stalls': 0}
+
+    self._buffer = Queue(max_buffer)
+    self._stopped = False
+
+    self.manager = WebSocketManager()
+    self.manager.daemon = True
+    self.manager.start()
+
+    for block_id in block_ids:
+      self.subscribe(block_id)
+
+  def subscribe(self, block_id):
+
+    """
+    Start streaming a block's output.
+    """
+
+    if self._stopped:
+      return
+
+    ws = BlockSocket(self, block_id)
+    self.sockets[block_id] = ws
+    ws.connect()
+    self.stats['connects'] += 1
+
+  def unsubscribe(self, block_id):
+
+    """
+    Stop streaming a block's output.
+    """
+
+    ws = self.sockets.pop(block_id, None)
+    if ws:
+      ws.close()
+
+  def _put(self, block_id, data):
+
+    try:
+      self._buffer.put_nowait((block_id, data))
+      return
+    except Full:
+      self.stats['stalls'] += 1
+      logger.warning('Websocket buffer full, waiting on the reader')
+
+    # block while the buffer is full, checking for close.
+    while not self._stopped:
+      try:
+        self._buffer.put((block_id, data), timeout=0.1)
+        return
+      except Full:
+        pass
+
+  def _closed(self, ws):
+
+    # reconnect sockets we didn't close ourselves.
+    if self._stopped or self.sockets.get(ws.block_id) is not ws:
+      return
+
+    logger.warning('Websocket for %s closed, reconnecting', ws.block_id)
+    t = threading.Timer(self.backoff, self._reconnect, [ws.block_id])
+    t.daemon = True
+    t.start()
+
+  def _reconnect(self, block_id):
+    try:
+      self.subscribe(block_id)
+    except Exception as e:
+      logger.warning('Reconnecting to %s failed: %r', block_id, e)
+      t = threading.Timer(self.backoff, self._reconnect, [block_id])
+      t.daemon = True
+      t.start()
+
+  def next_batch(self, timeout=None):
+
+    """
+    Get up to `batch_size` (block_id, msg) tuples,
+    decoding them in one pass. Waits up to `timeout`
+    seconds for the first one.
+    """
+
+    try:
+      frames = [self._buffer.get(timeout=timeout or 1e6)]
+    except Empty:
+      return []
+
+    while len(frames) < self.batch_size:
+      try:
+        frames.append(self._buffer.get_nowait())
+      except Empty:
+        break
+
+    block_ids = [f[0] for f in frames]
+    msgs = decode_lines([f[1] for f in frames])
+
+    # a frame was malformed: decode them one at a time.
+    if len(msgs) != len(frames):
+      pairs = [(b, decode_lines([d])) for b, d in frames]
+      block_ids = [b for b, m in pairs if m]
+      msgs = [m[0] for b, m in pairs if m]
+
+    self.stats['messages'] += len(msgs)
+    return zip(block_ids, msgs)
+
+  def __iter__(self):
+    while not self._stopped:
+      for pair in self.next_batch(timeout=1):
+        yield pair
+
+  def close(self):
+
+    """
+    Close every socket and stop the event loop.
+    """
+
+    self._stopped = True
+    for block_id in self.sockets.keys():
+      self.unsubscribe(block_id)
+    self.manager.stop()
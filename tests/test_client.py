@@ -0,0 +1,385 @@
+from unittest import TestCase
+import threading
+import time
+
+import streamtools as st
+from streamtools.fake import FakeServer
+from streamtools.stream import iter_lines
+
+
+class AsyncApiTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer(latency=0.01).start()
+    self.api = st.AsyncApi(self.server.url, concurrency=10)
+
+  def tearDown(self):
+    self.api.close()
+    self.server.stop()
+
+  def test_methods(self):
+    result = self.api.create_block('a', type='ticker')
+    assert result.get() == 'a'
+    assert self.api.get_block('a').get()['Type'] == 'ticker'
+
+  def test_bulk(self):
+    ids = self.api.create_blocks([
+      {'block_id': str(i), 'type': 'tolog'} for i in range(20)
+    ])
+    assert sorted(ids) == sorted(str(i) for i in range(20))
+
+    conn_ids = self.api.create_connections([
+      {'from_id': str(i), 'to_id': str(i + 1)} for i in range(19)
+    ])
+    assert len(conn_ids) == 19
+    assert len(self.api.api.list_connections()) == 19
+
+  def test_stream(self):
+    self.server.stream_rate = 50
+    self.api.create_blocks([{'block_id': 'a', 'type': 'ticker'}, 
+                            {'block_id': 'b', 'type': 'ticker'}])
+    stream = self.api.stream('a', 'b')
+    seen = set()
+    while seen != set(['a', 'b']):
+      block_id, msg = next(stream)
+      seen.add(block_id)
+
+    # closing the generator hangs up both streams.
+    assert len(self.api._responses) == 2
+    stream.close()
+    assert self.api._responses == []
+    time.sleep(0.2)
+    assert not [t for t in threading.enumerate() if t.name.startswith('stream-')]
+
+  def test_stream_end(self):
+    self.server.stream_rate = 50
+    self.api.create_blocks([{'block_id': 'a', 'type': 'ticker'}, 
+                            {'block_id': 'b', 'type': 'ticker'}])
+    stream = self.api.stream('a', 'b')
+    next(stream)
+
+    # ends once both streams end.
+    self.server.close_streams()
+    assert all(block_id in ('a', 'b') for block_id, msg in stream)
+    assert self.api._responses == []
+
+  def test_stream_error(self):
+    api = st.AsyncApi('localhost:1')
+    self.assertRaises(ValueError, list, api.stream('a'))
+
+
+class LibraryCacheTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_shared(self):
+    st.Api(self.server.url).library()
+    st.Api(self.server.url).library()
+    assert self.server.hits['GET library'] == 1
+
+    st.Api(self.server.url).invalidate_library()
+    st.Api(self.server.url).library()
+    assert self.server.hits['GET library'] == 2
+
+    st.Api(self.server.url).library(cache=False)
+    assert self.server.hits['GET library'] == 3
+
+  def test_errors(self):
+    dispatch = self.server.dispatch
+    def busy(method, parts, body):
+      if parts == ['library']:
+        return 503, {'daemon': 'busy'}
+      return dispatch(method, parts, body)
+
+    self.server.dispatch = busy
+    self.assertRaises(ValueError, st.Api(self.server.url).library)
+    self.server.dispatch = dispatch
+    assert 'histogram' in st.Api(self.server.url).library()
+
+  def test_block_routes(self):
+    b = st.Block('hist', type='histogram', url=self.server.url)
+    assert 'poll' in b.in_routes
+    assert b.out_routes == ['out']
+    assert 'histogram' in b.query_routes
+    assert self.server.hits['GET library'] == 1
+
+
+class StreamTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+    self.api.create_block('a', type='map')
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_sparse(self):
+    threading.Timer(0.2, self.api.to_block_route, ['a'], {'msg': {'n': 1}}).start()
+    assert next(self.api.stream('a')) == {'n': 1}
+
+  def test_split_lines(self):
+    class Resp:
+      raw = None
+      def iter_content(self, chunk_size):
+        return iter(['{"a"', ': 1}\r\n{"b"', '', ': 2}\n', '{"c": 3}'])
+    assert list(iter_lines(Resp())) == ['{"a": 1}', '{"b": 2}', '{"c": 3}']
+
+  def test_batches(self):
+    stream = self.api.stream_batches('a', batch_size=10, max_wait=0.5)
+    time.sleep(0.2)
+    for i in range(25):
+      self.api.to_block_route('a', msg={'n': i})
+
+    msgs = []
+    while len(msgs) < 25:
+      batch = stream.next_batch(timeout=2)
+      assert 0 < len(batch) <= 10
+      msgs.extend(batch)
+    assert [m['n'] for m in msgs] == range(25)
+    stream.stop()
+
+  def test_reconnect(self):
+    stream = self.api.stream_batches('a', backoff=0.05)
+    time.sleep(0.2)
+    self.server.close_streams()
+    time.sleep(0.3)
+    self.api.to_block_route('a', msg={'n': 1})
+    assert stream.next_batch(timeout=2) == [{'n': 1}]
+    assert stream.stats['connects'] == 2
+    stream.stop()
+
+
+class WebSocketTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+    for block_id in ['a', 'b']:
+      self.api.create_block(block_id, type='map')
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_ws(self):
+    threading.Timer(0.2, self.api.to_block_route, ['a'], {'msg': {'n': 1}}).start()
+    assert next(self.api.ws('a')) == {'n': 1}
+
+  def test_mux(self):
+    mux = self.api.ws_many('a', 'b', backoff=0.05)
+    self.api.to_block_route('a', msg={'n': 1})
+    self.api.to_block_route('b', msg={'n': 2})
+    msgs = mux.next_batch(timeout=2)
+    while len(msgs) < 2:
+      msgs.extend(mux.next_batch(timeout=2))
+    assert sorted(msgs) == [('a', {'n': 1}), ('b', {'n': 2})]
+
+    # dropped sockets reconnect.
+    self.server.close_streams()
+    time.sleep(0.5)
+    self.api.to_block_route('a', msg={'n': 3})
+    assert mux.next_batch(timeout=2) == [('a', {'n': 3})]
+    assert mux.stats['connects'] == 4
+    mux.close()
+
+  def test_mux_full(self):
+    mux = self.api.ws_many('a', max_buffer=1)
+    time.sleep(0.2)
+    for i in range(3):
+      self.api.to_block_route('a', msg={'n': i})
+    time.sleep(0.2)
+
+    # the event loop waits for room rather than dropping frames.
+    msgs = []
+    for i in range(5):
+      msgs.extend(mux.next_batch(timeout=0.5))
+    assert msgs == [('a', {'n': i}) for i in range(3)]
+    assert mux.stats['stalls'] >= 1
+    mux.close()
+
+
+class RequestStatsTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.records = []
+    self.api = st.Api(self.server.url, hooks=[self.records.append])
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_hooks(self):
+    self.api.create_block('a', type='ticker')
+    self.assertRaises(ValueError, self.api.get_block, 'b')
+    post, get = self.records
+    assert post['method'] == 'POST' and post['path'] == 'blocks'
+    assert post['status'] == 200 and post['bytes_sent'] > 0
+    assert post['time'] >= post['encode_time'] + post['decode_time']
+    assert get['path'] == 'blocks/:id' and get['error'] == 400
+
+  def test_failing_hook(self):
+    def fail(record):
+      raise RuntimeError('hook')
+    api = st.Api(self.server.url, hooks=[fail])
+    assert api.create_block('a', type='ticker') == 'a'
+    try:
+      api.get_block('b')
+      assert False
+    except ValueError as e:
+      assert 'does not exist' in str(e)
+    assert api.stats.to_dict()['GET blocks/:id']['errors'] == 1
+
+  def test_stats(self):
+    for i in range(3):
+      self.api.create_block('a-{}'.format(i), type='ticker')
+      self.api.to_block_route('a-{}'.format(i), msg={'n': i})
+
+    stats = self.api.stats.to_dict()
+    assert stats['POST blocks']['requests'] == 3
+    assert stats['POST blocks']['error_rate'] == 0
+    assert stats['POST blocks/:id/in']['time']['count'] == 3
+    assert stats['POST blocks/:id/in']['bytes_received'] > 0
+
+    text = self.api.stats.to_prometheus()
+    assert 'streamtools_api_requests_total{method="POST",path="blocks"} 3' in text
+    assert 'streamtools_api_request_seconds_count{method="POST",path="blocks/:id/in"} 3' in text
+
+
+class BatchTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_create(self):
+    with self.api.batch() as b:
+      for i in range(300):
+        self.api.create_block('log-{}'.format(i), type='tolog')
+      tick = self.api.create_block(type='ticker')
+      for i in range(300):
+        self.api.create_connection(from_id=tick, to_id='log-{}'.format(i))
+      assert self.server.request_count == 0
+
+    assert self.server.hits == {'GET export': 1, 'POST import': 1}
+    assert len(self.api.list_blocks()) == 301
+    assert len(self.api.list_connections()) == 300
+    assert all(r['ok'] for r in b.results)
+
+  def test_mixed(self):
+    self.api.create_block('a', type='ticker')
+    self.api.create_block('b', type='tolog')
+    self.api.create_block('c', type='tolog')
+    self.api.create_connection('a-b', from_id='a', to_id='b')
+
+    with self.api.batch() as b:
+      self.api.update_block('a', {'Interval': '5s'})
+      self.api.delete_block('b')
+      self.api.create_block('d', type='tolog', rule={'x': 1})
+      self.api.update_block('d', {'x': 2})
+      self.api.create_connection('a-d', from_id='a', to_id='d')
+      self.api.delete_connection('a-d')
+      self.api.create_connection('a-c', from_id='a', to_id='c')
+
+    assert self.api.get_block('a')['Rule'] == {'Interval': '5s'}
+    assert self.api.get_block('d')['Rule'] == {'x': 2}
+    assert sorted(self.api.block_ids) == ['a', 'c', 'd']
+    assert self.api.connection_ids == ['a-c']
+    assert b.diff['remove_connections'] == []
+    assert b.diff['remove_blocks'] == ['b']
+
+  def test_failures(self):
+    self.api.create_block('a', type='ticker')
+
+    def bad():
+      with self.api.batch():
+        self.api.create_block('b', type='tolog')
+        self.api.create_connection(from_id='a', to_id='missing')
+    self.assertRaises(ValueError, bad)
+    assert self.api.block_ids == ['a']
+
+    with self.api.batch(strict=False) as b:
+      self.api.create_block('b', type='tolog')
+      self.api.delete_block('missing')
+    assert [r['ok'] for r in b.results] == [True, False]
+    assert 'does not exist' in b.results[1]['error']
+    assert sorted(self.api.block_ids) == ['a', 'b']
+
+  def test_partial(self):
+    self.api.create_block('a', type='ticker')
+    self.api.create_block('b', type='tolog')
+
+    # the import fails after the delete and update have landed.
+    dispatch = self.server.dispatch
+    def flaky(method, parts, body):
+      if parts == ['import']:
+        return 500, {'daemon': 'import failed'}
+      return dispatch(method, parts, body)
+    self.server.dispatch = flaky
+
+    b = self.api.batch()
+    def bad():
+      with b:
+        self.api.update_block('a', {'Interval': '5s'})
+        self.api.delete_block('b')
+        self.api.create_block('c', type='tolog')
+        self.api.create_connection('a-c', from_id='a', to_id='c')
+    self.assertRaises(ValueError, bad)
+
+    assert [r['ok'] for r in b.results] == [True, True, False, False]
+    assert b.results[2]['error'] == 'Error loading pattern'
+    assert self.api.block_ids == ['a']
+
+  def test_lazy_models(self):
+    with self.api.batch():
+      b1 = st.Block('a', type='ticker', api=self.api, lazy=True)
+      b2 = st.Block('b', type='tolog', api=self.api, lazy=True)
+      c = b1 + b2
+      b1.attach()
+      b2.attach()
+      c.attach()
+    assert self.api.get_connection(c.id)['FromId'] == 'a'
+
+
+class TeardownTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer(latency=0.01).start()
+    self.api = st.Api(self.server.url)
+    with self.api.batch():
+      for i in range(50):
+        self.api.create_block('b-{}'.format(i), type='tolog')
+      for i in range(49):
+        self.api.create_connection('c-{}'.format(i), 
+          from_id='b-{}'.format(i), to_id='b-{}'.format(i + 1))
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_delete_pattern(self):
+    assert self.api.delete_pattern(concurrency=8)
+    assert 1 < self.server.peak_inflight['DELETE'] <= 8
+    assert self.api.get_pattern() == {'Blocks': [], 'Connections': []}
+    assert 'GET blocks' not in self.server.hits
+
+  def test_failures(self):
+    delete = self.api.delete_block
+    def flaky(block_id):
+      if block_id in ('b-3', 'b-12'):
+        raise ValueError('nope ' + block_id)
+      return delete(block_id)
+    self.api.delete_block = flaky
+
+    try:
+      self.api.delete_blocks(concurrency=5)
+      assert False
+    except ValueError as e:
+      assert e.failures == {'b-3': 'nope b-3', 'b-12': 'nope b-12'}
+      assert str(e) == 'Failed to delete b-12: nope b-12; b-3: nope b-3'
+    assert sorted(self.api.block_ids) == ['b-12', 'b-3']
@@ -0,0 +1,111 @@
+from unittest import TestCase
+
+import streamtools as st
+from streamtools.engine import Engine, compile_expr, parse_duration
+from streamtools.fake import FakeServer
+
+
+def tokenize(body):
+  for word in body['text'].split():
+    yield {'word': word}
+
+
+class ExprTests(TestCase):
+
+  def test_paths(self):
+    msg = {'a': {'b': [1, 2]}, 'user': 'bob', 'n': 7}
+    assert compile_expr('.a.b[1]')(msg) == 2
+    assert compile_expr('.')(msg) == msg
+    assert compile_expr('.missing.key')(msg) is None
+
+  def test_logic(self):
+    msg = {'n': 7, 'user': 'bob'}
+    assert compile_expr('.n > 5 && .user == "bob"')(msg)
+    assert compile_expr('.n * 2 < 10 || !(.user != "bob")')(msg) is True
+    assert compile_expr('.n + 1 == 8')(msg)
+    assert not compile_expr('.missing > 5')(msg)
+    self.assertRaises(ValueError, compile_expr, '.n >')
+    self.assertRaises(ValueError, compile_expr, '.n @ 5')
+
+  def test_durations(self):
+    assert parse_duration('1h0m30s') == 3630
+    assert parse_duration('500ms') == 0.5
+    assert parse_duration(None, 2) == 2
+
+
+class EngineTests(TestCase):
+
+  def test_pipeline(self):
+    raw = {
+      'Blocks': [
+        {'Id': 'in', 'Type': 'map', 'Rule': {'Map': {'big': '.n > 2'}}},
+        {'Id': 'filter', 'Type': 'filter', 'Rule': {'Filter': '.big'}},
+        {'Id': 'count', 'Type': 'count', 'Rule': {'Window': '1m'}},
+        {'Id': 'log', 'Type': 'tolog', 'Rule': {}}
+      ],
+      'Connections': [
+        {'Id': 'a', 'FromId': 'in', 'ToId': 'filter', 'ToRoute': 'in'},
+        {'Id': 'b', 'FromId': 'filter', 'ToId': 'count', 'ToRoute': 'in'},
+        {'Id': 'c', 'FromId': 'filter', 'ToId': 'log', 'ToRoute': 'in'}
+      ]
+    }
+    with Engine(raw) as engine:
+      for n in range(6):
+        engine.send('in', {'n': n})
+      assert engine.drain()
+      assert engine.query('count', 'count') == {'Count': 3}
+      assert [m['n'] for m in engine.blocks['log'].messages] == [3, 4, 5]
+      assert engine.stats['filter'] == {'in': 6, 'out': 3, 'errors': 0}
+
+  def test_ticker(self):
+    raw = {
+      'Blocks': [{'Id': 'tick', 'Type': 'ticker', 'Rule': {'Interval': '10ms'}}],
+      'Connections': []
+    }
+    with Engine(raw) as engine:
+      ticks = engine.subscribe('tick')
+      assert 'tick' in ticks.get(timeout=1)
+      engine.send('tick', {'Interval': '1h'}, route='rule')
+      assert engine.drain()
+      assert engine.blocks['tick'].interval == 3600
+
+  def test_unknown_type(self):
+    raw = {'Blocks': [{'Id': 'x', 'Type': 'fromwebsocket'}], 'Connections': []}
+    self.assertRaises(ValueError, Engine, raw)
+
+  def test_plugins(self):
+    with FakeServer() as server:
+      plugin = st.Plugin('tokenize', url=server.url, lazy=True)
+      plugin.main = tokenize
+      source = st.Block('source', type='map', url=server.url, lazy=True)
+      hist = st.Block('hist', type='histogram', rule={'Path': '.word'}, 
+                      url=server.url, lazy=True)
+      p = st.Pattern(url=server.url)
+      p += source + plugin.in_block
+      p += plugin.out_block + hist
+
+      with p.local(plugins=[plugin]) as engine:
+        engine.send('source', {'text': 'a b a'})
+        assert engine.drain()
+        hist = engine.query('hist', 'histogram')['Histogram']
+        assert sorted((h['Label'], h['Count']) for h in hist) == [('a', 2), ('b', 1)]
+      assert server.request_count == 0
+
+  def test_plugin_paths(self):
+    with FakeServer() as server:
+      seen = []
+      def main(body):
+        seen.append(dict(body))
+        return [body]
+      plugin = st.Plugin('project', url=server.url, paths=['.text'], 
+                         skip_unmatched=True, lazy=True)
+      plugin.main = main
+      source = st.Block('source', type='map', url=server.url, lazy=True)
+      p = st.Pattern(url=server.url)
+      p += source + plugin.in_block
+
+      with p.local(plugins=[plugin]) as engine:
+        engine.send('source', {'text': 'a', 'n': 1})
+        engine.send('source', {'n': 2})
+        assert engine.drain()
+      assert seen == [{'text': 'a'}]
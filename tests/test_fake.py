@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+import streamtools as st
+from streamtools.fake import FakeServer
+
+
+class FakeServerTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_blocks(self):
+    bid = self.api.create_block('tick', type='ticker', rule={'Interval': '1s'})
+    assert bid == 'tick'
+    assert self.api.block_ids == ['tick']
+
+    self.api.update_block('tick', rule={'Interval': '5s'})
+    assert self.api.get_block('tick')['Rule']['Interval'] == '5s'
+
+    self.api.delete_block('tick')
+    self.assertRaises(ValueError, self.api.get_block, 'tick')
+
+  def test_connections(self):
+    self.api.create_block('a', type='ticker')
+    self.api.create_block('b', type='tolog')
+    cid = self.api.create_connection('a-b', from_id='a', to_id='b')
+    assert self.api.get_connection(cid)['ToRoute'] == 'in'
+
+    self.api.to_block_route('a', msg={'hello': 'world'})
+    last = self.api.from_connection_route(cid)
+    assert last['Last'] == {'hello': 'world'}
+
+    # deleting a block removes its connections.
+    self.api.delete_block('a')
+    assert self.api.list_connections() == []
+
+  def test_pattern(self):
+    pattern = {
+      'Blocks': [
+        {'Id': 'a', 'Type': 'ticker', 'Rule': {}},
+        {'Id': 'b', 'Type': 'tolog', 'Rule': {}}
+      ],
+      'Connections': [
+        {'Id': 'a-b', 'FromId': 'a', 'ToId': 'b', 'ToRoute': 'in'}
+      ]
+    }
+    assert self.api.set_pattern(pattern)
+    exported = self.api.get_pattern()
+    assert len(exported['Blocks']) == 2
+    assert exported['Connections'][0]['Id'] == 'a-b'
+
+    assert self.api.delete_pattern()
+    assert self.api.get_pattern() == {'Blocks': [], 'Connections': []}
+
+  def test_stream(self):
+    self.server.stream_rate = 100
+    self.api.create_block('a', type='ticker')
+    stream = self.api.stream('a')
+    msgs = [next(stream) for _ in range(3)]
+    assert [m['seq'] for m in msgs] == [1, 2, 3]
+
+  def test_hits(self):
+    self.api.create_block('a', type='ticker')
+    self.api.get_block('a')
+    assert self.server.hits['POST blocks'] == 1
+    assert self.server.hits['GET blocks/:id'] == 1
+    assert self.server.request_count == 2
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+import streamtools as st
+from streamtools.fake import FakeServer
+from streamtools.load import LoadGenerator
+
+
+class LoadTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.url = self.server.url
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _pattern(self):
+    b1 = st.Block('in', type='map', url=self.url)
+    b2 = st.Block('out', type='map', url=self.url)
+    p = st.Pattern(url=self.url)
+    p += b1 + b2
+    return p
+
+  def test_due(self):
+    load = LoadGenerator(None, rate=10, duration=2)
+    assert load.total == 20
+    assert load.due(10) == 1.0
+
+    # ramping from 10/s to 30/s sends 40 messages,
+    # half of them by 1.24s.
+    load = LoadGenerator(None, rate=10, ramp_to=30, duration=2)
+    assert load.total == 40
+    assert abs(load.due(20) - 1.2361) < 0.001
+    assert abs(load.due(40) - 2.0) < 1e-9
+
+    self.assertRaises(ValueError, LoadGenerator, None, rate=0)
+    self.assertRaises(ValueError, LoadGenerator, None, rate=10, ramp_to=0)
+
+  def test_run(self):
+    load = LoadGenerator(self._pattern(), rate=100, ramp_to=200,
+                         duration=0.5, workers=3, payload={'word': 'hi'})
+    report = load.run()
+    assert report['sent'] == report['target'] == 75
+    assert report['received'] == 75
+    assert report['lost'] == 0 and report['loss'] == 0.0
+    assert report['duplicates'] == 0 and report['errors'] == 0
+
+    latency = report['latency']
+    assert latency['count'] == 75
+    assert 0 < latency['p50'] <= latency['p99'] <= latency['p999'] < 1
+
+  def test_loss(self):
+    p = self._pattern()
+
+    # drop every other message on the way in.
+    send_to = p.send_to
+    def lossy(msg):
+      if msg['_load']['seq'] % 2:
+        return send_to(msg)
+    p.send_to = lossy
+
+    load = LoadGenerator(p, rate=100, duration=0.2, drain=0.5)
+    report = load.run()
+    assert report['sent'] == 20
+    assert report['received'] == 10
+    assert report['loss'] == 0.5
+
+    # the stream is closed though messages never arrived.
+    assert not load._listener.is_alive()
+    assert not load._stream.running
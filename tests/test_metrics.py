@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from streamtools.metrics import Counter, Histogram
+
+
+class MetricsTests(TestCase):
+
+  def test_counter(self):
+    c = Counter()
+    c.inc()
+    c.inc(4)
+    assert c.value == 5
+    assert c.rate() > 0
+    assert c.snapshot()['count'] == 5
+
+  def test_histogram(self):
+    h = Histogram()
+    for i in range(1, 1001):
+      h.add(i)
+    snap = h.snapshot()
+    assert snap['count'] == 1000
+    assert snap['min'] == 1 and snap['max'] == 1000
+    assert snap['mean'] == 500.5
+    assert snap['p50'] == 501
+    assert snap['p99'] == 991
+    assert snap['p999'] == 1000
+
+  def test_histogram_window(self):
+    h = Histogram(size=10)
+    for i in range(100):
+      h.add(i)
+    assert h.count == 100
+    assert h.percentile(0) == 90
+    assert Histogram().snapshot()['p50'] is None
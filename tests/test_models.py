@@ -0,0 +1,340 @@
+from unittest import TestCase
+import threading
+import time
+
+import streamtools as st
+from streamtools.fake import FakeServer
+from streamtools.util import diff_pattern
+from streamtools.compiler import compile_pattern
+
+
+class PatternTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.url = self.server.url
+    self.api = st.Api(self.url)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _pattern(self):
+    b1 = st.Block('ticker', type='ticker', rule={'Interval': '1s'}, url=self.url)
+    b2 = st.Block('log', type='tolog', url=self.url)
+    p = st.Pattern(url=self.url)
+    p += b1 + b2
+    return p
+
+  def test_reconcile(self):
+    p = self._pattern()
+    p.blocks[0].rule = {'Interval': '5s'}
+
+    # the block library is cached for validation.
+    self.api.library()
+    hits = self.server.request_count
+    diff = p.refresh(overwrite=False)
+    assert diff['update_rules'] == [('ticker', {'Interval': '5s'})]
+    assert not diff['add_blocks'] and not diff['remove_blocks']
+
+    # one export + one rule update.
+    assert self.server.request_count - hits == 2
+    assert self.api.get_block('ticker')['Rule'] == {'Interval': '5s'}
+
+  def test_reconcile_prune(self):
+    p = self._pattern()
+    self.api.create_block('other', type='tolog')
+    
+    p.attach(reconcile=True)
+    assert 'other' in self.api.block_ids
+
+    p.attach(reconcile=True, prune=True)
+    assert 'other' not in self.api.block_ids
+    assert sorted(self.api.block_ids) == ['log', 'ticker']
+
+
+class TopologyTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+    for i in range(5):
+      self.api.create_block(str(i), type='tolog')
+    for i in range(4):
+      self.api.create_connection(str(i) + '-' + str(i + 1), from_id=str(i), to_id=str(i + 1))
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_walk(self):
+    blocks = [st.Block(str(i), url=self.server.url, _init=False) for i in range(5)]
+    hits = self.server.hits.get('GET connections', 0)
+
+    assert blocks[0].in_blocks == []
+    assert blocks[0].out_blocks == ['1']
+    assert blocks[2].in_blocks == ['1']
+    assert sorted(c.id for c in blocks[2].connections) == ['1-2', '2-3']
+    assert self.server.hits['GET connections'] - hits == 1
+
+  def test_invalidate(self):
+    b = st.Block('4', url=self.server.url, _init=False)
+    assert b.out_blocks == []
+    self.api.create_connection(from_id='4', to_id='0')
+    assert b.out_blocks == ['0']
+    self.api.delete_block('0')
+    assert b.out_blocks == []
+
+
+class ListenTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+    self.api.create_block('a', type='map')
+    self.api.create_block('b', type='tolog')
+    self.api.create_connection('a-b', from_id='a', to_id='b')
+    self.conn = st.Connection('a-b', url=self.server.url, _init=False)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_push(self):
+    emitted = time.time() - 1
+    msgs = [{'seq': 1, 'ts': emitted}, {'seq': 2, 'ts': emitted}, {'seq': 5}]
+    def send():
+      for msg in msgs:
+        self.api.to_block_route('a', msg=msg)
+    threading.Timer(0.2, send).start()
+    
+    stream = self.conn.listen(push=True)
+    assert [next(stream) for msg in msgs] == msgs
+
+    stats = self.conn.listen_stats
+    assert stats['messages'] == 3
+    assert stats['gaps'] == 1
+    assert stats['missed'] == 2
+
+    # only messages with a ts are timed.
+    assert stats['latency'].count == 2
+    assert stats['latency'].min >= 1
+
+  def test_poll(self):
+    self.api.to_block_route('a', msg={'n': 1})
+    stream = self.conn.listen(interval=0.01, seq_key='n', ts_key='at')
+    assert next(stream) == {'n': 1}
+
+    # a message overwritten before the next poll is missed.
+    self.api.to_block_route('a', msg={'n': 2, 'at': time.time() - 1})
+    self.api.to_block_route('a', msg={'n': 3, 'at': time.time() - 1})
+    assert next(stream)['n'] == 3
+
+    stats = self.conn.listen_stats
+    assert stats['messages'] == 2
+    assert stats['polls'] >= 2
+    assert stats['gaps'] == 1
+    assert stats['missed'] == 1
+    assert stats['latency'].count == 1
+    assert stats['latency'].min >= 1
+
+
+class SharedApiTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.url = self.server.url
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_shared(self):
+    b1 = st.Block('a', type='ticker', url=self.url)
+    b2 = st.Block('b', type='tolog', url='http://' + self.url)
+    c = b1 + b2
+    p = c + (b2 + st.Block('c', type='tolog', url=self.url))
+    assert b1._st is b2._st is c._st is p._st
+    assert b1._st is st.client.get_api(self.url)
+    assert all(b._st is b1._st for b in c.blocks + b1.connections[0].blocks)
+
+  def test_explicit(self):
+    api = st.Api(self.url, pool_size=2)
+    b1 = st.Block('a', type='ticker', api=api)
+    c = b1 + st.Block('b', type='tolog', api=api)
+    assert b1._st is api and c._st is api
+    assert b1.url == self.url
+    assert api.stats.to_dict()['POST connections']['requests'] == 1
+
+
+class LazyTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.url = self.server.url
+    self.api = st.Api(self.url)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_build(self):
+    b1 = st.Block(type='ticker', url=self.url, lazy=True)
+    b2 = st.Block('log', type='tolog', url=self.url, lazy=True)
+    b3 = st.Block('log-2', type='tolog', url=self.url, lazy=True)
+    p = (b1 + b2) + (b1 + b3)
+    assert self.server.request_count == 0
+    assert b1.id and p.blocks[0] is b1
+
+    # one library lookup + one import.
+    p.attach()
+    assert self.server.request_count == 2
+    assert sorted(self.api.block_ids) == sorted([b1.id, 'log', 'log-2'])
+    assert len(self.api.list_connections()) == 2
+
+  def test_reference(self):
+    self.api.create_block('tick', type='ticker', rule={'Interval': '1s'})
+    hits = self.server.request_count
+    b = st.Block('tick', url=self.url, lazy=True)
+    assert self.server.request_count == hits
+
+    assert b.type == 'ticker'
+    assert b.rule == {'Interval': '1s'}
+    assert self.server.request_count == hits + 1
+
+  def test_sync(self):
+    b = st.Block('tick', type='ticker', url=self.url, lazy=True)
+    b.sync()
+    assert self.api.get_block('tick')['Type'] == 'ticker'
+
+    b.rule = {'Interval': '5s'}
+    hits = dict(self.server.hits)
+    b.sync()
+    assert self.api.get_block('tick')['Rule'] == {'Interval': '5s'}
+    assert self.server.hits.get('DELETE blocks/:id') == hits.get('DELETE blocks/:id')
+
+    c = b + st.Block('log', type='tolog', url=self.url)
+    assert c.id is None
+    c.sync()
+    hits = self.server.request_count
+    c.sync()
+    assert self.server.request_count == hits + 1
+    assert len(self.api.list_connections()) == 1
+
+
+class CompileTests(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.url = self.server.url
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _pattern(self, *conns):
+    blocks = {
+      'tick': st.Block('tick', type='ticker', url=self.url, lazy=True),
+      'map': st.Block('map', type='map', url=self.url, lazy=True),
+      'log': st.Block('log', type='tolog', url=self.url, lazy=True)
+    }
+    p = st.Pattern(url=self.url)
+    for from_id, to_id, route in conns:
+      p += st.Connection(from_id=from_id, to_id=to_id, to_route=route, 
+        url=self.url, lazy=True, blocks=[blocks[from_id], blocks[to_id]])
+    return p
+
+  def test_order(self):
+    p = self._pattern(('map', 'log', 'in'), ('tick', 'map', 'in'))
+    p.blocks.append(st.Block('lonely', type='tolog', url=self.url, lazy=True))
+    compiled = p.compile()
+    order = compiled['order']
+    assert sorted(order) == ['log', 'lonely', 'map', 'tick']
+    assert order.index('tick') < order.index('map') < order.index('log')
+    assert compiled['sources'] == ['tick']
+    assert compiled['sinks'] == ['log']
+    assert compiled['orphans'] == ['lonely']
+
+  def test_errors(self):
+    p = self._pattern(('tick', 'map', 'bogus'), ('log', 'map', 'in'), 
+                      ('map', 'log', 'rule'))
+    p.blocks.append(st.Block('x', type='nope', url=self.url, lazy=True))
+    try:
+      p.attach()
+      assert False
+    except ValueError as e:
+      assert len(e.errors) == 4
+      assert 'unknown type "nope"' in e.errors[0]
+      assert 'no "bogus" route' in e.errors[1]
+      assert 'no OutRoutes' in e.errors[2]
+      assert 'no "rule" route' in e.errors[3]
+    assert self.server.hits == {'GET library': 1}
+
+  def test_cycles(self):
+    p = self._pattern(('map', 'map', 'in'), ('tick', 'log', 'in'))
+    assert p.compile()['cycles'] == ['map']
+    try:
+      p.compile(allow_cycles=False)
+      assert False
+    except ValueError as e:
+      assert 'form a cycle' in e.errors[0]
+
+    # feedback loops still deploy.
+    p.attach()
+    assert len(st.Api(self.url).get_pattern()['Connections']) == 2
+
+  def test_failed_refresh(self):
+    p = self._pattern(('tick', 'map', 'in'))
+    p.attach()
+    deployed = st.Api(self.url).get_pattern()
+    assert len(deployed['Blocks']) == 2
+
+    # an invalid refresh leaves the running pattern alone.
+    p.connections[0].to_route = 'bogus'
+    self.assertRaises(ValueError, p.refresh)
+    assert st.Api(self.url).get_pattern() == deployed
+
+  def test_dangling(self):
+    raw = {
+      'Blocks': [{'Id': 'a', 'Type': 'ticker'}],
+      'Connections': [{'Id': 'c', 'FromId': 'a', 'ToId': 'b'}]
+    }
+    self.assertRaises(ValueError, compile_pattern, raw)
+
+
+class DiffTests(TestCase):
+
+  blocks = [
+    {'Id': 'a', 'Type': 'ticker', 'Rule': {'Interval': '1s'}},
+    {'Id': 'b', 'Type': 'tolog', 'Rule': {}}
+  ]
+  connections = [{'Id': 'c', 'FromId': 'a', 'ToId': 'b', 'ToRoute': 'in'}]
+
+  def test_noop(self):
+    pattern = {'Blocks': self.blocks, 'Connections': self.connections}
+    diff = diff_pattern(pattern, pattern)
+    assert not any(diff.values())
+
+  def test_add_and_replace(self):
+    current = {'Blocks': self.blocks, 'Connections': self.connections}
+    desired = {
+      'Blocks': [
+        {'Id': 'a', 'Type': 'ticker', 'Rule': {'Interval': '1s'}},
+        {'Id': 'b', 'Type': 'count', 'Rule': {}},
+        {'Id': 'd', 'Type': 'tolog', 'Rule': {}}
+      ],
+      'Connections': self.connections + [
+        {'Id': 'e', 'FromId': 'b', 'ToId': 'd', 'ToRoute': 'in'}
+      ]
+    }
+    diff = diff_pattern(current, desired)
+    assert diff['remove_blocks'] == ['b']
+    assert sorted(b['Id'] for b in diff['add_blocks']) == ['b', 'd']
+
+    # `c` is deleted along with `b`, so it's re-added.
+    assert sorted(c['Id'] for c in diff['add_connections']) == ['c', 'e']
+    assert diff['remove_connections'] == []
+
+  def test_rewired_connection(self):
+    current = {'Blocks': self.blocks, 'Connections': self.connections}
+    desired = {
+      'Blocks': self.blocks,
+      'Connections': [{'Id': 'c', 'FromId': 'a', 'ToId': 'b', 'ToRoute': 'rule'}]
+    }
+    diff = diff_pattern(current, desired)
+    assert diff['remove_connections'] == ['c']
+    assert diff['add_connections'] == desired['Connections']
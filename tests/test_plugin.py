@@ -0,0 +1,503 @@
+from unittest import TestCase
+from collections import defaultdict
+import os
+import threading
+import time
+
+from kombu import Connection, Producer, Queue
+import requests
+import ujson
+
+import streamtools as st
+from streamtools import settings
+from streamtools.codec import Codec, CODECS, Projection
+from streamtools.fake import FakeServer
+
+
+def square(body):
+  time.sleep(0.01)
+  yield {'n': body['n'] ** 2, 'pid': os.getpid()}
+
+
+def split(body):
+  for word in body['text'].split():
+    yield {'word': word}
+
+
+def shout(body):
+  yield {'word': body['word'].upper(), 'pid': os.getpid()}
+
+
+def unpicklable(body):
+  if body['n'] == 1:
+    yield {'n': body['n'], 'fn': lambda: None}
+  else:
+    yield body
+
+
+class Settled:
+
+  # a delivered message that records how it was settled.
+  def __init__(self):
+    self.state = None
+
+  def ack(self):
+    self.state = 'ack'
+
+  def reject(self):
+    self.state = 'reject'
+
+  def requeue(self):
+    self.state = 'requeue'
+
+
+class ConfirmChannel:
+
+  # a channel that confirms, or refuses, everything published.
+  def __init__(self, nack=False):
+    self.events = defaultdict(set)
+    self.nack = nack
+    self.published = 0
+
+  def confirm_select(self):
+    pass
+
+  def wait(self, methods):
+    if self.nack:
+      for callback in self.events['basic_nack']:
+        callback(self.published, True, False)
+    else:
+      for callback in self.events['basic_ack']:
+        callback(self.published, True)
+
+
+class FlakyProducer:
+
+  # a producer whose `fail_at`th publish raises.
+  def __init__(self, channel, fail_at=None):
+    self.channel = channel
+    self.fail_at = fail_at
+    self.bodies = []
+
+  def publish(self, body, **kw):
+    if len(self.bodies) + 1 == self.fail_at:
+      raise IOError('connection lost')
+    self.bodies.append(body)
+    self.channel.published += 1
+
+
+class PluginTestCase(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer().start()
+    self.conn = Connection('memory://', 
+                           transport_options={'polling_interval': 0.01})
+
+  def tearDown(self):
+    self.server.stop()
+
+  def plugin(self, main, **kw):
+    plugin = st.Plugin(url=self.server.url, connection=self.conn, **kw)
+    plugin.main = main
+
+    # collect outputs
+    self.out = Queue('out-' + plugin.out_key, settings.EXCHANGE, 
+                     routing_key=plugin.out_key)
+    with self.conn.channel() as channel:
+      self.out(channel).declare()
+      plugin.queues[0](channel).declare()
+    return plugin
+
+  def publish(self, plugin, bodies):
+    with self.conn.channel() as channel:
+      producer = Producer(channel, exchange=settings.EXCHANGE)
+      for body in bodies:
+        producer.publish(body, routing_key=plugin.in_key, serializer=None,
+                         content_type='application/data')
+
+  def run_plugin(self, plugin, n, timeout=5):
+
+    # run the plugin until n outputs are published.
+    thread = threading.Thread(target=plugin.run)
+    thread.start()
+
+    outputs = []
+    deadline = time.time() + timeout
+    with self.conn.channel() as channel:
+      queue = self.out(channel)
+      while len(outputs) < n and time.time() < deadline:
+        message = queue.get()
+        if message:
+          outputs.append(message.payload)
+          message.ack()
+        else:
+          time.sleep(0.01)
+
+    plugin.should_stop = True
+    thread.join()
+    return outputs
+
+
+class PluginTests(PluginTestCase):
+
+  def test_inline(self):
+    def double(body):
+      yield {'n': body['n'] * 2}
+
+    plugin = self.plugin(double)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(5)])
+    outputs = self.run_plugin(plugin, 5)
+    assert [o['n'] for o in outputs] == [0, 2, 4, 6, 8]
+
+  def test_concurrent_ordered(self):
+    lock = threading.Lock()
+    calls = {'active': 0, 'peak': 0}
+    overtaken = threading.Event()
+    finished = []
+
+    def slow(body):
+      with lock:
+        calls['active'] += 1
+        calls['peak'] = max(calls['peak'], calls['active'])
+
+      # the first message finishes once a later one has.
+      if body['n'] == 0:
+        overtaken.wait(5)
+      with lock:
+        calls['active'] -= 1
+        finished.append(body['n'])
+      overtaken.set()
+      yield body
+
+    plugin = self.plugin(slow, concurrency=5)
+    assert plugin.prefetch_count == 10
+    self.publish(plugin, ['{"n": %d}' % i for i in range(5)])
+
+    outputs = self.run_plugin(plugin, 5)
+    assert [o['n'] for o in outputs] == range(5)
+    assert finished[0] != 0
+    assert 1 < calls['peak'] <= 5
+
+  def test_concurrent_unordered(self):
+    def slow(body):
+      time.sleep(0.05 * (5 - body['n']))
+      yield body
+
+    plugin = self.plugin(slow, concurrency=5, ordered=False)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(5)])
+    outputs = self.run_plugin(plugin, 5)
+    assert sorted(o['n'] for o in outputs) == range(5)
+
+  def test_errors(self):
+    def fail(body):
+      if body['n'] == 1:
+        raise ValueError('bad')
+      yield body
+
+    plugin = self.plugin(fail, concurrency=2)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(3)])
+    outputs = self.run_plugin(plugin, 2)
+    assert [o['n'] for o in outputs] == [0, 2]
+
+  def test_batched_publish(self):
+    def tokenize(body):
+      for word in body['text'].split():
+        yield {'word': word}
+
+    plugin = self.plugin(tokenize, publish_batch_size=25, publish_interval=1)
+    flushes = []
+    flush = plugin._flush
+    def counted():
+      if plugin._outbox:
+        flushes.append(len(plugin._outbox))
+      flush()
+    plugin._flush = counted
+
+    self.publish(plugin, ['{"text": "a b c d e f g h i j"}'] * 6)
+    outputs = self.run_plugin(plugin, 60)
+    assert len(outputs) == 60
+    assert flushes == [30, 30]
+
+  def test_failed_flush(self):
+    plugin = self.plugin(None, publish_batch_size=10, publish_interval=10)
+    plugin._producer = FlakyProducer(ConfirmChannel(), fail_at=2)
+    message = Settled()
+    plugin._inflight = 1
+    plugin._complete([message], ([{'n': 1}, {'n': 2}, {'n': 3}], None, 0))
+
+    # nothing is published twice, and the message waits to be redelivered.
+    self.assertRaises(IOError, plugin._flush)
+    assert plugin._outbox == [] and plugin._settle == []
+    plugin._flush()
+    assert plugin._producer.bodies == ['{"n":1}']
+    assert message.state is None
+    assert plugin.stats()['out']['count'] == 1
+    assert plugin.stats()['inflight'] == 0
+
+  def test_confirms(self):
+    for nack, state in [(False, 'ack'), (True, 'requeue')]:
+      plugin = self.plugin(None, confirm=True, publish_batch_size=2, 
+                           publish_interval=10)
+      channel = ConfirmChannel(nack=nack)
+      plugin._producer = FlakyProducer(channel)
+      plugin._start_confirms(channel)
+
+      messages = [Settled(), Settled()]
+      plugin._inflight = 2
+      plugin._complete(messages[:1], ([{'n': 1}], None, 0))
+      assert messages[0].state is None
+      plugin._complete(messages[1:], ([{'n': 2}], None, 0))
+      assert [m.state for m in messages] == [state, state]
+      assert plugin._unconfirmed == set()
+
+  def test_processes(self):
+    plugin = self.plugin(square, executor='process', concurrency=2)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(10)])
+    outputs = self.run_plugin(plugin, 10)
+    assert [o['n'] for o in outputs] == [i * i for i in range(10)]
+    assert len(set(o['pid'] for o in outputs)) == 2
+
+  def test_process_unpicklable(self):
+
+    # outputs that can't leave the worker fail the message.
+    plugin = self.plugin(unpicklable, executor='process', concurrency=2)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(4)])
+    outputs = self.run_plugin(plugin, 3)
+    assert [o['n'] for o in outputs] == [0, 2, 3]
+    assert plugin.stats()['errors']['count'] == 1
+    assert plugin.stats()['inflight'] == 0
+
+  def test_process_batches(self):
+
+    # the default main_batch runs `main` in the pool.
+    plugin = self.plugin(square, executor='process', concurrency=2, batch_size=5)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(10)])
+    outputs = self.run_plugin(plugin, 10)
+    assert [o['n'] for o in outputs] == [i * i for i in range(10)]
+    assert os.getpid() not in [o['pid'] for o in outputs]
+
+  def test_process_batches_unpicklable(self):
+
+    # one unpicklable output fails its batch, not later ones.
+    plugin = self.plugin(unpicklable, executor='process', concurrency=2, 
+                         batch_size=2, batch_wait=0.05)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(6)])
+    outputs = self.run_plugin(plugin, 4)
+    assert [o['n'] for o in outputs] == [2, 3, 4, 5]
+    assert plugin.stats()['errors']['count'] == 1
+    assert plugin.stats()['inflight'] == 0
+
+  def test_processes_need_functions(self):
+    class Squares(st.Plugin):
+      def main(self, body):
+        yield body
+    plugin = Squares(url=self.server.url, executor='process')
+    self.assertRaises(ValueError, plugin._start_pool)
+
+  def test_main_batch(self):
+    sizes = []
+    def score(bodies):
+      sizes.append(len(bodies))
+      for body in bodies:
+        yield {'n': body['n'], 'batch': len(bodies)}
+
+    plugin = self.plugin(None, batch_size=4, batch_wait=0.05)
+    plugin.main_batch = score
+    self.publish(plugin, ['{"n": %d}' % i for i in range(10)])
+    outputs = self.run_plugin(plugin, 10)
+    assert [o['n'] for o in outputs] == range(10)
+    assert sizes == [4, 4, 2]
+
+  def test_main_batch_errors(self):
+    def fail(bodies):
+      if any(body['n'] == 1 for body in bodies):
+        raise ValueError('bad')
+      return bodies
+
+    plugin = self.plugin(None, batch_size=2, concurrency=2)
+    plugin.main_batch = fail
+    self.publish(plugin, ['{"n": %d}' % i for i in range(4)])
+    outputs = self.run_plugin(plugin, 2)
+    assert [o['n'] for o in outputs] == [2, 3]
+
+  def test_stats(self):
+    def fail(body):
+      if body['n'] == 1:
+        raise ValueError('bad')
+      yield body
+      yield body
+
+    plugin = self.plugin(fail, publish_batch_size=2)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(3)])
+    self.run_plugin(plugin, 4)
+
+    stats = plugin.stats()
+    assert stats['id'] == plugin.id
+    assert stats['in']['count'] == 3
+    assert stats['out']['count'] == 4
+    assert stats['errors']['count'] == 1
+    assert stats['main_time']['count'] == 3
+    assert stats['publish_time']['count'] == 2
+    assert stats['inflight'] == 0
+
+  def test_stats_reporting(self):
+    def slow(body):
+      time.sleep(0.05)
+      yield body
+
+    st.Api(self.server.url).create_block('stats', type='tolog')
+    reports = self.server.state.subscribe('stats')
+    plugin = self.plugin(slow, stats_block='stats', stats_port=0, 
+                         stats_interval=0.05)
+    self.publish(plugin, ['{"n": %d}' % i for i in range(5)])
+    self.run_plugin(plugin, 5)
+    assert reports.get_nowait()['id'] == plugin.id
+
+    plugin._start_reporting()
+    url = 'http://localhost:%d' % plugin._stats_server.server_address[1]
+    assert requests.get(url).json()['in']['count'] == 5
+    plugin._stop_reporting()
+
+  def test_pipe(self):
+    first = self.plugin(split)
+    second = self.plugin(shout, publish_batch_size=3)
+    fused = first | second
+    assert fused.in_key == first.in_key and fused.out_key == second.out_key
+    assert fused.in_block is first.in_block and fused.out_block is second.out_block
+
+    self.publish(first, ['{"text": "a b c"}', '{"text": "d"}'])
+    outputs = self.run_plugin(fused, 4)
+    assert [o['word'] for o in outputs] == ['A', 'B', 'C', 'D']
+    assert fused.stats()['in']['count'] == 2
+    assert fused.stats()['out']['count'] == 4
+
+  def test_pipe_batches(self):
+    def count(bodies):
+      yield {'n': len(bodies)}
+
+    first = self.plugin(split, batch_size=2, batch_wait=0.05)
+    second = self.plugin(None, batch_size=10)
+    second.main_batch = count
+    third = self.plugin(lambda body: [body, body])
+
+    fused = first | second | third
+    assert len(fused.main.stages) == 3
+    self.publish(first, ['{"text": "a b c"}', '{"text": "d"}'])
+    outputs = self.run_plugin(fused, 2)
+    assert outputs == [{'n': 4}, {'n': 4}]
+
+  def test_pipe_processes(self):
+    first = self.plugin(split, executor='process', concurrency=2)
+    fused = first | self.plugin(shout)
+    self.publish(first, ['{"text": "a b"}', '{"text": "c"}'])
+    outputs = self.run_plugin(fused, 3)
+    assert [o['word'] for o in outputs] == ['A', 'B', 'C']
+    assert os.getpid() not in [o['pid'] for o in outputs]
+
+  def test_pipe_settings(self):
+    first = self.plugin(split)
+    self.assertRaises(ValueError, first.pipe, self.plugin(shout, paths=['.word']))
+
+    # a batched Plugin without its own main_batch fuses into processes.
+    first = self.plugin(split, executor='process', concurrency=2)
+    fused = first | self.plugin(shout, batch_size=10)
+    assert fused.main.picklable
+    self.publish(first, ['{"text": "a b"}'])
+    outputs = self.run_plugin(fused, 2)
+    assert [o['word'] for o in outputs] == ['A', 'B']
+
+  def test_codecs(self):
+    def echo(body):
+      yield body
+
+    plugin = self.plugin(echo, codec='raw')
+    self.publish(plugin, ['not json', '{"n": 1}'])
+    outputs = self.run_plugin(plugin, 2)
+    assert outputs == ['not json', '{"n": 1}']
+
+    reverse = Codec('reverse', 'application/x-reverse', 
+                    lambda o: ujson.dumps(o)[::-1], lambda b: ujson.loads(b[::-1]))
+    plugin = self.plugin(echo, codec=reverse, out_codec='json')
+    self.publish(plugin, ['}1 :"n"{'])
+    assert plugin.out_codec is CODECS['json']
+    outputs = self.run_plugin(plugin, 1)
+    assert outputs == [{'n': 1}]
+
+  def test_projection(self):
+    codec = Projection(['.summary', '.user.name'])
+    body = '{"meta": {"summary": "no"}, "text": "\\"summary\\": [", ' \
+           '"summary": "yes", "user": {"name": "bob"}}'
+    msg = codec.loads(body)
+    assert msg == {'summary': 'yes', 'user': {'name': 'bob'}}
+    assert codec.dumps(msg) is body
+    assert codec.loads('{"text": "hi"}') == {}
+
+    # nested repeats of a key are passed over in the same scan.
+    body = '{"revisions": [' + ', '.join(['{"summary": "no"}'] * 500) + \
+           '], "summary": "yes"}'
+    offsets = codec.matches(body)
+    assert offsets.keys() == ['summary']
+    assert codec.loads(body, offsets) == {'summary': 'yes'}
+    assert codec.loads(codec.loads(body)) == {'summary': 'yes'}
+
+    msg['user']['name'] = 'al'
+    del msg['summary']
+    assert ujson.loads(codec.dumps(msg)) == \
+      {'meta': {'summary': 'no'}, 'text': '"summary": [', 'user': {'name': 'al'}}
+
+  def test_projection_skips(self):
+    seen = []
+    def count(body):
+      seen.append(body)
+      yield body
+
+    bodies = [
+      '{"n": 1}', 
+      '{"meta": {"summary": "nested"}}', 
+      '{"summary": "yes"}'
+    ]
+
+    # by default, main sees every body.
+    plugin = self.plugin(count, paths=['.summary'])
+    self.publish(plugin, bodies)
+    outputs = self.run_plugin(plugin, 3)
+    assert seen == [{}, {}, {'summary': 'yes'}]
+    assert outputs[1] == {'meta': {'summary': 'nested'}}
+    assert plugin.stats()['skipped']['count'] == 0
+
+    del seen[:]
+    plugin = self.plugin(count, paths=['.summary'], skip_unmatched=True)
+    self.publish(plugin, bodies)
+    outputs = self.run_plugin(plugin, 1)
+    assert outputs == [{'summary': 'yes'}]
+    assert seen == [{'summary': 'yes'}]
+    assert plugin.stats()['skipped']['count'] == 2
+    assert plugin.stats()['inflight'] == 0
+    assert not plugin.codec.matches('{"n": 1}')
+
+  def test_plugin_projection(self):
+    def tag(body):
+      if body.get('summary') == 'tag':
+        body['tagged'] = True
+      yield body
+
+    plugin = self.plugin(tag, paths=['.summary'])
+    assert isinstance(plugin.codec, Projection)
+    assert plugin.out_codec is plugin.codec
+    self.publish(plugin, [
+      '{"summary": "pass", "n": 1}', 
+      '{"summary": "tag", "n": 2}',
+      '{"n": 3}'
+    ])
+    outputs = self.run_plugin(plugin, 2)
+    assert outputs == [
+      {'summary': 'pass', 'n': 1}, 
+      {'summary': 'tag', 'n': 2, 'tagged': True}
+    ]
+    self.assertRaises(ValueError, st.Plugin, url=self.server.url, 
+                      codec='raw', paths=['.summary'])
+
+  def test_unknown_codec(self):
+    self.assertRaises(ValueError, st.Plugin, url=self.server.url, codec='xml')
+    if 'msgpack' not in CODECS:
+      self.assertRaises(ValueError, st.Plugin, url=self.server.url, codec='msgpack')
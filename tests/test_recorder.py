@@ -0,0 +1,168 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from kombu import Connection
+import ujson
+
+import streamtools as st
+from streamtools.codec import Codec
+from streamtools.fake import FakeServer
+from streamtools import recorder
+from streamtools.recorder import Recorder, Replayer, segment_paths
+
+
+class RecorderTests(TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def write(self, n, **kw):
+    with Recorder(self.path, **kw) as rec:
+      for i in range(n):
+        rec.write({'n': i}, ts=1000.0 + i)
+
+  def test_round_trip(self):
+    self.write(100, segment_size=500, index_interval=10)
+    assert len(segment_paths(self.path)) > 1
+
+    lines = list(Replayer(self.path, speed=None).lines())
+    assert [ts for ts, _ in lines] == [1000.0 + i for i in range(100)]
+    assert list(Replayer(self.path, speed=None)) == [{'n': i} for i in range(100)]
+
+    # appends go to a new segment.
+    n_segments = len(segment_paths(self.path))
+    self.write(1)
+    assert len(segment_paths(self.path)) == n_segments + 1
+    assert list(Replayer(self.path, speed=None))[-1] == {'n': 0}
+
+  def test_seek(self):
+    self.write(50, index_interval=7)
+    replay = Replayer(self.path, speed=None, start=1020.0, end=1029.0)
+    assert list(replay) == [{'n': i} for i in range(20, 30)]
+
+  def test_truncated(self):
+
+    # a crash loses the block it cut short.
+    self.write(10, index_interval=4)
+    log_path = segment_paths(self.path)[0]
+    with open(log_path, 'r+b') as f:
+      f.truncate(os.path.getsize(log_path) - 3)
+    assert len(list(Replayer(self.path, speed=None))) == 8
+
+  def test_compression(self):
+    line = ujson.dumps({'summary': 'Undid revision 639204823 by 10.0.0.1', 'user': 'Example'})
+    with Recorder(self.path) as rec:
+      for i in range(1000):
+        rec.write(line)
+    stored = sum(os.path.getsize(p) for p in segment_paths(self.path))
+    assert stored < len(line) * 1000 * 0.1
+
+  def test_speed(self):
+    with Recorder(self.path) as rec:
+      for i in range(5):
+        rec.write({'n': i}, ts=i * 0.1)
+
+    # record the sleeps instead of taking them.
+    sleeps = []
+    class Clock:
+      time = staticmethod(time.time)
+      sleep = staticmethod(sleeps.append)
+
+    recorder.time = Clock
+    try:
+      assert len(list(Replayer(self.path, speed=4))) == 5
+      assert len(sleeps) == 4
+      for i, wait in enumerate(sleeps):
+        assert abs(wait - (i + 1) * 0.025) < 0.01, sleeps
+
+      del sleeps[:]
+      assert len(list(Replayer(self.path, speed=None))) == 5
+      assert sleeps == []
+
+    finally:
+      recorder.time = time
+
+  def test_missing(self):
+    self.assertRaises(ValueError, Replayer, os.path.join(self.path, 'nope'))
+
+
+class ReplayTests(TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.server = FakeServer().start()
+    self.api = st.Api(self.server.url)
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.path)
+
+  def test_record_block(self):
+    self.server.stream_rate = 200
+    self.api.create_block('tick', type='ticker')
+    with Recorder(self.path) as rec:
+      assert rec.record(self.api, 'tick', limit=20) == 20
+
+    msgs = list(Replayer(self.path, speed=None))
+    assert [m['seq'] for m in msgs] == range(1, 21)
+
+  def test_record_quiet(self):
+
+    # a quiet stream still stops at the deadline.
+    self.api.create_block('quiet', type='tolog')
+    with Recorder(self.path) as rec:
+      recording = threading.Thread(target=rec.record, args=(self.api, 'quiet'), 
+                                   kwargs={'duration': 0.2})
+      recording.start()
+      recording.join(10)
+      assert not recording.is_alive()
+
+  def test_to_block(self):
+    self.api.create_block('a', type='map')
+    self.api.create_block('b', type='tolog')
+    conn_id = self.api.create_connection(from_id='a', to_id='b')
+    with Recorder(self.path) as rec:
+      for i in range(5):
+        rec.write({'n': i})
+
+    assert Replayer(self.path, speed=None).to_block(self.api, 'a') == 5
+    assert self.api.from_connection_route(conn_id)['Last'] == {'n': 4}
+
+  def test_to_plugin(self):
+    conn = Connection('memory://')
+    plugin = st.Plugin(url=self.server.url, connection=conn)
+    with conn.channel() as channel:
+      queue = plugin.queues[0](channel)
+      queue.declare()
+
+      with Recorder(self.path) as rec:
+        for i in range(3):
+          rec.write({'n': i})
+      assert Replayer(self.path, speed=None).to_plugin(plugin) == 3
+
+      msgs = [queue.get(no_ack=True) for i in range(3)]
+      assert [m.payload for m in msgs] == [{'n': 0}, {'n': 1}, {'n': 2}]
+
+  def test_to_plugin_codec(self):
+    reverse = Codec('reverse', 'application/x-reverse',
+                    lambda o: ujson.dumps(o)[::-1], lambda b: ujson.loads(b[::-1]))
+    conn = Connection('memory://')
+    plugin = st.Plugin(url=self.server.url, connection=conn, codec=reverse)
+    with conn.channel() as channel:
+      queue = plugin.queues[0](channel)
+      queue.declare()
+
+      with Recorder(self.path) as rec:
+        rec.write({'n': 1})
+      Replayer(self.path, speed=None).to_plugin(plugin)
+
+      msg = queue.get(no_ack=True)
+      assert msg.content_type == 'application/x-reverse'
+      assert reverse.loads(msg.body) == {'n': 1}